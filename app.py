@@ -1,30 +1,97 @@
-from flask import Flask, url_for, redirect, render_template, request, flash, make_response
+from flask import Flask, url_for, redirect, render_template, request, flash, make_response, jsonify, Response, \
+    stream_with_context, send_file, send_from_directory, abort, session
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
 
 from myConfig import Config
 from flask_sqlalchemy import SQLAlchemy
+from flask_migrate import Migrate, upgrade
 from flask_login import LoginManager, UserMixin, current_user, logout_user, login_required, login_user
-import phonenumbers
+import os
 import re
-from datetime import datetime
-from sqlalchemy import text
-from werkzeug.security import generate_password_hash, check_password_hash
+import atexit
+import click
+import json
+import mimetypes
+import sqlite3
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+from sqlalchemy import text, inspect
+from sqlalchemy.exc import IntegrityError
+from werkzeug.utils import safe_join
+from alembic.migration import MigrationContext
+from alembic.script import ScriptDirectory
+
+import queries
+from archive import MessageArchive
+from assets import AssetManifest, AssetError, downloadVendor, buildAssets
+from avatars import AvatarStore, AvatarError, AVATAR_HASH
+from cache import createCache
+from database import engineOptions, configureEngine
+from events import createEventBus
+from instrumentation import instrument
+from passwords import PasswordHasher, HasherBusy, AttemptThrottle
+from phones import PhoneValidator
+from ingest import MessageWriter, IngestQueueFull
 
 
 app = Flask(__name__)
 app.config.from_object(Config)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///coopNet.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engineOptions(app.config)
 db = SQLAlchemy(app)
+configureEngine(db.engine, app.config['SQLITE_PRAGMAS'])
+# Схема БД ведется миграциями (flask db upgrade)
+MIGRATIONS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+migrate = Migrate(app, db, directory=MIGRATIONS, render_as_batch=True)
+if app.config['INSTRUMENTATION']:
+    instrument(app, db.engine)
+# Полнотекстовый поиск сообщений работает на FTS5 и есть только в SQLite
+message_search = db.engine.dialect.name == 'sqlite'
 login_manager = LoginManager(app)
+bus = createEventBus(app.config, app.logger)
+message_archive = MessageArchive(app.config['ARCHIVE_PATH'])
+phone_validator = PhoneValidator(app.config['PHONE_REGIONS'])
+password_hasher = PasswordHasher(app.config['PASSWORD_HASH_METHOD'],
+                                 app.config['PASSWORD_HASH_WORKERS'],
+                                 app.config['PASSWORD_HASH_QUEUE'],
+                                 app.config['PASSWORD_HASH_TIMEOUT'])
+# Неудачные попытки входа: на один email с одного адреса, на один email и с одного адреса
+login_throttle = AttemptThrottle(app.config['LOGIN_ACCOUNT_ADDRESS_ATTEMPTS'], app.config['LOGIN_THROTTLE_WINDOW'])
+account_throttle = AttemptThrottle(app.config['LOGIN_ACCOUNT_ATTEMPTS'], app.config['LOGIN_THROTTLE_WINDOW'])
+address_throttle = AttemptThrottle(app.config['LOGIN_ADDRESS_ATTEMPTS'], app.config['LOGIN_THROTTLE_WINDOW'])
+fragment_cache = createCache(app.config)
+assets = AssetManifest(app.config['ASSETS_BUILD_PATH'])
+# Скомпилированные шаблоны сохраняются на диск, новые процессы их не компилируют
+if app.config['JINJA_BYTECODE_CACHE']:
+    os.makedirs(app.config['JINJA_BYTECODE_CACHE'], exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['JINJA_BYTECODE_CACHE'])
+avatar_store = AvatarStore(app.config['AVATAR_STORAGE'],
+                           app.config['AVATAR_SIZES'],
+                           app.config['AVATAR_MAX_SIZE'],
+                           app.config['AVATAR_MAX_PIXELS'])
 
 # region БД
 chat_user = db.Table(
     'Список Участников Чата',
     db.Column('chat_id', db.Integer(), db.ForeignKey('Чат.chat_id')),
-    db.Column('user_id', db.String(320), db.ForeignKey('Пользователь.id'))
+    db.Column('user_id', db.String(320), db.ForeignKey('Пользователь.id')),
+    db.Index('ix_chat_user_user_id_chat_id', 'user_id', 'chat_id'),
+    db.Index('ix_chat_user_chat_id_user_id', 'chat_id', 'user_id')
 )
 
 
+# Ключ поиска в справочнике - строка без учета регистра. lower() в SQLite меняет регистр
+# только латинских букв, поэтому ключи считаются в Python и хранятся в отдельных колонках
+def searchKey(value):
+    return value.casefold() if value else value
+
+
+# Ключ заполняется при вставке строки по значению колонки column
+def searchKeyDefault(column):
+    return lambda context: searchKey(context.get_current_parameters().get(column))
+
+
 class User(db.Model, UserMixin):
     __tablename__ = 'Пользователь'
     id = db.Column(db.Integer, primary_key=True)
@@ -36,27 +103,19 @@ class User(db.Model, UserMixin):
     info = db.Column(db.String(70))
     date_registration = db.Column(db.DateTime, default=datetime.utcnow)
     # theme =
-    photo = db.Column(db.BLOB, nullable=True)
-
-    # Получаем аватар пользователя
-    def GetAvatar(self, app):
-        img = None
-        if not self.photo:
-            try:
-                with app.open_resource(app.root_path + url_for('static', filename='images/Avatar.png'),
-                                       'rb') as f:
-                    img = f.read()
-            except FileNotFoundError as e:
-                print(f'Не найден аватар по умолчанию: {str(e)}')
-        else:
-            img = self.photo
-
-        return img
+    # Изображение загружается только при явном обращении к колонке
+    photo = db.deferred(db.Column(db.BLOB, nullable=True))
+    # Хэш аватара в хранилище на диске (AvatarStore)
+    photo_hash = db.Column(db.String(64), nullable=True)
+    # Ключи поиска в справочнике (searchKey)
+    login_key = db.Column(db.String(32), default=searchKeyDefault('login'))
+    name_key = db.Column(db.String(60), default=searchKeyDefault('name'))
+    email_key = db.Column(db.String(320), default=searchKeyDefault('email'))
 
     # Верификация типа изображения
     def VerifyExt(self, filename):
-        ext = filename.rsplit('.', 1)[1]
-        if ext in ('png', 'PNG'):
+        ext = filename.rsplit('.', 1)[-1]
+        if ext.lower() in ('png', 'jpg', 'jpeg'):
             return True
         return False
 
@@ -65,7 +124,8 @@ class User(db.Model, UserMixin):
         if not avatar:
             return False
         try:
-            self.photo = avatar
+            self.photo_hash = avatar_store.save(avatar)
+            self.photo = None
             db.session.commit()
         except Exception as e:
             print(f'Ошибка обновления аватара в БД: {str(e)}')
@@ -76,6 +136,7 @@ class User(db.Model, UserMixin):
     def RemoveAvatar(self):
         try:
             self.photo = None
+            self.photo_hash = None
             db.session.commit()
         except Exception as e:
             print(f'Ошибка удаления аватара из БД: {str(e)}')
@@ -91,31 +152,18 @@ class Chat(db.Model):
     chat_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     chat_name = db.Column(db.String(32))
     chat_description = db.Column(db.String(70))
-    chat_photo = db.Column(db.BLOB, nullable=True)
+    chat_photo = db.deferred(db.Column(db.BLOB, nullable=True))
+    # Хэш аватара в хранилище на диске (AvatarStore)
+    chat_photo_hash = db.Column(db.String(64), nullable=True)
     chat_creator = db.Column(db.Integer, db.ForeignKey('Пользователь.id'))
 
     # Для получения доступа к связанным объектам
     cats = db.relationship('User', secondary=chat_user, backref=db.backref('tasks', lazy='dynamic'))
 
-    # Получаем аватар пользователя
-    def GetAvatar(self, app):
-        img = None
-        if not self.chat_photo:
-            try:
-                with app.open_resource(app.root_path + url_for('static', filename='images/ChatAvatar.png'),
-                                       'rb') as f:
-                    img = f.read()
-            except FileNotFoundError as e:
-                print(f'Не найден аватар по умолчанию: {str(e)}')
-        else:
-            img = self.chat_photo
-
-        return img
-
     # Верификация типа изображения
     def VerifyExt(self, filename):
-        ext = filename.rsplit('.', 1)[1]
-        if ext in ('png', 'PNG'):
+        ext = filename.rsplit('.', 1)[-1]
+        if ext.lower() in ('png', 'jpg', 'jpeg'):
             return True
         return False
 
@@ -124,7 +172,8 @@ class Chat(db.Model):
         if not avatar:
             return False
         try:
-            self.chat_photo = avatar
+            self.chat_photo_hash = avatar_store.save(avatar)
+            self.chat_photo = None
             db.session.commit()
         except Exception as e:
             print(f'Ошибка обновления аватара в БД: {str(e)}')
@@ -135,6 +184,7 @@ class Chat(db.Model):
     def RemoveAvatar(self):
         try:
             self.chat_photo = None
+            self.chat_photo_hash = None
             db.session.commit()
         except Exception as e:
             print(f'Ошибка удаления аватара из БД: {str(e)}')
@@ -142,6 +192,22 @@ class Chat(db.Model):
         return True
 
 
+# Личный чат двух пользователей, user_a < user_b
+class DirectChat(db.Model):
+    __tablename__ = 'Личный Чат'
+    chat_id = db.Column(db.Integer, db.ForeignKey('Чат.chat_id'), primary_key=True)
+    user_a = db.Column(db.Integer, db.ForeignKey('Пользователь.id'), nullable=False)
+    user_b = db.Column(db.Integer, db.ForeignKey('Пользователь.id'), nullable=False)
+
+    __table_args__ = (db.UniqueConstraint('user_a', 'user_b', name='uq_direct_chat_users'),)
+
+
+# Индексы для поиска пользователей по началу логина, имени и email без учета регистра
+db.Index('ix_user_login_key', User.login_key)
+db.Index('ix_user_name_key', User.name_key)
+db.Index('ix_user_email_key', User.email_key)
+
+
 class Message(db.Model):
     __tablename__ = 'Сообщение'
     message_id = db.Column(db.Integer, primary_key=True, autoincrement=True)
@@ -150,12 +216,230 @@ class Message(db.Model):
     message_content = db.Column(db.String(120))
     message_date_sent = db.Column(db.DateTime, default=datetime.utcnow)
     message_status = db.Column(db.Integer, default=0)
+
+    # Индекс для постраничной загрузки истории чата по курсору message_id.
+    # Отправитель в индексе - для подсчета непрочитанных без чтения строк таблицы
+    __table_args__ = (db.Index('ix_message_chat_id_message_id_sender', 'chat_id', 'message_id', 'message_sender'),)
+
+
+# Сводка чата для боковой панели: последнее сообщение.
+# Обновляется в одной транзакции с отправкой и удалением сообщений
+class ChatSummary(db.Model):
+    __tablename__ = 'Сводка Чата'
+    chat_id = db.Column(db.Integer, db.ForeignKey('Чат.chat_id'), primary_key=True)
+    last_message_id = db.Column(db.Integer)
+    last_message_content = db.Column(db.String(120))
+    last_message_date_sent = db.Column(db.DateTime)
+    last_message_sender = db.Column(db.Integer, db.ForeignKey('Пользователь.id'))
+
+
+# Граница прочтения: последнее прочитанное участником сообщение чата.
+# Непрочитанные сообщения и отметки о прочтении вычисляются по ней
+class ReadMark(db.Model):
+    __tablename__ = 'Прочитанные Сообщения'
+    chat_id = db.Column(db.Integer, db.ForeignKey('Чат.chat_id'), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('Пользователь.id'), primary_key=True)
+    last_read_message_id = db.Column(db.Integer, nullable=False, default=0)
 #endregion
 
 
+# region Схема
+# Короткая транзакция записи. В SQLite блокировка записи берется сразу (BEGIN IMMEDIATE),
+# поэтому параллельные писатели ждут друг друга (busy_timeout), а не получают "database is locked"
+def writing():
+    return db.engine.execution_options(write_transaction=True).begin()
+
+
+# Пересчитываем сводки чатов по таблице сообщений и архиву
+def rebuildChatSummaries():
+    with writing() as connection:
+        connection.execute(text("delete from \"Сводка Чата\""))
+        connection.execute(text("insert into \"Сводка Чата\" (chat_id, last_message_id, last_message_content, last_message_date_sent, last_message_sender) "
+                                "select chat_id, message_id, message_content, message_date_sent, message_sender "
+                                "from \"Сообщение\" "
+                                "where message_id in (select max(message_id) from \"Сообщение\" group by chat_id)"))
+
+        # Сообщения чатов, которых нет в основной таблице, целиком перенесены в архив:
+        # их сводки берутся из последнего сообщения архива
+        archived = []
+        for chat_id, in connection.execute(text("select chat_id from \"Чат\" c "
+                                                "where not exists (select 1 from \"Сводка Чата\" s where s.chat_id = c.chat_id)")).fetchall():
+            for message in message_archive.messages(chat_id, MAX_MESSAGE_ID, 1):
+                archived.append(message)
+        if archived:
+            connection.execute(queries.UPSERT_CHAT_SUMMARY, archived)
+
+
+# Переносим прочтения из message_status в границы прочтения участников
+def backfillReadMarks():
+    with writing() as connection:
+        connection.execute(text("insert into \"Прочитанные Сообщения\" (chat_id, user_id, last_read_message_id) "
+                                "select member.chat_id, cast(member.user_id as integer), max(mes.message_id) "
+                                "from \"Список Участников Чата\" member inner join \"Сообщение\" mes "
+                                "on mes.chat_id = member.chat_id "
+                                "and (mes.message_sender = cast(member.user_id as integer) or mes.message_status = 1) "
+                                "group by member.chat_id, member.user_id"))
+
+
+# Пересобираем полнотекстовый индекс сообщений (FTS5, создается миграцией). Тексты
+# хранятся только в таблице сообщений, индекс ссылается на них по message_id
+def rebuildSearchIndex():
+    with writing() as connection:
+        connection.execute(text("insert into \"Поиск Сообщений\" (\"Поиск Сообщений\") values ('rebuild')"))
+
+
+# Переносим аватары из BLOB-колонок в хранилище на диске
+def exportAvatars():
+    exported = 0
+    for user in User.query.filter(User.photo.isnot(None)):
+        try:
+            user.photo_hash = avatar_store.save(user.photo)
+        except AvatarError as e:
+            print(f'Аватар пользователя {user.id} не перенесен: {str(e)}')
+            continue
+        user.photo = None
+        exported += 1
+    for chat in Chat.query.filter(Chat.chat_photo.isnot(None)):
+        try:
+            chat.chat_photo_hash = avatar_store.save(chat.chat_photo)
+        except AvatarError as e:
+            print(f'Аватар чата {chat.chat_id} не перенесен: {str(e)}')
+            continue
+        chat.chat_photo = None
+        exported += 1
+    db.session.commit()
+    return exported
+
+
+# Переносим сообщения старше cutoff в архив пачками по batch_size. Каждая пачка
+# удаляется из основной таблицы (и из индекса поиска) своей короткой транзакцией.
+# Сначала пишется архив: при сбое сообщения останутся в обоих местах, а не пропадут,
+# повторы в архиве при чтении отбрасываются
+def archivingMessages(cutoff, batch_size, block_size):
+    archived = 0
+    after = (0, 0)
+    while True:
+        with db.engine.connect() as connection:
+            rows = connection.execute(queries.ARCHIVE_CANDIDATES, cutoff=str(cutoff), chat_id=after[0], message_id=after[1],
+                                      limit=batch_size).fetchall()
+        if not rows:
+            return archived
+
+        chats = {}
+        for row in rows:
+            chats.setdefault(row.chat_id, []).append(dict(row._mapping))
+        for chat_id, messages in chats.items():
+            message_archive.write(chat_id, messages, block_size)
+
+        with writing() as connection:
+            if message_search:
+                connection.execute(queries.SEARCH_INDEX_DELETE,
+                                   [{'message_id': row.message_id, 'message_content': row.message_content, 'chat_id': row.chat_id}
+                                    for row in rows])
+            connection.execute(queries.DELETE_MESSAGES, message_ids=[row.message_id for row in rows])
+
+        archived += len(rows)
+        after = (rows[-1].chat_id, rows[-1].message_id)
+
+
+# Возвращаем свободные страницы файла SQLite шагами по step страниц, чтобы
+# не держать блокировку записи долго. Работает в режиме auto_vacuum = incremental.
+# execute модуля sqlite3 выполняет только первый шаг incremental_vacuum (одну страницу),
+# поэтому прагма выполняется через executescript - каждый шаг своей транзакцией
+def reclaimingSpace(step):
+    if db.engine.dialect.name != 'sqlite':
+        return 0
+
+    reclaimed = 0
+    connection = db.engine.raw_connection()
+    try:
+        if connection.execute('pragma auto_vacuum').fetchone()[0] != 2:
+            return 0
+        while True:
+            free = connection.execute('pragma freelist_count').fetchone()[0]
+            if not free:
+                return reclaimed
+            connection.executescript('pragma incremental_vacuum({:d})'.format(min(step, free)))
+            reclaimed += min(step, free)
+    finally:
+        connection.close()
+
+
+# Версия схемы: (в последней ли она миграции, создана ли БД до перехода на миграции)
+def schemaState():
+    with db.engine.connect() as connection:
+        current = set(MigrationContext.configure(connection).get_current_heads())
+        legacy = not current and inspect(connection).has_table(User.__tablename__)
+    return current == set(ScriptDirectory(MIGRATIONS).get_heads()), legacy
+
+
+# Приводим схему БД к последней миграции. БД, созданные до перехода на миграции,
+# принимаются начальной миграцией, после чего аватары из их BLOB-колонок переносятся
+# в хранилище. Если БД уже в последней версии, Alembic не запускается.
+# Процессы, запущенные одновременно, не выполняют миграции наперегонки: миграции идут
+# под монопольной блокировкой файла SCHEMA_LOCK_PATH, остальные процессы ждут ее
+# и после нее видят уже обновленную схему
+def upgradeSchema():
+    if schemaState()[0]:
+        return
+
+    lock = sqlite3.connect(app.config['SCHEMA_LOCK_PATH'], timeout=app.config['SCHEMA_LOCK_TIMEOUT'],
+                           isolation_level=None)
+    try:
+        lock.execute('begin exclusive')
+        updated, legacy = schemaState()
+        if updated:
+            return
+        with app.app_context():
+            upgrade(directory=MIGRATIONS)
+            if legacy:
+                exportAvatars()
+    finally:
+        # Незавершенная транзакция откатывается, блокировка снимается
+        lock.close()
+
+
+if app.config['DATABASE_AUTO_UPGRADE']:
+    upgradeSchema()
+# endregion
+
+
+# Пользователь текущего запроса: только поля, нужные страницам, без изображений и пароля
+class Identity(UserMixin):
+    def __init__(self, id, email, name, login, photo_hash):
+        self.id = id
+        self.email = email
+        self.name = name
+        self.login = login
+        self.photo_hash = photo_hash
+
+    def __repr__(self):
+        return '<Identity %r>' % self.id
+
+
+# Пользователь берется из сессии, а из БД перечитывается не чаще раза в IDENTITY_CACHE_TTL секунд
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(user_id)
+    cached = session.get('identity')
+    if cached and str(cached['id']) == str(user_id) and time.time() - cached['loaded'] < app.config['IDENTITY_CACHE_TTL']:
+        return Identity(**cached['user'])
+
+    row = db.engine.execute(queries.USER_IDENTITY, user_id=user_id).first()
+    if row is None:
+        session.pop('identity', None)
+        return None
+    return rememberIdentity(dict(row._mapping))
+
+
+# Запоминаем данные пользователя (колонки USER_IDENTITY) в сессии
+def rememberIdentity(user):
+    session['identity'] = {'id': user['id'], 'loaded': time.time(), 'user': user}
+    return Identity(**user)
+
+
+# Сбрасываем кэш пользователя в сессии после изменения его данных
+def forgetIdentity():
+    session.pop('identity', None)
 
 
 @app.route('/logout')
@@ -190,14 +474,10 @@ def isValidLogin(error, not_error, login):
 
 
 def isValidPhone(error, not_error, phone):
-    try:
-        my_number = phonenumbers.parse(phone, 'RUS')
-        if not phonenumbers.is_valid_number(my_number):
-            error['phone'] = 'Неверный номер телефона'
-        else:
-            not_error['phone'] = phone
-    except:
+    if not phone_validator.valid(phone):
         error['phone'] = 'Неверный номер телефона'
+    else:
+        not_error['phone'] = phone
 
 
 def isValidEmail(error, not_error, email):
@@ -226,93 +506,230 @@ def isValidPassword(error, not_error, password, confirm_password):
         not_error['password'] = password
 
 
-def isValidUser(error, user):
-    if user != 0:
-        error['user_exists'] = 'Пользователь с таким email уже существует!'
+# Email, логин и телефон пользователя уникальны. Занятое значение определяет
+# сама БД при добавлении пользователя, отдельных проверок перед вставкой нет
+UNIQUE_USER_FIELDS = (('email', 'user_exists', 'Пользователь с таким email уже существует!'),
+                      ('login', 'login', 'Пользователь с таким логином уже существует!'),
+                      ('telephone', 'phone', 'Пользователь с таким номером телефона уже существует!'))
+
+
+def isUniqueUser(error, integrity_error):
+    for column, field, message in UNIQUE_USER_FIELDS:
+        if column in str(integrity_error.orig):
+            error[field] = message
+            return
+    raise integrity_error
 # endregion
 
 
 # region SQL
-# Необходимо еще возвращать id собеседника
+# Курсор первой страницы истории чата
+MAX_MESSAGE_ID = 2 ** 63 - 1
+
+
+# Получаем все чаты пользователя для боковой панели одним запросом по сводкам чатов.
+# Для личных чатов возвращается собеседник, чаты упорядочены по последней активности
 def gettingChats():
-    # Получаем все чаты пользователя
-    sql = text("select inf.chat_id, me, friend, p.email, message_id, message_sender, message_content, message_date_sent, message_status "
-               "from (  select * "
-               "from (  select info_chat.chat_id, me, friend, message_id, message_sender, message_content, message_date_sent, message_status "
-               "from (  select f_chat.chat_id, f_chat.user_id as me, s_chat.user_id as friend "
-               "from 'Список Участников Чата' f_chat inner join 'Список Участников Чата' s_chat on f_chat.chat_id==s_chat.chat_id "
-               "where f_chat.user_id=='{}' and f_chat.user_id!=s_chat.user_id and f_chat.chat_id not in (select chat_id from 'Чат' where chat_description=='chat') "
-               ") info_chat left outer join 'Сообщение' mes on info_chat.chat_id == mes.chat_id "
-               "order by message_date_sent desc "
-               ") chat_mes "
-               "group by chat_mes.chat_id) inf inner join 'Пользователь' p on inf.friend == p.id".format(current_user.id))
-    return [row for row in db.engine.execute(sql)]
-
-
-# Получаем все групповые чаты авторизованного пользователя (Оптимизировано)
-def gettingGroupChats():
-
-    sql = text("select chat_id, chat_name, chat_description, chat_creator, message_id, message_content, message_date_sent, message_status "
-               "from (select chInfo.*, c.message_id, c.message_content, c.message_date_sent, c.message_status "
-               "from (select myCh.*, ch.chat_name, ch.chat_description, ch.chat_creator "
-               "from (select chat_id "
-               "from 'Список Участников Чата' "
-               "where user_id=='{}') myCh inner join 'Чат' ch on myCh.chat_id==ch.chat_id "
-               "where chat_description == 'chat' ) chInfo left outer join 'Сообщение' c on chInfo.chat_id==c.chat_id "
-               "order by message_date_sent desc) info "
-               "group by info.chat_id".format(current_user.id))
-
-    return [row for row in db.engine.execute(sql)]
-
-
-# Получаем все сообщения одного чата по его id (Оптимизировано)
-def receivingChatMessages(chat_id):
-    sql = text("select mes.message_id, mes.chat_id, mes.message_sender, user.name, mes.message_content, mes.message_date_sent, mes.message_status "
-               "from (select * "
-               "from 'Сообщение' "
-               "where chat_id == '{}' "
-               "order by message_date_sent asc) mes left join 'Пользователь' user on mes.message_sender = user.id ".format(chat_id))
-
-    return [row for row in db.engine.execute(sql)]
+    return [row for row in db.engine.execute(queries.USER_CHATS, user_id=current_user.id)]
+
+
+# Получаем страницу сообщений одного чата по его id (Оптимизировано)
+# Страница заканчивается перед сообщением before (курсор), без OFFSET.
+# Возвращает сообщения по возрастанию и признак наличия более старых сообщений
+def receivingChatMessages(chat_id, before=None, limit=None):
+    if limit is None:
+        limit = app.config['MESSAGES_PAGE_SIZE']
+    if before is None:
+        before = MAX_MESSAGE_ID
+
+    messages = [row for row in db.engine.execute(queries.CHAT_MESSAGES, chat_id=chat_id, before=before, limit=limit + 1)]
+    # Более старые сообщения дочитываются из архива
+    if len(messages) <= limit:
+        messages = archivedMessages(chat_id, messages[0].message_id if messages else before, limit + 1 - len(messages)) + messages
+    has_more = len(messages) > limit
+    if has_more:
+        messages = messages[1:]
+    return messages, has_more
+
+
+# Страница сообщений чата для потоковой отрисовки (Оптимизировано).
+# Границы страницы определяются по индексу, а сами сообщения читаются курсором по мере вывода шаблона.
+# Возвращает сообщения, признак наличия более старых сообщений и id (первого, последнего) сообщения
+# страницы. Неполная страница дочитывается из архива, как в receivingChatMessages
+def streamingChatMessages(chat_id, before=None, limit=None):
+    if limit is None:
+        limit = app.config['MESSAGES_PAGE_SIZE']
+    if before is None:
+        before = MAX_MESSAGE_ID
+
+    first, last, count = db.engine.execute(queries.CHAT_PAGE_BOUNDS, chat_id=chat_id, before=before, limit=limit).first()
+    if count < limit:
+        messages, has_more = receivingChatMessages(chat_id, before, limit)
+        return messages, has_more, (messages[0][0], messages[-1][0]) if messages else None
+
+    has_more = (db.engine.execute(queries.CHAT_OLDER_MESSAGE, chat_id=chat_id, before=first).first() is not None
+                or bool(message_archive.messages(chat_id, first, 1)))
+    return rangeRows(chat_id, first, last, app.config['HOMEPAGE_STREAM_ROWS']), has_more, (first, last)
+
+
+# Сообщения чата с first по last пачками по batch_size строк. Каждая пачка читается коротким
+# запросом, после которого соединение сразу возвращается в пул: медленный клиент не держит
+# соединение пула и транзакцию чтения SQLite (она не дает checkpoint перенести WAL в БД),
+# пока дочитывает страницу. Цена - запрос на каждую пачку, и страница читается не одним
+# снимком: сообщение, удаленное во время отдачи страницы, может в нее не попасть
+def rangeRows(chat_id, first, last, batch_size):
+    while first <= last:
+        with db.engine.connect() as connection:
+            rows = connection.execute(queries.CHAT_MESSAGES_RANGE, chat_id=chat_id, first=first, last=last,
+                                      limit=batch_size).fetchall()
+        if not rows:
+            return
+        yield from rows
+        first = rows[-1].message_id + 1
+
+
+# Строка сообщения из архива с теми же колонками, что и в CHAT_MESSAGES
+ArchivedMessage = namedtuple('ArchivedMessage', ['message_id', 'chat_id', 'message_sender', 'name', 'message_content',
+                                                 'message_date_sent', 'message_status', 'photo_hash'])
+
+
+# Получаем из архива последние limit сообщений чата перед сообщением before.
+# Имена и аватары отправителей - текущие, из таблицы пользователей
+def archivedMessages(chat_id, before, limit):
+    messages = message_archive.messages(chat_id, before, limit)
+    if not messages:
+        return []
+
+    senders = {row[0]: row for row in db.engine.execute(queries.MESSAGE_SENDERS,
+                                                        user_ids=list({message['message_sender'] for message in messages}))}
+    rows = []
+    for message in messages:
+        sender = senders.get(message['message_sender'])
+        rows.append(ArchivedMessage(message['message_id'], message['chat_id'], message['message_sender'],
+                                    sender[1] if sender else None, message['message_content'],
+                                    message['message_date_sent'], message['message_status'],
+                                    sender[2] if sender else None))
+    return rows
+
+
+# Запрос для полнотекстового поиска из введенной строки: слова ищутся целиком,
+# последнее слово - по началу. Операторы FTS5 из ввода не попадают в запрос
+def searchExpression(query):
+    words = re.findall(r'\w+', query)
+    if not words:
+        return None
+    return ' '.join('"{}"'.format(word) for word in words) + '*'
+
+
+# Поиск сообщений в чатах пользователя (Оптимизировано).
+# Совпадения берутся из индекса FTS5 и упорядочены по релевантности (bm25)
+def searchingMessages(query, offset, limit):
+    return [row for row in db.engine.execute(queries.SEARCH_MESSAGES,
+                                             query=query,
+                                             user_id=current_user.id,
+                                             limit=limit,
+                                             offset=offset)]
+
+
+# Сдвигаем границу прочтения пользователя вперед одной строкой (Оптимизировано).
+# Возвращает True, если граница изменилась
+def markingChatRead(chat_id, user_id, message_id):
+    return db.engine.execute(queries.MARK_CHAT_READ, chat_id=chat_id, user_id=user_id, message_id=message_id).rowcount > 0
+
+
+# Получаем последнее сообщение чата, прочитанное кем-либо из собеседников
+def gettingChatReadUpTo(chat_id, user_id):
+    return db.engine.execute(queries.CHAT_READ_UP_TO, chat_id=chat_id, user_id=user_id).scalar() or 0
+
+
+# Получаем id всех чатов пользователя
+def gettingUserChatIds(user_id):
+    return {row[0] for row in db.engine.execute(queries.USER_CHAT_IDS, user_id=user_id)}
 
 
 # Получаем список участников чата по id чата (Оптимизировано)
 def gettingChatParticipants(chat_id):
-    sql = text("select user_id "
-               "from 'Список Участников Чата' "
-               "where chat_id=='{}' and user_id != '{}'".format(chat_id, current_user.id))
-
-    return db.engine.execute(sql).first()
+    return db.engine.execute(queries.CHAT_COMPANION, chat_id=chat_id, user_id=current_user.id).first()
 
 
 # Получаем имя чата по id пользователя (Оптимизировано)
 # Используется только для P2P чатов
 def gettingChatNameById(user_id):
-    sql = text("select email "
-               "from 'Пользователь' "
-               "where id == '{}'".format(user_id))
-
-    return db.engine.execute(sql).first()
+    return db.engine.execute(queries.USER_EMAIL, user_id=user_id).first()
 
 
 # Получаем информацию о пользователе P2P чата по id пользователя (Оптимизировано)
 def chatParticipantProfile(user_id):
-    sql = text("select id, email, name, telephone, login, info, date_registration "
-               "from 'Пользователь' "
-               "where id == '{}' ".format(user_id))
+    return db.engine.execute(queries.USER_PROFILE, user_id=user_id).first()
 
-    return db.engine.execute(sql).first()
 
+# Получаем id личного чата двух пользователей, создавая его при первом открытии
+def gettingDirectChat(user_id, companion_id):
+    user_a, user_b = sorted((int(user_id), int(companion_id)))
+    chat = db.engine.execute(queries.DIRECT_CHAT, user_a=user_a, user_b=user_b).first()
+    if chat is not None:
+        return chat[0]
 
-def userInformation(user):
+    companion = gettingChatNameById(companion_id)
+    if companion is None:
+        return None
 
-    if user is not None:
-        sql = text("select count(*) from 'Пользователь' where email=='{}'".format(user))
-    else:
-        sql = text("select * "
-                   "from 'Пользователь' "
-                   "where id != '{}'".format(current_user.id))
-    return [row for row in db.engine.execute(sql)]
+    try:
+        with writing() as connection:
+            chat_id = connection.execute(queries.INSERT_CHAT,
+                                         chat_name=companion[0], chat_description='friend', chat_creator=user_id).scalar()
+            connection.execute(queries.INSERT_DIRECT_CHAT,
+                               chat_id=chat_id, user_a=user_a, user_b=user_b)
+            connection.execute(queries.INSERT_CHAT_MEMBER,
+                               [{'chat_id': chat_id, 'user_id': user_a}, {'chat_id': chat_id, 'user_id': user_b}])
+    except IntegrityError:
+        # Чат уже создан параллельным запросом
+        return db.engine.execute(queries.DIRECT_CHAT, user_a=user_a, user_b=user_b).first()[0]
+
+    bus.publish(chat_id, 'members_changed', {'chat_id': chat_id, 'added': [user_a, user_b], 'removed': []})
+    return chat_id
+
+
+# Id пользователей, отмеченных в форме: без повторов и только существующие
+def formUserIds(connection, form):
+    requested = {int(key) for key in form.keys() if key.isdigit()}
+    if not requested:
+        return set()
+    return {row[0] for row in connection.execute(queries.EXISTING_USERS, user_ids=sorted(requested))}
+
+
+# Добавляем участников в чат одним executemany, пропуская тех, кто уже в чате
+def addingChatMembers(connection, chat_id, user_ids):
+    members = {row[0] for row in connection.execute(queries.CHAT_MEMBER_IDS, chat_id=chat_id)}
+    added = sorted(set(user_ids) - members)
+    if added:
+        connection.execute(queries.INSERT_CHAT_MEMBER, [{'chat_id': chat_id, 'user_id': user_id} for user_id in added])
+    return added
+
+
+# Удаляем участников из чата вместе с их границами прочтения
+def removingChatMembers(connection, chat_id, user_ids):
+    members = {row[0] for row in connection.execute(queries.CHAT_MEMBER_IDS, chat_id=chat_id)}
+    removed = sorted(set(user_ids) & members)
+    if removed:
+        rows = [{'chat_id': chat_id, 'user_id': user_id} for user_id in removed]
+        connection.execute(queries.DELETE_CHAT_MEMBER, rows)
+        connection.execute(queries.DELETE_READ_MARK, rows)
+    return removed
+
+
+# Страница справочника пользователей (Оптимизировано).
+# Поиск по началу логина, имени или email идет по индексам, страницы - по курсору id
+def searchingUsers(query, after, limit):
+    sql = queries.SEARCH_USERS if query else queries.LIST_USERS
+
+    query = searchKey(query)
+    return [row for row in db.engine.execute(sql,
+                                             query=query,
+                                             query_end=query + '\uffff',
+                                             after=after,
+                                             user_id=current_user.id,
+                                             limit=limit)]
 # endregion
 
 
@@ -331,158 +748,278 @@ def registration():
         isValidEmail(error, not_error, request.form['reg_email'])
         isValidPassword(error, not_error, request.form['reg_password'], request.form['confirm_password'])
 
-        user = userInformation(request.form['reg_email'].lower())
-        isValidUser(error, user[0][0])
-
         if not error:
             # Добавление нового пользователя
-            sql = text("INSERT INTO 'Пользователь' (email, name, telephone, login, password, info, date_registration) "
-                       "VALUES ('{}', '{}', '{}', '{}', '{}', '{}', '{}')".format(request.form['reg_email'].lower(),
-                                                                                  request.form['name'],
-                                                                                  phone,
-                                                                                  request.form['login'],
-                                                                                  generate_password_hash(request.form['reg_password']),
-                                                                                  'Напишите информацию о себе',
-                                                                                  datetime.utcnow()))
-            db.engine.execute(sql)
-
-            sql = text("select p1.id, p1.email, p2.id, p2.email "
-                       "from 'Пользователь' p1 inner join 'Пользователь' p2 "
-                       "    on p1.email !=p2.email and p1.email == '{}'".format(request.form['reg_email'].lower()))
-
-            table = [row for row in db.engine.execute(sql)]
-            for row in table:
-                try:
-                    user1_id, user1_email, user2_id, user2_email = row
-
-                    user_in_db = db.session.query(User).filter_by(email=user1_email).first()
-                    user_in_db_2 = db.session.query(User).filter_by(email=user2_email).first()
-
-                    chat = Chat(chat_name=user2_email, chat_description='friend', chat_creator=user1_id)
-                    chat.cats.append(user_in_db)
-                    chat.cats.append(user_in_db_2)
-                    db.session.add(chat)
-                    db.session.flush()
-                except:
-                    # Если были ошибки, то откатываемся назад
-                    db.session.rollback()
-                    print("Ошибка добавления в БД")
-                # Сохраняем изменения в таблице
-                db.session.commit()
-
-            return redirect(url_for('authorization'))
-        else:
-            return render_template('Registration.html', title='Registration', message=[error, not_error])
+            try:
+                db.engine.execute(queries.INSERT_USER,
+                                  email=request.form['reg_email'].lower(),
+                                  name=request.form['name'],
+                                  telephone=phone,
+                                  login=request.form['login'],
+                                  email_key=searchKey(request.form['reg_email']),
+                                  name_key=searchKey(request.form['name']),
+                                  login_key=searchKey(request.form['login']),
+                                  password=password_hasher.hash(request.form['reg_password']),
+                                  info='Напишите информацию о себе',
+                                  date_registration=str(datetime.utcnow()))
+            except IntegrityError as e:
+                isUniqueUser(error, e)
+            else:
+                # Личные чаты создаются при первом открытии (gettingDirectChat)
+                return redirect(url_for('authorization'))
+
+        return render_template('Registration.html', title='Registration', message=[error, not_error])
 
     return render_template('Registration.html', title='Registration', message=[error, not_error])
 
 
 # Страница авторизации (Оптимизировано)
+# Пользователь и хэш пароля читаются одним запросом. Пароль проверяется в пуле хэширования,
+# после неудачных попыток email с этого адреса и сам адрес клиента временно блокируются (до проверки пароля).
+# Email со всех адресов блокируется только после большего числа попыток (перебор с разных адресов):
+# иначе несколько чужих неудачных попыток закрывали бы вход владельцу аккаунта
 @app.route('/', methods=['GET', 'POST'])
 def authorization():
     if current_user.is_authenticated:
         return redirect(url_for('homepage'))
     if request.method == 'POST':
-        error = {}
-
-        user = userInformation(request.form['email'].lower())
-        isValidUser(error, user[0][0])
-
-        if error:
-            error.clear()
-            sql = text("select email, password from 'Пользователь' where email=='{}'".format(request.form['email'].lower()))
-            info_user = [row for row in db.engine.execute(sql)]
-            email, password = info_user[0]
-        else:
+        email = request.form['email'].lower()
+        address = request.remote_addr
+
+        wait = max(login_throttle.blocked((email, address)),
+                   account_throttle.blocked(email),
+                   address_throttle.blocked(address))
+        if wait:
+            retry_after = str(int(wait) + 1)
+            return render_template('Authorization.html', title='Authorization',
+                                   message='Слишком много попыток входа, повторите через {} с'.format(retry_after)), \
+                429, {'Retry-After': retry_after}
+
+        user = db.engine.execute(queries.USER_CREDENTIALS, email=email).first()
+        # Для неизвестного email пароль тоже проверяется (с подставным хэшем), чтобы по времени
+        # ответа нельзя было узнать, есть ли такой пользователь
+        if not password_hasher.verify(user.password if user is not None else None, request.form['password']):
+            login_throttle.failed((email, address))
+            account_throttle.failed(email)
+            address_throttle.failed(address)
             return render_template('Authorization.html', title='Authorization', message='Ошибка ввода данных')
+        login_throttle.reset((email, address))
 
-        if check_password_hash(password, request.form['password']):
-            user = User.query.filter_by(email=request.form['email'].lower()).first()
-            login_user(user)
-            load_user(email)
-
-            return redirect(url_for('homepage'))
-        else:
-            return render_template('Authorization.html', title='Authorization', message='Ошибка ввода данных')
+        # Хэш, посчитанный с прежними параметрами, заменяется при входе.
+        # Если пул хэширования занят, хэш пересчитается при следующем входе
+        if password_hasher.outdated(user.password):
+            try:
+                db.engine.execute(queries.UPDATE_USER_PASSWORD,
+                                  user_id=user.id,
+                                  password=password_hasher.hash(request.form['password']))
+            except HasherBusy:
+                pass
+
+        identity = dict(user._mapping)
+        del identity['password']
+        login_user(rememberIdentity(identity))
+        return redirect(url_for('homepage'))
 
     return render_template('Authorization.html', title='Authorization')
 
 
-# Главная страница (Оптимизировано)
-@app.route('/HomePage', methods=['GET', 'POST'])
-@login_required
-def homepage():
-    user = current_user
-    chat_name = ''
+# Пул хэширования паролей занят: клиент повторяет вход или регистрацию позже
+@app.errorhandler(HasherBusy)
+def hasherBusy(error):
+    message = 'Сервер перегружен, повторите попытку позже'
+    if request.endpoint == 'registration':
+        page = render_template('Registration.html', title='Registration', message=[{'busy': message}, {}])
+    else:
+        page = render_template('Authorization.html', title='Authorization', message=message)
+    return page, 503, {'Retry-After': '1'}
+
+
+# region Кэш фрагментов страниц
+# Фрагмент из кэша или заново отрисованный. Ключ включает версии данных фрагмента
+def cachedFragment(key, versions, render):
+    key = fragmentKey(key, versions)
+    html = fragment_cache.get(key)
+    if html is None:
+        html = render()
+        fragment_cache.set(key, html)
+    return Markup(html)
+
+
+# Фрагмент для потоковой отрисовки: из кэша целиком или по частям из render().
+# Фрагмент сохраняется в кэш, только если он был выведен до конца и не длиннее
+# CACHE_MAX_FRAGMENT символов: части большого фрагмента не копятся в памяти
+def streamedFragment(key, versions, render):
+    key = fragmentKey(key, versions)
+    html = fragment_cache.get(key)
+    if html is not None:
+        return [Markup(html)]
+    return cachingChunks(key, render(), app.config['CACHE_MAX_FRAGMENT'])
+
+
+def cachingChunks(key, chunks, max_size):
+    parts, size = [], 0
+    for chunk in chunks:
+        if parts is not None:
+            parts.append(chunk)
+            size += len(chunk)
+            if size > max_size:
+                parts = None
+        yield chunk
+    if parts is not None:
+        fragment_cache.set(key, ''.join(parts))
+
+
+def fragmentKey(key, versions):
+    return '{}:v{}'.format(key, ':'.join(str(version) for version in fragment_cache.versions(versions)))
+
+
+# Шаблон по частям: части отдаются по мере вывода шаблона, страница целиком не собирается
+def generatingTemplate(template_name, **context):
+    app.update_template_context(context)
+    return (Markup(chunk) for chunk in app.jinja_env.get_template(template_name).generate(context))
+
+
+# Потоковый ответ из шаблона: части копятся до HOMEPAGE_STREAM_BUFFER символов
+# и отправляются, не дожидаясь конца отрисовки
+def streamingTemplate(template_name, **context):
+    chunks = generatingTemplate(template_name, **context)
+    buffer_size = app.config['HOMEPAGE_STREAM_BUFFER']
+
+    def generate():
+        buffer, buffered = [], 0
+        for chunk in chunks:
+            buffer.append(chunk)
+            buffered += len(chunk)
+            if buffered >= buffer_size:
+                yield ''.join(buffer)
+                buffer, buffered = [], 0
+        if buffer:
+            yield ''.join(buffer)
+
+    return Response(stream_with_context(generate()), mimetype='text/html')
+
+
+# События чата делают устаревшими окно чата и списки чатов его участников.
+# Прочтение меняет только список чатов прочитавшего (счетчик непрочитанных) и отметки в окне чата
+@bus.subscribe
+def invalidateFragments(chat_id, event_type, data):
+    if event_type == 'messages_read':
+        users = {data['user_id']}
+    else:
+        users = {row[0] for row in db.engine.execute(queries.CHAT_MEMBER_IDS, chat_id=chat_id)}
+        users.update(data.get('removed', ()))
+    fragment_cache.bump(['chat:{}'.format(chat_id)] + ['chats:{}'.format(user_id) for user_id in users])
 
-    selectedchat = request.args.get('selectedchat', type=int)
 
-    chat = gettingChats()
-    chat.extend(gettingGroupChats())
+# Аватар пользователя виден в его профиле, в его сообщениях и в списках чатов собеседников
+def userUpdated(user_id):
+    fragment_cache.bump(['profile:{}'.format(user_id)])
+    for chat_id in gettingUserChatIds(user_id):
+        bus.publish(chat_id, 'chat_updated', {'chat_id': chat_id})
+# endregion
 
-    all_user = userInformation(None)
 
-    if selectedchat is not None:
-        messages_chat = ''
-        chatparticipants = ''
-        chat_id = selectedchat
+# Окно выбранного чата: история, участники и профиль собеседника
+def renderingChatWindow(chat_id, before, stream=False):
+    # Сообщения и отметка о прочтении - только для участников чата
+    if not isChatMember(chat_id, current_user.id):
+        abort(404)
 
-        sql = text("select * "
-                   "from 'Чат' "
-                   "where chat_id == {}".format(chat_id))
-        selectedchat = db.engine.execute(sql).first()
+    selectedchat = db.engine.execute(queries.CHAT, chat_id=chat_id).first()
 
-        sql = text("select id, email "
-                   "from 'Пользователь' "
-                   "where id in (select user_id "
-                   "from 'Список Участников Чата' "
-                   "where chat_id == {} and user_id != '{}')".format(chat_id, current_user.id))
-        chatparticipants = [row for row in db.engine.execute(sql)]
+    chatparticipants = [row for row in db.engine.execute(queries.CHAT_PARTICIPANTS,
+                                                         chat_id=chat_id,
+                                                         user_id=current_user.id)]
 
-        sql = text("UPDATE 'Сообщение' "
-                   "set message_status = 1 "
-                   "where chat_id == {} and message_sender !='{}'".format(chat_id, current_user.id))
+    if stream:
+        messages_chat, has_more, bounds = streamingChatMessages(chat_id, before)
+    else:
+        messages_chat, has_more = receivingChatMessages(chat_id, before)
+        bounds = (messages_chat[0][0], messages_chat[-1][0]) if messages_chat else None
 
-        db.engine.execute(sql)
+    # Прочитанными считаются все показанные сообщения
+    if bounds:
+        readMessages(chat_id, bounds[1])
 
-        messages_chat = receivingChatMessages(chat_id)
+    read_up_to = gettingChatReadUpTo(chat_id, current_user.id)
 
+    # Собеседник есть только у личного чата. В групповом чате, где остался один создатель,
+    # и в личном чате без второго участника выводится название чата
+    chat_user_id = None
+    if selectedchat[2] != 'chat':
         chat_user_id = gettingChatParticipants(chat_id)
 
-        if selectedchat[2] == 'chat':
-            chat_name = (selectedchat[1],)
-        else:
-            chat_name = gettingChatNameById(chat_user_id[0])
-
+    if chat_user_id is None:
+        chat_name = (selectedchat[1],)
+        companion = None
+    else:
+        chat_name = gettingChatNameById(chat_user_id[0])
         companion = chatParticipantProfile(chat_user_id[0])
 
-        return render_template('HomePage.html',
-                               user=user,
-                               myChat=chat,
-                               name=chat_name,
-                               message=messages_chat,
-                               companion=companion,
-                               chat_id=chat_id,
-                               all_user=all_user,
-                               selectedchat=selectedchat,
-                               chatparticipants=chatparticipants)
-    else:
-        return render_template('HomePage.html',
-                               user=user,
-                               myChat=chat,
-                               name=chat_name,
-                               #message=messages_chat,
-                               all_user=all_user,
-                               #selectedchat=selectedchat,
-                               #chatparticipants=chatparticipants
-                               )
+    return (generatingTemplate if stream else render_template)('ChatWindow.html',
+                                                               user=current_user,
+                                                               name=chat_name,
+                                                               message=messages_chat,
+                                                               bounds=bounds,
+                                                               has_more=has_more,
+                                                               before=before,
+                                                               read_up_to=read_up_to,
+                                                               companion=companion,
+                                                               chat_id=chat_id,
+                                                               selectedchat=selectedchat,
+                                                               chatparticipants=chatparticipants)
+
+
+# Главная страница (Оптимизировано).
+# Профиль, список чатов и окно чата берутся из кэша, пока в них ничего не изменилось.
+# Чат, в котором пользователь не состоит, не открывается.
+# Окно чата из кэша уже было показано этому пользователю, поэтому прочтение не отмечается заново.
+# При HOMEPAGE_STREAMING страница отдается по частям: макет и список чатов уходят клиенту,
+# пока сообщения окна чата читаются из БД
+@app.route('/HomePage', methods=['GET', 'POST'])
+@login_required
+def homepage():
+    user = current_user
+
+    selectedchat = request.args.get('selectedchat', type=int)
+    before = request.args.get('before', type=int)
+
+    if selectedchat is not None and not isChatMember(selectedchat, user.id):
+        flash('Чат не найден', 'error')
+        return redirect(url_for('homepage'))
+
+    profile_modal = cachedFragment('profile:{}'.format(user.id), ['profile:{}'.format(user.id)],
+                                   lambda: render_template('ProfileModal.html', user=user))
+
+    chat_list = cachedFragment('chats:{}'.format(user.id), ['chats:{}'.format(user.id)],
+                               lambda: render_template('ChatList.html', myChat=gettingChats()))
+
+    streaming = app.config['HOMEPAGE_STREAMING']
+    chat_window = None
+    if selectedchat is not None:
+        key = 'chat:{}:{}:{}'.format(selectedchat, before, user.id)
+        if streaming:
+            chat_window = streamedFragment(key, ['chat:{}'.format(selectedchat)],
+                                           lambda: renderingChatWindow(selectedchat, before, stream=True))
+        else:
+            chat_window = [cachedFragment(key, ['chat:{}'.format(selectedchat)],
+                                          lambda: renderingChatWindow(selectedchat, before))]
+
+    return (streamingTemplate if streaming else render_template)('HomePage.html',
+                                                                 user=user,
+                                                                 profile_modal=profile_modal,
+                                                                 chat_list=chat_list,
+                                                                 chat_window=chat_window,
+                                                                 last_event_id=bus.last_id)
 
 
 # Обработчик удаления аватара пользователя (Оптимизировано)
 @app.route('/removeavatar', methods=['POST', 'GET'])
 @login_required
 def removeavatar():
-    result = current_user.RemoveAvatar()
+    result = User.query.get(current_user.id).RemoveAvatar()
+    forgetIdentity()
+    userUpdated(current_user.id)
     if not result:
         flash('Ошибка удаления аватара', 'error')
     flash('Аватар успешно удален', 'success')
@@ -496,24 +1033,87 @@ def removechatavatar():
     chatfield = request.args.get('chatfield')
     chat = Chat.query.filter_by(chat_id=chatfield).first()
     result = chat.RemoveAvatar()
+    bus.publish(chat.chat_id, 'chat_updated', {'chat_id': chat.chat_id})
     if not result:
         flash('Ошибка удаления аватара', 'error')
     flash('Аватар успешно удален', 'success')
     return redirect(url_for('homepage', selectedchat=chat.chat_id))
 
 
+# Ссылка на статический ресурс: файл сборки с хэшем в имени, а без сборки -
+# CDN для внешних ресурсов и каталог static для собственных
+@app.template_global()
+def assetUrl(name):
+    built = assets.built(name)
+    if built:
+        return url_for('asset', filename=built)
+    return assets.external(name) or url_for('static', filename=name)
+
+
+# Хэш SRI для атрибута integrity, пустая строка - проверка не нужна
+@app.template_global()
+def assetIntegrity(name):
+    return assets.integrity(name)
+
+
+# Отдаем файл сборки (Оптимизировано). Имя меняется вместе с содержимым, поэтому файл
+# кэшируется навсегда; сжатая копия выбирается по Accept-Encoding клиента
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    if safe_join(app.config['ASSETS_BUILD_PATH'], filename) is None:
+        abort(404)
+    path, encoding = assets.negotiate(filename, request.accept_encodings)
+    response = send_from_directory(app.config['ASSETS_BUILD_PATH'], path,
+                                   mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream',
+                                   max_age=app.config['ASSETS_CACHE_MAX_AGE'])
+    if encoding:
+        response.content_encoding = encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.set_etag(path)
+    return response.make_conditional(request)
+
+
+# Ссылка на аватар: хэш содержимого в адресе служит версией,
+# аватар по умолчанию отдается как статический ресурс
+@app.template_global()
+def avatarUrl(avatar_hash, default='images/Avatar.png', size=None):
+    if avatar_hash:
+        return url_for('avatar', avatar_hash=avatar_hash, size=size)
+    return assetUrl(default)
+
+
+# Отдаем аватар нужного размера из хранилища по хэшу (Оптимизировано).
+# Содержимое по адресу неизменно, поэтому условный запрос получает 304 без обращения к БД
+@app.route('/avatar/<avatar_hash>', defaults={'size': None})
+@app.route('/avatar/<avatar_hash>/<int:size>')
+def avatar(avatar_hash, size):
+    if not AVATAR_HASH.fullmatch(avatar_hash) or (size is not None and size not in app.config['AVATAR_SIZES']):
+        abort(404)
+
+    etag = avatar_hash if size is None else '{}-{}'.format(avatar_hash, size)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        if not avatar_store.exists(avatar_hash):
+            abort(404)
+        path = avatar_store.path(avatar_hash) if size is None else avatar_store.variant(avatar_hash, size)
+        response = send_file(path, mimetype='image/png', conditional=False,
+                             max_age=app.config['AVATAR_CACHE_MAX_AGE'])
+
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config['AVATAR_CACHE_MAX_AGE']
+    response.cache_control.immutable = True
+    return response
+
+
 # Обработчик получения аватара пользователя (Оптимизировано)
 @app.route('/useravatar')
 @login_required
 def useravatar():
-    user = current_user
-    img = user.GetAvatar(app)
-    if not img:
-        return ""
-
-    h = make_response(img)
-    h.headers['Content-Type'] = '/Image/png'
-    return h
+    return redirect(avatarUrl(current_user.photo_hash))
 
 
 # Обработчик загрузки аватара пользователя (Оптимизировано)
@@ -522,14 +1122,18 @@ def useravatar():
 def upload():
     if request.method == 'POST':
         file = request.files.get('file')
-        if file and current_user.VerifyExt(file.filename):
+        user = User.query.get(current_user.id)
+        if file and user.VerifyExt(file.filename):
             try:
-                img = file.read()
-                result = current_user.UpdateAvatar(img)
+                img = avatar_store.read(file.stream)
+                result = user.UpdateAvatar(img)
+                forgetIdentity()
+                userUpdated(current_user.id)
                 if not result:
                     flash('Ошибка обновления аватара', 'error')
-                flash('Аватар успешно обновлен', 'success')
-            except FileNotFoundError:
+                else:
+                    flash('Аватар успешно обновлен', 'success')
+            except (FileNotFoundError, AvatarError):
                 flash('Ошибка обновления аватара', 'error')
                 return redirect(url_for('homepage'))
         return redirect(url_for('homepage'))
@@ -548,12 +1152,14 @@ def chatupload():
         file = request.files.get('file_chat')
         if file and chat.VerifyExt(file.filename):
             try:
-                img = file.read()
+                img = avatar_store.read(file.stream)
                 result = chat.UpdateAvatar(img)
+                bus.publish(chat.chat_id, 'chat_updated', {'chat_id': chat.chat_id})
                 if not result:
                     flash('Ошибка обновления аватара', 'error')
-                flash('Аватар успешно обновлен', 'success')
-            except FileNotFoundError:
+                else:
+                    flash('Аватар успешно обновлен', 'success')
+            except (FileNotFoundError, AvatarError):
                 flash('Ошибка обновления аватара', 'error')
                 return redirect(url_for('homepage', selectedchat=chat.chat_id))
         return redirect(url_for('homepage', selectedchat=chat.chat_id))
@@ -566,15 +1172,11 @@ def chatupload():
 @login_required
 def getuseravatar():
     userfield = request.args.get('userfield')
-    user = User.query.filter_by(id=userfield).first()
-
-    img = user.GetAvatar(app)
-    if not img:
-        return ""
+    user = db.engine.execute(queries.USER_PHOTO_HASH, user_id=userfield).first()
+    if user is None:
+        abort(404)
 
-    h = make_response(img)
-    h.headers['Content-Type'] = '/Image/png'
-    return h
+    return redirect(avatarUrl(user[0]))
 
 
 # Получаем аватар чата (Оптимизировано)
@@ -582,45 +1184,191 @@ def getuseravatar():
 @login_required
 def getchatavatar():
     chatfield = request.args.get('chatfield')
-    chat = Chat.query.filter_by(chat_id=chatfield).first()
-
-    img = chat.GetAvatar(app)
-    if not img:
-        return ""
-
-    h = make_response(img)
-    h.headers['Content-Type'] = '/Image/png'
-    return h
+    chat = db.engine.execute(queries.CHAT_PHOTO_HASH, chat_id=chatfield).first()
+    if chat is None:
+        abort(404)
+
+    return redirect(avatarUrl(chat[0], 'images/ChatAvatar.png'))
+
+
+# Клиент ожидает JSON вместо перерисовки страницы
+def wantsJson():
+    return request.accept_mimetypes.best == 'application/json'
+
+
+# Удаляем сообщение (строку OWN_MESSAGE) вместе с его записью в поиске и оповещаем участников чата
+def deletingMessage(message_id, message):
+    with writing() as connection:
+        if message_search:
+            connection.execute(queries.SEARCH_INDEX_DELETE, message_id=message_id, message_content=message[1], chat_id=message[0])
+        connection.execute(queries.DELETE_MESSAGE, message_id=message_id)
+        rewindingChatSummary(connection, message[0], message_id)
+
+    deleted = {'message_id': message_id, 'chat_id': message[0]}
+    bus.publish(message[0], 'message_deleted', deleted)
+    return deleted
+
+
+# Если удалено последнее сообщение чата, сводка переходит к предыдущему: из основной таблицы,
+# а когда сообщения чата остались только в архиве - к последнему из архива
+def rewindingChatSummary(connection, chat_id, message_id):
+    if connection.execute(queries.REWIND_CHAT_SUMMARY, chat_id=chat_id, message_id=message_id).rowcount:
+        return
+    if connection.execute(queries.CHAT_LAST_MESSAGE_ID, chat_id=chat_id).scalar() != message_id:
+        return
+
+    previous = message_archive.messages(chat_id, message_id, 1)
+    previous = previous[0] if previous else dict.fromkeys(MessageArchive.FIELDS)
+    connection.execute(queries.REWIND_CHAT_SUMMARY_TO,
+                       chat_id=chat_id,
+                       deleted_id=message_id,
+                       message_id=previous['message_id'],
+                       message_content=previous['message_content'],
+                       message_date_sent=previous['message_date_sent'],
+                       message_sender=previous['message_sender'])
+
+
+# Удаляем сообщение текущего пользователя из основной таблицы или из архива.
+# Возвращает None, если у пользователя нет такого сообщения
+def deletingOwnMessage(message_id):
+    message = db.engine.execute(queries.OWN_MESSAGE, message_id=message_id, user_id=current_user.id).first()
+    if message is not None:
+        return deletingMessage(message_id, message)
+
+    message = message_archive.delete(message_id, current_user.id)
+    if message is None:
+        return None
+    with writing() as connection:
+        rewindingChatSummary(connection, message['chat_id'], message_id)
+    deleted = {'message_id': message_id, 'chat_id': message['chat_id']}
+    bus.publish(message['chat_id'], 'message_deleted', deleted)
+    return deleted
 
 
 # Удаление сообщения из чата (Оптимизировано)
 @app.route('/deletemessage', methods=['POST', 'GET'])
 @login_required
 def deletemessage():
-    messageid = request.form['submit']
+    messageid = request.form.get('submit', type=int)
     selectedchat = request.args.get('chat_id')
+
     try:
-        sql = text('delete from Сообщение '
-                   ' where message_id == ' + str(messageid))
-        db.engine.execute(sql)
+        deleted = deletingOwnMessage(messageid)
     except:
+        if wantsJson():
+            return jsonify(error='Ошибка удаления сообщения'), 500
+        flash('Ошибка удаления сообщения')
+        return redirect(url_for('homepage', selectedchat=selectedchat))
+
+    if deleted is None:
+        if wantsJson():
+            return jsonify(error='Сообщение не найдено'), 404
         flash('Ошибка удаления сообщения')
+        return redirect(url_for('homepage', selectedchat=selectedchat))
 
+    if wantsJson():
+        return jsonify(deleted)
     return redirect(url_for('homepage', selectedchat=selectedchat))
 
 
+# Записываем пачку сообщений одной транзакцией: сообщения, записи в поиске, сводки чатов
+# и границы прочтения отправителей (свои сообщения отправитель уже прочитал).
+# Сводка и граница обновляются один раз - по последнему сообщению пачки. Возвращает id сообщений
+def writingMessages(rows):
+    message_ids = []
+    latest = {}
+    with writing() as connection:
+        for row in rows:
+            message_id = connection.execute(queries.INSERT_MESSAGE, row).scalar()
+            message_ids.append(message_id)
+            latest[(row['chat_id'], row['message_sender'])] = dict(row, message_id=message_id)
+            if message_search:
+                connection.execute(queries.SEARCH_INDEX_INSERT,
+                                   message_id=message_id, message_content=row['message_content'], chat_id=row['chat_id'])
+
+        summaries = {}
+        for row in latest.values():
+            connection.execute(queries.MARK_CHAT_READ,
+                               chat_id=row['chat_id'], user_id=row['message_sender'], message_id=row['message_id'])
+            summaries[row['chat_id']] = max(summaries.get(row['chat_id'], row), row, key=lambda found: found['message_id'])
+        for row in summaries.values():
+            connection.execute(queries.UPSERT_CHAT_SUMMARY, row)
+    return message_ids
+
+
+# Групповая запись сообщений (MESSAGE_INGEST): отправки из разных запросов
+# записываются общими транзакциями фоновым потоком
+message_writer = None
+if app.config['MESSAGE_INGEST']:
+    message_writer = MessageWriter(writingMessages,
+                                   app.config['INGEST_QUEUE_SIZE'],
+                                   app.config['INGEST_BATCH_SIZE'],
+                                   app.config['INGEST_MAX_DELAY'])
+    atexit.register(message_writer.close)
+
+
+# Записываем сообщение и оповещаем участников чата. При групповой записи ждем фиксации
+# пачки, поэтому полученный id уже сохранен в БД
+def sendingMessage(chat_id, message_content):
+    message_date_sent = str(datetime.utcnow())
+    row = {'chat_id': chat_id,
+           'message_sender': current_user.id,
+           'message_content': message_content,
+           'message_date_sent': message_date_sent}
+    if message_writer is not None:
+        message_id = message_writer.submit(row).result(app.config['INGEST_TIMEOUT'])
+    else:
+        message_id = writingMessages([row])[0]
+
+    message = {'message_id': message_id,
+               'chat_id': chat_id,
+               'message_sender': current_user.id,
+               'name': current_user.name,
+               'message_content': message_content,
+               'message_date_sent': message_date_sent,
+               'avatar': avatarUrl(current_user.photo_hash, size=30)}
+    bus.publish(chat_id, 'message_created', message)
+    return message
+
+
+# Очередь групповой записи заполнена: клиент повторяет отправку позже
+@app.errorhandler(IngestQueueFull)
+def ingestQueueFull(error):
+    if wantsJson() or request.path.startswith('/api/'):
+        response = jsonify(error='Сервер перегружен, повторите отправку позже')
+        response.status_code = 503
+    else:
+        flash('Сервер перегружен, повторите отправку позже')
+        response = redirect(url_for('homepage', selectedchat=request.args.get('chat_id', type=int)))
+    response.headers['Retry-After'] = '1'
+    return response
+
+
 # Отправка сообщения в чат (Оптимизировано)
+# Для запросов с Accept: application/json возвращает только созданное сообщение
 @app.route('/sendmessage', methods=['POST'])
 @login_required
 def sendmessage():
-    chat_id = request.args.get('chat_id')
+    chat_id = request.args.get('chat_id', type=int)
     message_content = request.form.get('MessageText')
 
-    sql = text("insert into 'Сообщение' ('chat_id', 'message_sender', 'message_content', 'message_date_sent', 'message_status') "
-               "values ({}, {}, '{}', '{}', '0') ".format(chat_id, current_user.id, message_content, datetime.utcnow()))
+    if chat_id is None:
+        if wantsJson():
+            return jsonify(error='Не указан чат'), 400
+        return redirect(url_for('homepage'))
+    if not isChatMember(chat_id, current_user.id):
+        if wantsJson():
+            return jsonify(error='Нет доступа к чату'), 403
+        return redirect(url_for('homepage'))
+    if not message_content:
+        if wantsJson():
+            return jsonify(error='Пустое сообщение'), 400
+        return redirect(url_for('homepage', selectedchat=chat_id))
 
-    db.engine.execute(sql)
+    message = sendingMessage(chat_id, message_content)
 
+    if wantsJson():
+        return jsonify(message), 201
     return redirect(url_for('homepage', selectedchat=chat_id))
     # chat = gettingChats()
     #
@@ -653,42 +1401,449 @@ def sendmessage():
     #                        chatparticipants=chatparticipants)
 
 
+# Справочник пользователей для выбора участников чатов (Оптимизировано)
+@app.route('/users')
+@login_required
+def users():
+    query = request.args.get('q', '').strip()
+    after = request.args.get('after', 0, type=int)
+    limit = app.config['USER_DIRECTORY_PAGE_SIZE']
+
+    found = searchingUsers(query, after, limit + 1)
+    page = found[:limit]
+    return jsonify(users=[{'id': user.id,
+                           'email': user.email,
+                           'name': user.name,
+                           'login': user.login,
+                           'avatar': avatarUrl(user.photo_hash, size=55)} for user in page],
+                   next=page[-1].id if len(found) > limit else None)
+
+
+# Поиск по истории сообщений (Оптимизировано).
+# Каждая находка ведет на страницу истории, которая заканчивается найденным сообщением
+@app.route('/searchmessages')
+@login_required
+def searchmessages():
+    query = searchExpression(request.args.get('q', ''))
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = app.config['MESSAGE_SEARCH_PAGE_SIZE']
+
+    if not message_search:
+        return jsonify(error='Поиск сообщений доступен только для SQLite'), 501
+    if query is None:
+        return jsonify(results=[], next=None)
+
+    found = searchingMessages(query, offset, limit + 1)
+    page = found[:limit]
+    return jsonify(results=[{'message_id': row.message_id,
+                             'chat_id': row.chat_id,
+                             'chat_name': row.chat_name,
+                             'avatar': avatarUrl(row.photo_hash,
+                                                 'images/ChatAvatar.png' if row.chat_description == 'chat' else 'images/Avatar.png',
+                                                 size=55),
+                             'snippet': row.snippet,
+                             'message_date_sent': str(row.message_date_sent),
+                             'url': url_for('homepage', selectedchat=row.chat_id, before=row.message_id + 1,
+                                            _anchor='message-{}'.format(row.message_id))} for row in page],
+                   next=offset + limit if len(found) > limit else None)
+
+
+# Открытие личного чата с пользователем (Оптимизировано)
+@app.route('/directchat')
+@login_required
+def directchat():
+    userfield = request.args.get('userfield', type=int)
+    if userfield is None or userfield == current_user.id:
+        return redirect(url_for('homepage'))
+
+    chat_id = gettingDirectChat(current_user.id, userfield)
+    if chat_id is None:
+        return redirect(url_for('homepage'))
+
+    return redirect(url_for('homepage', selectedchat=chat_id))
+
+
+# Отмечаем сообщения чата прочитанными до message_id и оповещаем собеседников
+def readMessages(chat_id, message_id):
+    # Граница не может уйти дальше последнего сообщения чата, иначе будущие сообщения
+    # сразу окажутся прочитанными
+    last_message_id = db.engine.execute(queries.CHAT_LAST_MESSAGE_ID, chat_id=chat_id).scalar()
+    if last_message_id is None:
+        return None
+    message_id = min(message_id, last_message_id)
+    if markingChatRead(chat_id, current_user.id, message_id):
+        bus.publish(chat_id, 'messages_read', {'chat_id': chat_id,
+                                               'user_id': current_user.id,
+                                               'last_read_message_id': message_id})
+    return message_id
+
+
+# Отметка о прочтении сообщений, полученных без перезагрузки страницы
+@app.route('/readmessages', methods=['POST'])
+@login_required
+def readmessages():
+    chat_id = request.args.get('chat_id', type=int)
+    message_id = request.form.get('message_id', type=int)
+    if chat_id is None or message_id is None:
+        return jsonify(error='Не указан чат или сообщение'), 400
+    if not isChatMember(chat_id, current_user.id):
+        return jsonify(error='Нет доступа к чату'), 403
+
+    message_id = readMessages(chat_id, message_id)
+    return jsonify(chat_id=chat_id, last_read_message_id=message_id)
+
+
+# region JSON API
+# Данные для клиента без перерисовки страницы. Списки отдаются с ETag по версии данных
+# из кэша фрагментов: пока версия не изменилась, клиент получает 304 без запросов к БД
+
+def messageJson(row):
+    return {'message_id': row.message_id,
+            'chat_id': row.chat_id,
+            'message_sender': row.message_sender,
+            'name': row.name,
+            'message_content': row.message_content,
+            'message_date_sent': str(row.message_date_sent),
+            'avatar': avatarUrl(row.photo_hash, size=30)}
+
+
+# ETag по версии данных. parts - от чего еще зависит ответ (пользователь, страница).
+# Возвращает тег и ответ 304, если у клиента эта версия
+def versionTag(name, *parts):
+    etag = '-'.join(str(part) for part in (fragment_cache.generation, fragment_cache.versions([name])[0]) + parts)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return etag, response
+    return etag, None
+
+
+def taggedJson(etag, **data):
+    response = jsonify(**data)
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def isChatMember(chat_id, user_id):
+    return db.engine.execute(queries.CHAT_MEMBER, chat_id=chat_id, user_id=user_id).first() is not None
+
+
+# Чаты пользователя со сводками (Оптимизировано)
+@app.route('/api/chats')
+@login_required
+def apiChats():
+    etag, not_modified = versionTag('chats:{}'.format(current_user.id))
+    if not_modified is not None:
+        return not_modified
+
+    return taggedJson(etag, chats=[{'chat_id': row.chat_id,
+                                    'chat_name': row.chat_name,
+                                    'chat_description': row.chat_description,
+                                    'companion_id': row.companion_id,
+                                    'avatar': avatarUrl(row.photo_hash,
+                                                        'images/ChatAvatar.png' if row.chat_description == 'chat' else 'images/Avatar.png',
+                                                        size=55),
+                                    'last_message_id': row.last_message_id,
+                                    'last_message_sender': row.last_message_sender,
+                                    'last_message_content': row.last_message_content,
+                                    'last_message_date_sent': None if row.last_message_date_sent is None else str(row.last_message_date_sent),
+                                    'unread_count': row.unread_count} for row in gettingChats()])
+
+
+# Сообщения чата (Оптимизировано): since - только новые после since по возрастанию,
+# before - страница истории перед before, без параметров - последняя страница.
+# Удаления приходят событиями message_deleted
+@app.route('/api/chats/<int:chat_id>/messages')
+@login_required
+def apiMessages(chat_id):
+    if not isChatMember(chat_id, current_user.id):
+        return jsonify(error='Чат не найден'), 404
+
+    since = request.args.get('since', type=int)
+    before = request.args.get('before', type=int)
+    # Страницы и дозагрузки одного чата различаются тегом, а read_up_to зависит от пользователя
+    if since is not None:
+        page = 'since{}'.format(since)
+    elif before is not None:
+        page = 'before{}'.format(before)
+    else:
+        page = 'latest'
+    etag, not_modified = versionTag('chat:{}'.format(chat_id), page, current_user.id)
+    if not_modified is not None:
+        return not_modified
+
+    limit = app.config['MESSAGES_PAGE_SIZE']
+    if since is not None:
+        messages = [row for row in db.engine.execute(queries.CHAT_MESSAGES_SINCE, chat_id=chat_id, since=since, limit=limit + 1)]
+        has_more = len(messages) > limit
+        messages = messages[:limit]
+    else:
+        messages, has_more = receivingChatMessages(chat_id, before, limit)
+
+    return taggedJson(etag,
+                      chat_id=chat_id,
+                      messages=[messageJson(row) for row in messages],
+                      has_more=has_more,
+                      read_up_to=gettingChatReadUpTo(chat_id, current_user.id))
+
+
+# Отправка сообщения: {"message_content": "..."}
+@app.route('/api/chats/<int:chat_id>/messages', methods=['POST'])
+@login_required
+def apiSendMessage(chat_id):
+    data = request.get_json(silent=True) or {}
+    message_content = data.get('message_content')
+    if not isinstance(message_content, str) or not message_content:
+        return jsonify(error='Пустое сообщение'), 400
+    if not isChatMember(chat_id, current_user.id):
+        return jsonify(error='Чат не найден'), 404
+
+    return jsonify(sendingMessage(chat_id, message_content)), 201
+
+
+@app.route('/api/messages/<int:message_id>', methods=['DELETE'])
+@login_required
+def apiDeleteMessage(message_id):
+    deleted = deletingOwnMessage(message_id)
+    if deleted is None:
+        return jsonify(error='Сообщение не найдено'), 404
+    return jsonify(deleted)
+
+
+# Отметка о прочтении: {"message_id": ...}
+@app.route('/api/chats/<int:chat_id>/read', methods=['POST'])
+@login_required
+def apiReadMessages(chat_id):
+    data = request.get_json(silent=True) or {}
+    message_id = data.get('message_id')
+    if not isinstance(message_id, int):
+        return jsonify(error='Не указано сообщение'), 400
+    if not isChatMember(chat_id, current_user.id):
+        return jsonify(error='Чат не найден'), 404
+
+    message_id = readMessages(chat_id, message_id)
+    return jsonify(chat_id=chat_id, last_read_message_id=message_id)
+# endregion
+
+
+# region События чатов
+# Поток событий чатов пользователя (Server-Sent Events)
+@app.route('/events')
+@login_required
+def events():
+    user_id = current_user.id
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    if last_id is None:
+        last_id = request.args.get('last_id', bus.last_id, type=int)
+
+    def stream():
+        cursor = last_id
+        while True:
+            # Список чатов перечитываем, чтобы получать события новых чатов
+            chat_ids = gettingUserChatIds(user_id)
+            found, cursor = bus.wait(cursor, chat_ids, app.config['EVENTS_HEARTBEAT'])
+            if not found:
+                yield ': heartbeat\n\n'
+            for event_id, chat_id, event_type, data in found:
+                yield 'id: {}\nevent: {}\ndata: {}\n\n'.format(event_id, event_type, json.dumps(data))
+
+    return Response(stream_with_context(stream()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# Long-poll для клиентов без поддержки Server-Sent Events
+@app.route('/poll')
+@login_required
+def poll():
+    last_id = request.args.get('last_id', type=int)
+    if last_id is None:
+        return jsonify(last_id=bus.last_id, events=[])
+
+    found, cursor = bus.wait(last_id, gettingUserChatIds(current_user.id), app.config['EVENTS_POLL_TIMEOUT'])
+    return jsonify(last_id=cursor,
+                   events=[{'id': event_id, 'type': event_type, 'data': data}
+                           for event_id, chat_id, event_type, data in found])
+# endregion
+
+
 # Создание нового группового чата (Оптимизировано)
 @app.route('/creatingchat', methods=['POST'])
 @login_required
 def creatingChat():
 
-    chat_name = request.form['ChatNameCreate']
-    # Люди в чате
-    group = [current_user.id]
-
-    for number, row in enumerate(request.form.items()):
-        if number != 0:
-            group.append(row[0])
+    chat_name = request.form.get('ChatNameCreate')
 
     if chat_name is not None:
 
-        sql = text("INSERT INTO 'Чат' (chat_name, chat_description, chat_creator) "
-                   "VALUES ('{}','{}','{}')".format(chat_name, 'chat', current_user.id))
-        db.engine.execute(sql)
+        # Чат и все участники записываются одной транзакцией
+        with writing() as connection:
+            chat_id = connection.execute(queries.INSERT_CHAT,
+                                         chat_name=chat_name, chat_description='chat', chat_creator=current_user.id).scalar()
 
-        sql = text("select * "
-                   "from 'Чат' "
-                   "where chat_creator == '{}'"
-                   "order by chat_id desc "
-                   "limit 1".format(current_user.id))
+            added = addingChatMembers(connection, chat_id, formUserIds(connection, request.form) | {current_user.id})
 
-        new_group_chat = db.engine.execute(sql).first()
+        bus.publish(chat_id, 'members_changed', {'chat_id': chat_id, 'added': added, 'removed': []})
+        return redirect(url_for('homepage', selectedchat=chat_id))
 
-        # Проходимся по каждому человеку
-        for people in group:
-            sql = text("INSERT INTO 'Список Участников Чата' (chat_id, user_id) "
-                       "VALUES ({},'{}')".format(new_group_chat[0], people))
-            db.engine.execute(sql)
+    return redirect(url_for('homepage'))
 
-        return redirect(url_for('homepage', selectedchat=new_group_chat[0]))
 
-    return redirect(url_for('homepage'))
+# Групповой чат, которым управляет пользователь (создатель чата)
+def managedChat(connection, chat_id):
+    chat = connection.execute(queries.CHAT, chat_id=chat_id).first()
+    if chat is None or chat.chat_description != 'chat' or chat.chat_creator != current_user.id:
+        return None
+    return chat
+
+
+# Добавление участников в групповой чат (Оптимизировано)
+@app.route('/addchatmembers', methods=['POST'])
+@login_required
+def addchatmembers():
+    chat_id = request.args.get('chat_id', type=int)
+
+    with writing() as connection:
+        chat = managedChat(connection, chat_id)
+        if chat is not None:
+            added = addingChatMembers(connection, chat_id, formUserIds(connection, request.form))
+
+    if chat is None:
+        if wantsJson():
+            return jsonify(error='Чат не найден'), 404
+        flash('Ошибка добавления участников')
+        return redirect(url_for('homepage'))
+
+    bus.publish(chat_id, 'members_changed', {'chat_id': chat_id, 'added': added, 'removed': []})
+    if wantsJson():
+        return jsonify(chat_id=chat_id, added=added)
+    return redirect(url_for('homepage', selectedchat=chat_id))
+
+
+# Удаление участников из группового чата (Оптимизировано).
+# Создатель чата остается в нем
+@app.route('/removechatmembers', methods=['POST'])
+@login_required
+def removechatmembers():
+    chat_id = request.args.get('chat_id', type=int)
+
+    with writing() as connection:
+        chat = managedChat(connection, chat_id)
+        if chat is not None:
+            removed = removingChatMembers(connection, chat_id, formUserIds(connection, request.form) - {chat.chat_creator})
+
+    if chat is None:
+        if wantsJson():
+            return jsonify(error='Чат не найден'), 404
+        flash('Ошибка удаления участников')
+        return redirect(url_for('homepage'))
+
+    bus.publish(chat_id, 'members_changed', {'chat_id': chat_id, 'added': [], 'removed': removed})
+    if wantsJson():
+        return jsonify(chat_id=chat_id, removed=removed)
+    return redirect(url_for('homepage', selectedchat=chat_id))
+
+
+# region Команды
+# Одноразовая миграция: удаляем личные чаты, созданные при регистрации и ни разу
+# не использованные, а оставшиеся регистрируем в таблице личных чатов
+@app.cli.command('drop-unused-friend-chats')
+def dropUnusedFriendChats():
+    unused = ("select chat_id "
+              "from \"Чат\" c "
+              "where chat_description = 'friend' "
+              "and chat_id not in (select chat_id from \"Личный Чат\") "
+              "and not exists (select 1 from \"Сообщение\" m where m.chat_id = c.chat_id)")
+
+    with writing() as connection:
+        connection.execute(text("delete from \"Список Участников Чата\" "
+                                "where chat_id in ({})".format(unused)))
+        dropped = connection.execute(text("delete from \"Чат\" "
+                                          "where chat_id in ({})".format(unused))).rowcount
+        registered = connection.execute(text("insert into \"Личный Чат\" (chat_id, user_a, user_b) "
+                                             "select chat_id, min(cast(user_id as integer)), max(cast(user_id as integer)) "
+                                             "from \"Список Участников Чата\" "
+                                             "where chat_id in (select chat_id from \"Чат\" where chat_description = 'friend') "
+                                             "and chat_id not in (select chat_id from \"Личный Чат\") "
+                                             "group by chat_id "
+                                             "having count(distinct user_id) = 2 "
+                                             "on conflict do nothing")).rowcount
+
+    print(f'Удалено неиспользуемых личных чатов: {dropped}, зарегистрировано личных чатов: {registered}')
+
+
+# Перенос аватаров из БД в хранилище на диске
+@app.cli.command('export-avatars')
+def exportAvatarsCommand():
+    print(f'Перенесено аватаров: {exportAvatars()}')
+
+
+# Сборка статических ресурсов (ASSETS_BUILD_PATH). Новые имена подхватываются
+# после перезапуска приложения
+@app.cli.command('build-assets')
+@click.option('--offline', is_flag=True, help='не скачивать внешние ресурсы, собрать то, что есть')
+def buildAssetsCommand(offline):
+    if not offline:
+        try:
+            for name in downloadVendor(app.config['ASSETS_VENDOR_PATH']):
+                print(f'Скачан {name}')
+        except (OSError, AssetError) as e:
+            raise click.ClickException(f'Ошибка загрузки внешних ресурсов: {e}. '
+                                       f'Без них соберите с --offline: шаблоны подключат их с CDN')
+    manifest = buildAssets([app.config['ASSETS_VENDOR_PATH'], app.static_folder], app.config['ASSETS_BUILD_PATH'])
+    print(f'Собрано ресурсов: {len(manifest)}')
+
+
+# Пересборка полнотекстового индекса сообщений
+@app.cli.command('rebuild-search-index')
+def rebuildSearchIndexCommand():
+    rebuildSearchIndex()
+    print('Индекс поиска сообщений пересобран')
+
+
+# Перенос старых сообщений в архив (ARCHIVE_PATH) и возврат освободившегося места.
+# Рассчитана на запуск по расписанию, например раз в сутки из cron
+@app.cli.command('archive-messages')
+@click.option('--days', type=int, help='возраст сообщений в днях, по умолчанию ARCHIVE_AFTER_DAYS')
+def archiveMessagesCommand(days):
+    if days is None:
+        days = app.config['ARCHIVE_AFTER_DAYS']
+    archived = archivingMessages(datetime.utcnow() - timedelta(days=days),
+                                 app.config['ARCHIVE_BATCH_SIZE'],
+                                 app.config['ARCHIVE_BLOCK_SIZE'])
+    print(f'Перенесено в архив сообщений: {archived}')
+    print(f'Освобождено страниц БД: {reclaimingSpace(app.config["VACUUM_STEP_PAGES"])}')
+
+
+# Возврат свободного места в файле SQLite. Если БД создана без auto_vacuum = incremental,
+# режим включается полным VACUUM (один раз, БД блокируется на все время)
+@app.cli.command('incremental-vacuum')
+def incrementalVacuumCommand():
+    if db.engine.dialect.name != 'sqlite':
+        print('Команда нужна только для SQLite')
+        return
+
+    connection = db.engine.raw_connection()
+    try:
+        if connection.execute('pragma auto_vacuum').fetchone()[0] != 2:
+            connection.execute('pragma auto_vacuum = incremental')
+            connection.execute('vacuum')
+            print('Включен режим auto_vacuum = incremental')
+    finally:
+        connection.close()
+    print(f'Освобождено страниц БД: {reclaimingSpace(app.config["VACUUM_STEP_PAGES"])}')
+
+
+# Пересчет сводок чатов для существующих БД
+@app.cli.command('rebuild-chat-summaries')
+def rebuildChatSummariesCommand():
+    rebuildChatSummaries()
+    print('Сводки чатов пересчитаны')
+# endregion
 
 
 # Страница ошибки 404 (Оптимизировано)
@@ -697,6 +1852,13 @@ def pageNotFound(error):
     return render_template('Page404.html'), 404
 
 
+# Загружаемый файл превышает MAX_CONTENT_LENGTH
+@app.errorhandler(413)
+def requestTooLarge(error):
+    flash('Файл слишком большой', 'error')
+    return redirect(url_for('homepage'))
+
+
 # Страница ошибки 401 (Оптимизировано)
 @app.errorhandler(401)
 def pageNotFound(error):
@@ -0,0 +1,100 @@
+import json
+import os
+import sqlite3
+import threading
+import zlib
+
+
+# Архив старых сообщений в отдельном файле SQLite. Сообщения одного чата хранятся
+# сжатыми блоками (JSON + zlib) с диапазоном message_id, поэтому страница истории
+# читается из одного-двух блоков. Имя и аватар отправителя в архив не попадают:
+# они берутся из БД приложения при чтении, как и для сообщений из основной таблицы
+class MessageArchive(object):
+    FIELDS = ('message_id', 'chat_id', 'message_sender', 'message_content', 'message_date_sent', 'message_status')
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+    # Соединение для текущего потока. Пока архива нет, файл не создается (create=False)
+    def connection(self, create=False):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            if not create and not os.path.exists(self.path):
+                return None
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('pragma journal_mode = WAL')
+            connection.executescript("create table if not exists blocks "
+                                     "(block_id integer primary key, chat_id integer not null, "
+                                     "first_message_id integer not null, last_message_id integer not null, "
+                                     "message_count integer not null, data blob not null);"
+                                     "create index if not exists ix_blocks_chat on blocks (chat_id, last_message_id);")
+            self.local.connection = connection
+        return connection
+
+    @staticmethod
+    def pack(messages):
+        return zlib.compress(json.dumps(messages, ensure_ascii=False, default=str).encode('utf-8'), 9)
+
+    @staticmethod
+    def unpack(data):
+        return json.loads(zlib.decompress(data).decode('utf-8'))
+
+    # Записываем сообщения одного чата блоками по block_size (сообщения - словари FIELDS)
+    def write(self, chat_id, messages, block_size):
+        messages = sorted(messages, key=lambda message: message['message_id'])
+        blocks = [messages[start:start + block_size] for start in range(0, len(messages), block_size)]
+        connection = self.connection(create=True)
+        with connection:
+            connection.execute('begin immediate')
+            connection.executemany("insert into blocks (chat_id, first_message_id, last_message_id, message_count, data) "
+                                   "values (?, ?, ?, ?, ?)",
+                                   [(chat_id, block[0]['message_id'], block[-1]['message_id'], len(block), self.pack(block))
+                                    for block in blocks])
+
+    # Последние limit сообщений чата перед сообщением before по возрастанию message_id
+    def messages(self, chat_id, before, limit):
+        connection = self.connection()
+        if connection is None or limit <= 0:
+            return []
+
+        found = {}
+        cursor = connection.execute("select data from blocks "
+                                    "where chat_id = ? and first_message_id < ? "
+                                    "order by last_message_id desc", (chat_id, before))
+        for data, in cursor:
+            for message in self.unpack(data):
+                if message['message_id'] < before:
+                    found[message['message_id']] = message
+            # Блоки одного чата не пересекаются, кроме повторно перенесенных
+            # после сбоя, поэтому дальше читать не нужно
+            if len(found) >= limit:
+                break
+        cursor.close()
+        return [found[message_id] for message_id in sorted(found)[-limit:]]
+
+    # Удаляем сообщение отправителя из архива. Возвращает удаленное сообщение или None
+    def delete(self, message_id, message_sender):
+        connection = self.connection()
+        if connection is None:
+            return None
+
+        with connection:
+            connection.execute('begin immediate')
+            deleted = None
+            for block_id, data in connection.execute("select block_id, data from blocks "
+                                                     "where first_message_id <= ? and last_message_id >= ?",
+                                                     (message_id, message_id)).fetchall():
+                block = self.unpack(data)
+                rest = [message for message in block
+                        if message['message_id'] != message_id or message['message_sender'] != message_sender]
+                if len(rest) == len(block):
+                    continue
+                deleted = next(message for message in block if message['message_id'] == message_id)
+                if rest:
+                    connection.execute("update blocks set first_message_id = ?, last_message_id = ?, message_count = ?, data = ? "
+                                       "where block_id = ?",
+                                       (rest[0]['message_id'], rest[-1]['message_id'], len(rest), self.pack(rest), block_id))
+                else:
+                    connection.execute("delete from blocks where block_id = ?", (block_id,))
+        return deleted
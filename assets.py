@@ -0,0 +1,165 @@
+import base64
+import gzip
+import hashlib
+import json
+import os
+import posixpath
+import re
+import urllib.request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Внешние ресурсы, которые раньше подключались с CDN: имя в каталоге vendor, адрес и
+# хэш SRI (пустой - у ресурса на CDN его не было, файл берется как есть)
+BOOTSTRAP = 'https://cdn.jsdelivr.net/npm/bootstrap@5.2.0-beta1/dist/'
+BOOTSTRAP_ICONS = 'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.8.3/font/'
+VENDOR = (
+    ('bootstrap.min.css', BOOTSTRAP + 'css/bootstrap.min.css',
+     'sha384-0evHe/X+R7YkIZDRvuzKMRqM+OrBnVFBL6DOitfPri4tjfHxaWutUpFmBp4vmVor'),
+    ('bootstrap.bundle.min.js', BOOTSTRAP + 'js/bootstrap.bundle.min.js',
+     'sha384-pprn3073KE6tl6bjs2QrFaJGz5/SUsLqktiwsUTF55Jfv3qYSDhgCecCxMW52nD2'),
+    ('bootstrap-icons.css', BOOTSTRAP_ICONS + 'bootstrap-icons.css', ''),
+    ('fonts/bootstrap-icons.woff2', BOOTSTRAP_ICONS + 'fonts/bootstrap-icons.woff2', ''),
+    ('fonts/bootstrap-icons.woff', BOOTSTRAP_ICONS + 'fonts/bootstrap-icons.woff', ''),
+)
+
+# Сжатые копии имеют смысл только для текстовых форматов: png, woff и woff2 уже сжаты
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt', '.ico')
+
+MANIFEST = 'manifest.json'
+
+CSS_URL = re.compile(r'url\((["\']?)([^)"\']+)\1\)')
+
+
+class AssetError(Exception):
+    pass
+
+
+# Хэш содержимого для атрибута integrity
+def integrity(data):
+    return 'sha384-' + base64.b64encode(hashlib.sha384(data).digest()).decode()
+
+
+def writeFile(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as file:
+        file.write(data)
+    os.replace(temporary, path)
+
+
+# Сжатая копия сохраняется, только если она меньше исходного файла
+def writeCompressed(path, data, compressed):
+    if len(compressed) < len(data):
+        writeFile(path, compressed)
+
+
+# Скачиваем внешние ресурсы в vendor_path. Уже скачанные файлы не перезагружаются,
+# содержимое сверяется с хэшем SRI
+def downloadVendor(vendor_path, timeout=30):
+    downloaded = []
+    for name, url, sri in VENDOR:
+        path = os.path.join(vendor_path, name)
+        if os.path.exists(path):
+            continue
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            data = response.read()
+        if sri and integrity(data) != sri:
+            raise AssetError('{}: содержимое не совпадает с {}'.format(url, sri))
+        writeFile(path, data)
+        downloaded.append(name)
+    return downloaded
+
+
+# Все файлы каталогов sources: имя относительно каталога -> путь
+def collectFiles(sources):
+    files = {}
+    for source in sources:
+        for directory, _, names in os.walk(source):
+            for name in names:
+                path = os.path.join(directory, name)
+                files.setdefault(os.path.relpath(path, source).replace(os.sep, '/'), path)
+    return files
+
+
+# Ссылки url(...) в CSS на собранные файлы заменяются именами с хэшем
+def rewriteCss(name, data, manifest):
+    directory = posixpath.dirname(name)
+
+    def replace(match):
+        reference = match.group(2)
+        target = posixpath.normpath(posixpath.join(directory, re.split('[?#]', reference, 1)[0]))
+        if '://' in reference or reference.startswith('data:') or target not in manifest:
+            return match.group(0)
+        return 'url("{}")'.format(posixpath.relpath(manifest[target]['file'], directory or '.'))
+
+    return CSS_URL.sub(replace, data.decode('utf-8')).encode('utf-8')
+
+
+# Сборка ресурсов из каталогов sources в output_path: каждый файл копируется под именем
+# с хэшем содержимого (images/Avatar.png -> images/Avatar.1a2b3c4d5e6f.png), для текстовых
+# форматов рядом кладутся сжатые копии .gz и, если установлен brotli, .br.
+# Файлы прошлых сборок не удаляются: страницы, отданные до перезапуска, ссылаются на них.
+# Соответствие имен записывается в manifest.json
+def buildAssets(sources, output_path):
+    files = collectFiles(sources)
+    manifest = {}
+    # CSS собираются последними: к этому моменту известны имена шрифтов и картинок
+    for name in sorted(files, key=lambda name: (name.endswith('.css'), name)):
+        with open(files[name], 'rb') as file:
+            data = file.read()
+        if name.endswith('.css'):
+            data = rewriteCss(name, data, manifest)
+
+        base, extension = posixpath.splitext(name)
+        built = '{}.{}{}'.format(base, hashlib.sha256(data).hexdigest()[:12], extension)
+        path = os.path.join(output_path, built)
+        if not os.path.exists(path):
+            writeFile(path, data)
+            if extension in COMPRESSIBLE:
+                writeCompressed(path + '.gz', data, gzip.compress(data, 9, mtime=0))
+                if brotli is not None:
+                    writeCompressed(path + '.br', data, brotli.compress(data, quality=11))
+        manifest[name] = {'file': built, 'integrity': integrity(data)}
+
+    writeFile(os.path.join(output_path, MANIFEST), json.dumps(manifest, indent=2, sort_keys=True).encode())
+    return manifest
+
+
+# Манифест сборки, читается один раз при запуске процесса. Пока сборки нет,
+# внешние ресурсы подключаются с CDN, а собственные - из каталога static
+class AssetManifest(object):
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.vendor = {name: (url, sri) for name, url, sri in VENDOR}
+        try:
+            with open(os.path.join(output_path, MANIFEST), 'rb') as file:
+                self.manifest = json.load(file)
+        except FileNotFoundError:
+            self.manifest = {}
+
+    # Имя собранного файла или None
+    def built(self, name):
+        entry = self.manifest.get(name)
+        return entry and entry['file']
+
+    def external(self, name):
+        entry = self.vendor.get(name)
+        return entry and entry[0]
+
+    def integrity(self, name):
+        entry = self.manifest.get(name)
+        if entry:
+            return entry['integrity']
+        return self.vendor.get(name, ('', ''))[1]
+
+    # Сжатая копия файла сборки для Accept-Encoding клиента: (имя, кодировка) или (имя, None)
+    def negotiate(self, filename, accept_encodings):
+        for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+            if encoding in accept_encodings and os.path.isfile(os.path.join(self.output_path, filename + suffix)):
+                return filename + suffix, encoding
+        return filename, None
@@ -0,0 +1,111 @@
+import hashlib
+import io
+import os
+import re
+
+from PIL import Image, ImageOps
+
+
+# Имя файла аватара - sha256 исходного содержимого
+AVATAR_HASH = re.compile(r'[0-9a-f]{64}')
+
+# Форматы, которые принимаются при загрузке
+AVATAR_FORMATS = ('PNG', 'JPEG')
+
+
+# Загруженный файл не является допустимым изображением
+class AvatarError(Exception):
+    pass
+
+
+# Хранилище аватаров на локальном диске с адресацией по содержимому.
+# При загрузке изображение один раз приводится к квадрату и уменьшается
+# до всех размеров, которые используются в шаблонах.
+# Файл с данным хэшем никогда не меняется, поэтому его можно кэшировать навсегда
+class AvatarStore(object):
+    def __init__(self, root, sizes, max_size, max_pixels):
+        self.root = root
+        self.sizes = tuple(sorted(sizes))
+        self.max_size = max_size
+        self.max_pixels = max_pixels
+
+    # Путь к файлу аватара по хэшу. Без размера - самая крупная копия
+    def path(self, avatar_hash, size=None):
+        name = avatar_hash if size is None else '{}_{}'.format(avatar_hash, size)
+        return os.path.join(self.root, avatar_hash[:2], name + '.png')
+
+    def exists(self, avatar_hash, size=None):
+        return bool(AVATAR_HASH.fullmatch(avatar_hash)) and os.path.exists(self.path(avatar_hash, size))
+
+    # Чтение загружаемого файла частями с ограничением размера
+    def read(self, stream):
+        chunks = []
+        total = 0
+        while True:
+            chunk = stream.read(64 * 1024)
+            if not chunk:
+                break
+            total += len(chunk)
+            if total > self.max_size:
+                raise AvatarError('Размер файла больше {} байт'.format(self.max_size))
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    # Декодирование с проверкой, что это действительно PNG или JPEG
+    def decode(self, data):
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                if image.format not in AVATAR_FORMATS:
+                    raise AvatarError('Неподдерживаемый формат изображения')
+                if image.width * image.height > self.max_pixels:
+                    raise AvatarError('Слишком большое разрешение изображения')
+                image.verify()
+
+            image = Image.open(io.BytesIO(data))
+            image.load()
+        except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as e:
+            raise AvatarError('Поврежденное изображение: {}'.format(str(e)))
+
+        # Учитываем поворот снимка из EXIF
+        return self.normalize(ImageOps.exif_transpose(image))
+
+    # Приводим изображение к RGB, прозрачность сохраняем только если она есть
+    @staticmethod
+    def normalize(image):
+        if 'A' in image.getbands() or 'transparency' in image.info:
+            return image.convert('RGBA')
+        return image.convert('RGB')
+
+    # Квадратная копия изображения со стороной size
+    @staticmethod
+    def resize(image, size):
+        return ImageOps.fit(image, (size, size), Image.LANCZOS)
+
+    def write(self, path, image):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Пишем во временный файл, чтобы читатели не увидели его недописанным
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        image.save(tmp_path, format='PNG', optimize=True)
+        os.replace(tmp_path, path)
+
+    # Сохранение аватара, возвращает его хэш
+    def save(self, data):
+        avatar_hash = hashlib.sha256(data).hexdigest()
+        if all(self.exists(avatar_hash, size) for size in (None,) + self.sizes):
+            return avatar_hash
+
+        image = self.decode(data)
+        self.write(self.path(avatar_hash), self.resize(image, self.sizes[-1]))
+        for size in self.sizes:
+            self.write(self.path(avatar_hash, size), self.resize(image, size))
+        return avatar_hash
+
+    # Путь к копии нужного размера. Для аватаров, сохраненных
+    # без уменьшенных копий, копия создается при первом запросе
+    def variant(self, avatar_hash, size):
+        path = self.path(avatar_hash, size)
+        if not os.path.exists(path):
+            with Image.open(self.path(avatar_hash)) as image:
+                image.load()
+                self.write(path, self.resize(self.normalize(image), size))
+        return path
@@ -0,0 +1,159 @@
+# Проверка планов запросов горячего пути: заполняет временную БД SQLite (схема - миграциями
+# при импорте приложения), выполняет каждый запрос из HOT_PATH и получает его план через
+# EXPLAIN QUERY PLAN. Завершается с кодом 1, если какой-либо запрос полностью просматривает таблицу:
+#
+#   python -m benchmarks.explain --users 500 --messages 20000
+#
+# Запросы на изменение выполняются в транзакции, которая затем откатывается
+import argparse
+import atexit
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+
+# БД и хранилища - временные, окружение нужно задать до импорта приложения
+workdir = tempfile.mkdtemp(prefix='coopnet-explain-')
+atexit.register(shutil.rmtree, workdir, True)
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(workdir, 'coopnet.db')
+os.environ['AVATAR_STORAGE'] = os.path.join(workdir, 'avatars')
+os.environ['ARCHIVE_PATH'] = os.path.join(workdir, 'archive.db')
+
+from sqlalchemy import event, text
+
+import queries
+from app import app, db, MAX_MESSAGE_ID
+from benchmarks.seed import seed
+
+
+# Запросы горячего пути и их параметры по образцам из заполненной БД
+HOT_PATH = {
+    'USER_IDENTITY': lambda s: {'user_id': s['user_id']},
+    'USER_CREDENTIALS': lambda s: {'email': s['email']},
+    'USER_PHOTO_HASH': lambda s: {'user_id': s['user_id']},
+    'USER_PROFILE': lambda s: {'user_id': s['user_id']},
+    'UPDATE_USER_PASSWORD': lambda s: {'user_id': s['user_id'], 'password': 'план'},
+    'SEARCH_USERS': lambda s: {'query': 'user1', 'query_end': 'user2', 'after': 0, 'user_id': s['user_id'], 'limit': 20},
+    'LIST_USERS': lambda s: {'after': 0, 'user_id': s['user_id'], 'limit': 20},
+    'EXISTING_USERS': lambda s: {'user_ids': [s['user_id'], s['companion_id']]},
+    'MESSAGE_SENDERS': lambda s: {'user_ids': [s['user_id'], s['companion_id']]},
+    'USER_CHATS': lambda s: {'user_id': s['user_id']},
+    'CHAT_MEMBER': lambda s: {'chat_id': s['chat_id'], 'user_id': s['user_id']},
+    'USER_CHAT_IDS': lambda s: {'user_id': s['user_id']},
+    'CHAT': lambda s: {'chat_id': s['chat_id']},
+    'CHAT_PHOTO_HASH': lambda s: {'chat_id': s['chat_id']},
+    'CHAT_COMPANION': lambda s: {'chat_id': s['chat_id'], 'user_id': s['user_id']},
+    'CHAT_PARTICIPANTS': lambda s: {'chat_id': s['chat_id'], 'user_id': s['user_id']},
+    'CHAT_MEMBER_IDS': lambda s: {'chat_id': s['chat_id']},
+    'DELETE_CHAT_MEMBER': lambda s: {'chat_id': s['chat_id'], 'user_id': s['user_id']},
+    'DIRECT_CHAT': lambda s: {'user_a': s['user_id'], 'user_b': s['companion_id']},
+    'CHAT_MESSAGES': lambda s: {'chat_id': s['chat_id'], 'before': MAX_MESSAGE_ID, 'limit': 51},
+    'CHAT_PAGE_BOUNDS': lambda s: {'chat_id': s['chat_id'], 'before': MAX_MESSAGE_ID, 'limit': 50},
+    'CHAT_OLDER_MESSAGE': lambda s: {'chat_id': s['chat_id'], 'before': s['message_id']},
+    'CHAT_MESSAGES_RANGE': lambda s: {'chat_id': s['chat_id'], 'first': s['message_id'] - 1000, 'last': s['message_id'],
+                                      'limit': 500},
+    'CHAT_MESSAGES_SINCE': lambda s: {'chat_id': s['chat_id'], 'since': s['message_id'] - 100, 'limit': 51},
+    'OWN_MESSAGE': lambda s: {'message_id': s['message_id'], 'user_id': s['user_id']},
+    'DELETE_MESSAGE': lambda s: {'message_id': s['message_id']},
+    'UPSERT_CHAT_SUMMARY': lambda s: {'chat_id': s['chat_id'], 'message_id': s['message_id'], 'message_content': 'план',
+                                      'message_date_sent': '2000-01-01 00:00:00', 'message_sender': s['user_id']},
+    'REWIND_CHAT_SUMMARY': lambda s: {'chat_id': s['chat_id'], 'message_id': s['message_id']},
+    'REWIND_CHAT_SUMMARY_TO': lambda s: {'chat_id': s['chat_id'], 'deleted_id': s['message_id'], 'message_id': s['message_id'] - 1,
+                                         'message_content': 'план', 'message_date_sent': '2000-01-01 00:00:00',
+                                         'message_sender': s['user_id']},
+    'MARK_CHAT_READ': lambda s: {'chat_id': s['chat_id'], 'user_id': s['user_id'], 'message_id': s['message_id']},
+    'DELETE_READ_MARK': lambda s: {'chat_id': s['chat_id'], 'user_id': s['user_id']},
+    'CHAT_READ_UP_TO': lambda s: {'chat_id': s['chat_id'], 'user_id': s['user_id']},
+    'CHAT_LAST_MESSAGE_ID': lambda s: {'chat_id': s['chat_id']},
+    'SEARCH_MESSAGES': lambda s: {'query': 'привет', 'user_id': s['user_id'], 'limit': 20, 'offset': 0},
+}
+
+# Строки плана: полный просмотр таблицы, подзапрос или представление
+SCAN = re.compile(r'^SCAN (\S+)( .*)?$')
+SUBQUERY = re.compile(r'^(?:CO-ROUTINE|MATERIALIZE) (\S+)')
+
+
+# Образцы параметров: самый активный пользователь, его самый большой чат,
+# собеседник в этом чате и последнее сообщение пользователя в нем
+def sampleParameters(connection):
+    user_id, chat_id, message_id = connection.execute(text(
+        "select message_sender, chat_id, max(message_id) "
+        "from \"Сообщение\" "
+        "group by message_sender, chat_id "
+        "order by count(*) desc "
+        "limit 1")).first()
+    email = connection.execute(queries.USER_EMAIL, {'user_id': user_id}).scalar()
+    companion_id = connection.execute(queries.CHAT_COMPANION, {'chat_id': chat_id, 'user_id': user_id}).scalar()
+    return {'user_id': user_id, 'email': email, 'chat_id': chat_id,
+            'companion_id': int(companion_id), 'message_id': message_id}
+
+
+# План запроса: последний выполненный оператор повторяется с EXPLAIN QUERY PLAN
+def queryPlan(connection, statement, parameters):
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute('explain query plan ' + statement, parameters)
+        return [row[3] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+# Таблицы, которые план просматривает полностью
+def tableScans(plan):
+    subqueries = {match.group(1) for match in map(SUBQUERY.match, plan) if match}
+    scans = []
+    for line in plan:
+        match = SCAN.match(line)
+        if match is None or match.group(1) in subqueries or match.group(1) == 'CONSTANT':
+            continue
+        if match.group(2) and ('INDEX' in match.group(2) or 'VIRTUAL TABLE' in match.group(2)):
+            continue
+        scans.append(match.group(1))
+    return scans
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Проверка планов запросов горячего пути')
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--chats', type=int, default=100, help='групповых чатов')
+    parser.add_argument('--direct', type=int, default=300, help='личных чатов')
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--verbose', action='store_true', help='печатать планы всех запросов')
+    args = parser.parse_args(argv)
+
+    executed = []
+
+    with app.app_context():
+        seed(args.users, args.chats, 8, args.messages, random.Random(1), direct=args.direct)
+
+        @event.listens_for(db.engine, 'before_cursor_execute')
+        def capture(connection, cursor, statement, parameters, context, executemany):
+            executed.append((statement, parameters))
+
+        failed = []
+        with db.engine.connect() as connection:
+            samples = sampleParameters(connection)
+            for name, parameters in HOT_PATH.items():
+                transaction = connection.begin()
+                try:
+                    executed.clear()
+                    connection.execute(getattr(queries, name), parameters(samples))
+                    plan = queryPlan(connection, *executed[-1])
+                finally:
+                    transaction.rollback()
+
+                scans = tableScans(plan)
+                print('{:<22} {}'.format(name, 'просмотр таблиц: ' + ', '.join(scans) if scans else 'ok'))
+                if scans or args.verbose:
+                    print('\n'.join('    ' + line for line in plan))
+                if scans:
+                    failed.append(name)
+
+    if failed:
+        sys.exit('Полный просмотр таблиц в запросах: {}'.format(', '.join(failed)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+# Отдача HomePage с большим окном чата: время до первого байта (TTFB), полное время ответа
+# и пиковая память при обычной и потоковой отрисовке (HOMEPAGE_STREAMING), а также
+# первый запрос нового процесса с кэшем скомпилированных шаблонов (JINJA_BYTECODE_CACHE) и без него.
+# Каждый режим - отдельный процесс с сервером werkzeug, БД временная:
+#
+#   python -m benchmarks.homepage --messages 20000 --page 5000 --requests 20
+#
+# --page - MESSAGES_PAGE_SIZE, сколько сообщений выводится в окне чата.
+# Пиковый RSS включает страницы файла БД, отображенные в память (mmap_size), поэтому разница
+# режимов точнее видна по пику памяти Python на один запрос (tracemalloc, отдельный запрос после замеров)
+import argparse
+import http.client
+import itertools
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.parse
+
+
+# Режимы: название и окружение процесса
+MODES = (
+    ('целиком', {'HOMEPAGE_STREAMING': '0'}),
+    ('потоком', {'HOMEPAGE_STREAMING': '1'}),
+)
+
+
+def request(port, path, headers=None, method='GET', body=None):
+    connection = http.client.HTTPConnection('127.0.0.1', port)
+    try:
+        started = time.perf_counter()
+        connection.request(method, path, body=body, headers=headers or {})
+        response = connection.getresponse()
+        response.read(1)
+        first_byte = time.perf_counter() - started
+        # Ответ читается частями, чтобы клиент не держал страницу в памяти процесса
+        size = 1
+        while True:
+            chunk = response.read(64 * 1024)
+            if not chunk:
+                break
+            size += len(chunk)
+        return response, first_byte, time.perf_counter() - started, size
+    finally:
+        connection.close()
+
+
+# Процесс замера: сервер в отдельном потоке, запросы к нему через сокет.
+# Пиковая память (ru_maxrss) сравнивается с памятью после входа, до первой страницы
+def child(args):
+    import resource
+    import threading
+
+    from werkzeug.serving import make_server
+
+    started = time.perf_counter()
+    from app import app
+    import_seconds = time.perf_counter() - started
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_port
+
+    login = urllib.parse.urlencode({'email': args.email, 'password': args.password})
+    response = request(port, '/', {'Content-Type': 'application/x-www-form-urlencoded'}, 'POST', login)[0]
+    cookie = response.getheader('Set-Cookie').split(';', 1)[0]
+
+    # Окно чата каждый раз отрисовывается заново: before отличается, а страница та же
+    def page(number):
+        return request(port, '/HomePage?selectedchat={}&before={}'.format(args.chat_id, args.before + number),
+                       {'Cookie': cookie})
+
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    first = page(0)
+    runs = [page(number) for number in range(1, args.requests + 1)]
+    tracemalloc.start()
+    page(args.requests + 1)
+    heap_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    server.shutdown()
+    print(json.dumps({'import_seconds': import_seconds,
+                      'first_request_seconds': first[2],
+                      'ttfb': [run[1] for run in runs],
+                      'total': [run[2] for run in runs],
+                      'bytes': runs[0][3],
+                      'baseline_rss_kb': baseline_kb,
+                      'heap_peak_bytes': heap_peak,
+                      'rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+
+
+# Номера файлов кэша фрагментов: у каждого процесса свой, чтобы он не получал страницы,
+# отрисованные в другом режиме
+processes = itertools.count()
+
+
+def measure(environment, args, dataset):
+    environment = dict(environment, CACHE_PATH='{}-{}.db'.format(environment['CACHE_PATH'], next(processes)))
+    command = [sys.executable, '-m', 'benchmarks.homepage', '--child',
+               '--requests', str(args.requests),
+               '--email', dataset['email'],
+               '--chat-id', str(dataset['chat_id']),
+               '--before', str(dataset['before'])]
+    result = subprocess.run(command, env=environment, capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+# Заполнение БД в отдельном процессе: все сообщения - в одном групповом чате
+SEED = ("import json, random, sys\n"
+        "from sqlalchemy import text\n"
+        "from app import app, db\n"
+        "from benchmarks.seed import seed\n"
+        "with app.app_context():\n"
+        "    seed(50, 1, 8, int(sys.argv[1]), random.Random(1), pick_chat=lambda: 0)\n"
+        "    chat_id, before, user_id = db.engine.execute(text(\n"
+        "        'select chat_id, max(message_id) + 1, min(message_sender) from \"Сообщение\" group by chat_id')).first()\n"
+        "    email = db.engine.execute(text('select email from \"Пользователь\" where id = :id'), id=user_id).scalar()\n"
+        "print(json.dumps({'chat_id': chat_id, 'before': before, 'email': email}))\n")
+
+
+def milliseconds(values):
+    values = sorted(values)
+    return 'медиана {:7.1f}, p95 {:7.1f}'.format(statistics.median(values) * 1e3,
+                                                 values[min(len(values) - 1, int(len(values) * 0.95))] * 1e3)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='TTFB и память HomePage при обычной и потоковой отрисовке')
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--page', type=int, default=5000, help='сообщений в окне чата (MESSAGES_PAGE_SIZE)')
+    parser.add_argument('--requests', type=int, default=20)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--email', help=argparse.SUPPRESS)
+    parser.add_argument('--password', default='password', help=argparse.SUPPRESS)
+    parser.add_argument('--chat-id', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--before', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        child(args)
+        return
+
+    workdir = tempfile.mkdtemp(prefix='coopnet-homepage-')
+    try:
+        # Фрагменты кэшируются в файле, чтобы сохраненные страницы не занимали память процесса
+        environment = dict(os.environ,
+                           DATABASE_URL='sqlite:///' + os.path.join(workdir, 'coopnet.db'),
+                           AVATAR_STORAGE=os.path.join(workdir, 'avatars'),
+                           ARCHIVE_PATH=os.path.join(workdir, 'archive.db'),
+                           CACHE_BACKEND='sqlite',
+                           CACHE_PATH=os.path.join(workdir, 'cache'),
+                           JINJA_BYTECODE_CACHE='',
+                           MESSAGES_PAGE_SIZE=str(args.page))
+        seeded = subprocess.run([sys.executable, '-c', SEED, str(args.messages)], env=environment,
+                                capture_output=True, text=True, check=True,
+                                cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        dataset = json.loads(seeded.stdout.strip().splitlines()[-1])
+
+        results = [(name, measure(dict(environment, **mode), args, dataset)) for name, mode in MODES]
+
+        # Первый запрос нового процесса: шаблоны компилируются или читаются из кэша
+        cached = dict(environment, JINJA_BYTECODE_CACHE=os.path.join(workdir, 'jinja-cache'))
+        measure(cached, args, dataset)
+        compiled = [('без кэша шаблонов', results[-1][1]), ('с кэшем шаблонов', measure(cached, args, dataset))]
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print('окно чата: {} сообщений, страница {:.0f} КиБ, запросов: {}'.format(
+        args.page, results[0][1]['bytes'] / 1024, args.requests))
+    for name, result in results:
+        print('{}:'.format(name))
+        print('    TTFB, мс:          {}'.format(milliseconds(result['ttfb'])))
+        print('    ответ целиком, мс: {}'.format(milliseconds(result['total'])))
+        print('    пиковый RSS, МиБ:  {:.1f} (до первой страницы {:.1f})'.format(
+            result['rss_kb'] / 1024, result['baseline_rss_kb'] / 1024))
+        print('    пик памяти Python на запрос, МиБ: {:.1f}'.format(result['heap_peak_bytes'] / 2 ** 20))
+    for name, result in compiled:
+        print('первый запрос процесса {}, мс: {:.1f}'.format(name, result['first_request_seconds'] * 1e3))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# Пропускная способность записи сообщений при пачках отправок: транзакция на каждое сообщение
+# против групповой записи (ingest.MessageWriter). Запускается на БД из benchmarks.seed
+# (сообщения добавляются в нее):
+#
+#   DATABASE_URL=sqlite:////tmp/coopnet-bench.db python -m benchmarks.ingest --messages 5000 --concurrency 16
+#
+# Замеряется только запись в БД, без HTTP и оповещения участников
+import argparse
+import random
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import text
+
+from app import app, db, writingMessages
+from benchmarks.seed import messageText
+from ingest import MessageWriter
+
+
+# Сообщения от участников случайных чатов
+def messageRows(connection, count, seed):
+    rnd = random.Random(seed)
+    members = [tuple(row) for row in connection.execute(text("select chat_id, cast(user_id as integer) "
+                                                             "from \"Список Участников Чата\""))]
+    return [dict(zip(('chat_id', 'message_sender'), rnd.choice(members)),
+                 message_content=messageText(rnd),
+                 message_date_sent=str(datetime.utcnow()))
+            for _ in range(count)]
+
+
+def run(rows, concurrency, send):
+    timings = []
+    chunks = [rows[number::concurrency] for number in range(concurrency)]
+
+    def worker(chunk):
+        for row in chunk:
+            started = time.perf_counter()
+            send(row)
+            timings.append(time.perf_counter() - started)
+
+    threads = [threading.Thread(target=worker, args=(chunk,)) for chunk in chunks]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    timings.sort()
+    return {'p50_ms': round(timings[len(timings) // 2] * 1e3, 2),
+            'p99_ms': round(timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1e3, 2),
+            'throughput': round(len(timings) / elapsed, 1)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Запись сообщений: по одному и пачками')
+    parser.add_argument('--messages', type=int, default=5000, help='сообщений на режим')
+    parser.add_argument('--concurrency', type=int, default=16, help='параллельных отправителей')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    with app.app_context():
+        with db.engine.connect() as connection:
+            rows = messageRows(connection, args.messages * 2, args.seed)
+        if not rows:
+            raise SystemExit('БД пуста, заполните ее через benchmarks.seed')
+
+        single = run(rows[:args.messages], args.concurrency, lambda row: writingMessages([row]))
+
+        writer = MessageWriter(writingMessages, app.config['INGEST_QUEUE_SIZE'],
+                               app.config['INGEST_BATCH_SIZE'], app.config['INGEST_MAX_DELAY'])
+        try:
+            grouped = run(rows[args.messages:], args.concurrency,
+                          lambda row: writer.submit(row).result(app.config['INGEST_TIMEOUT']))
+        finally:
+            writer.close()
+
+    print('{:<12} {:>9} {:>9} {:>10}'.format('режим', 'p50 мс', 'p99 мс', 'сообщ/с'))
+    for name, result in (('по одному', single), ('пачками', grouped)):
+        print('{:<12} {:>9} {:>9} {:>10}'.format(name, result['p50_ms'], result['p99_ms'], result['throughput']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# Задержка отдельных запросов: SQL, собранный через str.format (как было раньше в app.py),
+# против постоянных запросов с параметрами из queries.py. Запускается на БД из benchmarks.seed:
+#
+#   DATABASE_URL=sqlite:////tmp/coopnet-bench.db python -m benchmarks.latency --iterations 5000
+import argparse
+import json
+import random
+import time
+
+from sqlalchemy import text
+
+import queries
+from app import app, db
+
+
+# Запросы в том виде, в котором они строились до перехода на параметры
+FORMATTED = {
+    'CHAT_MESSAGES': "select mes.message_id, mes.chat_id, mes.message_sender, user.name, mes.message_content, mes.message_date_sent, mes.message_status, user.photo_hash "
+                     "from (select * "
+                     "from 'Сообщение' "
+                     "where chat_id == {chat_id} and message_id < {before} "
+                     "order by message_id desc "
+                     "limit {limit}) mes left join 'Пользователь' user on mes.message_sender = user.id "
+                     "order by mes.message_id asc",
+    'CHAT': "select chat_id, chat_name, chat_description, chat_creator, chat_photo_hash "
+            "from 'Чат' "
+            "where chat_id == {chat_id}",
+    'CHAT_PARTICIPANTS': "select id, email, photo_hash "
+                         "from 'Пользователь' "
+                         "where id in (select user_id "
+                         "from 'Список Участников Чата' "
+                         "where chat_id == {chat_id} and user_id != '{user_id}')",
+    'CHAT_COMPANION': "select user_id "
+                      "from 'Список Участников Чата' "
+                      "where chat_id=='{chat_id}' and user_id != '{user_id}'",
+    'USER_PROFILE': "select id, email, name, telephone, login, info, date_registration, photo_hash "
+                    "from 'Пользователь' "
+                    "where id == '{user_id}' ",
+    'USER_CREDENTIALS': "select id, email, name, login, photo_hash, password from 'Пользователь' where email=='{email}'",
+}
+
+
+# Случайные параметры запроса из заполненной БД
+def parameters(rnd, chat_ids, user_ids):
+    user_id = rnd.choice(user_ids)
+    return {'chat_id': rnd.choice(chat_ids),
+            'user_id': user_id,
+            'email': 'user{}@bench.local'.format(user_id),
+            'before': 2 ** 63 - 1,
+            'limit': app.config['MESSAGES_PAGE_SIZE'] + 1}
+
+
+def percentile(timings, q):
+    return timings[min(len(timings) - 1, int(len(timings) * q))]
+
+
+def summary(timings):
+    timings = sorted(timings)
+    return {'mean_us': round(sum(timings) / len(timings) * 1e6, 1),
+            'p50_us': round(percentile(timings, 0.50) * 1e6, 1),
+            'p95_us': round(percentile(timings, 0.95) * 1e6, 1)}
+
+
+# Поочередно выполняем оба варианта запроса с одинаковыми параметрами
+def measure(connection, name, params):
+    formatted, bound = [], []
+    for values in params:
+        started = time.perf_counter()
+        connection.execute(text(FORMATTED[name].format(**values))).fetchall()
+        formatted.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        connection.execute(getattr(queries, name), values).fetchall()
+        bound.append(time.perf_counter() - started)
+
+    formatted, bound = summary(formatted), summary(bound)
+    return {'query': name,
+            'format': formatted,
+            'bound': bound,
+            'speedup': round(formatted['mean_us'] / bound['mean_us'], 2)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Задержка запросов: str.format против параметров')
+    parser.add_argument('--iterations', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='вывести результаты в JSON')
+    args = parser.parse_args(argv)
+
+    rnd = random.Random(args.seed)
+    with app.app_context(), db.engine.connect() as connection:
+        chat_ids = [row[0] for row in connection.execute(text("select chat_id from 'Чат'"))]
+        user_ids = [row[0] for row in connection.execute(text("select id from 'Пользователь'"))]
+        if not chat_ids or not user_ids:
+            raise SystemExit('БД пуста, заполните ее через benchmarks.seed')
+
+        params = [parameters(rnd, chat_ids, user_ids) for _ in range(args.iterations)]
+        results = [measure(connection, name, params) for name in FORMATTED]
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return
+
+    print('{:<20} {:>12} {:>12} {:>12} {:>12} {:>8}'.format('запрос', 'format p50', 'format p95', 'bound p50', 'bound p95', 'x'))
+    for result in results:
+        print('{:<20} {:>12} {:>12} {:>12} {:>12} {:>8}'.format(result['query'],
+                                                             result['format']['p50_us'], result['format']['p95_us'],
+                                                             result['bound']['p50_us'], result['bound']['p95_us'],
+                                                             result['speedup']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+# Нагрузочный прогон основных маршрутов через тестовый клиент Flask: задержка p50/p95/p99
+# и пропускная способность каждого сценария. Запускается на БД из benchmarks.seed
+# (сценарии регистрации, отправки сообщений и создания чатов добавляют в нее данные):
+#
+#   DATABASE_URL=sqlite:////tmp/coopnet-bench.db AVATAR_STORAGE=/tmp/coopnet-bench-avatars \
+#       python -m benchmarks.load --requests 500 --concurrency 4 --output results.json
+#
+# С --baseline результаты сравниваются с JSON предыдущего прогона
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import text
+
+from app import app, db
+from benchmarks.seed import PASSWORD, messageText
+
+
+# Номера для уникальных email, логинов и телефонов регистрируемых пользователей
+registrations = itertools.count()
+
+
+# Данные заполненной БД, из которых выбираются параметры запросов
+def loadDataset(connection):
+    users = [tuple(row) for row in connection.execute(text("select id, email, photo_hash from \"Пользователь\" "
+                                                           "where email like '%@bench.local'"))]
+    chats = {}
+    for chat_id, user_id in connection.execute(text("select chat_id, cast(user_id as integer) "
+                                                    "from \"Список Участников Чата\"")):
+        chats.setdefault(user_id, []).append(chat_id)
+    return {'users': users,
+            'chats': chats,
+            'avatars': sorted({user[2] for user in users if user[2]}),
+            'run': datetime.utcnow().strftime('%H%M%S')}
+
+
+# Клиент, авторизованный под случайным пользователем, у которого есть чаты
+def loggedClient(rnd, dataset):
+    while True:
+        user_id, email, photo_hash = rnd.choice(dataset['users'])
+        if dataset['chats'].get(user_id):
+            break
+    client = app.test_client()
+    client.post('/', data={'email': email, 'password': PASSWORD})
+    return client, {'user_id': user_id, 'chats': dataset['chats'][user_id]}
+
+
+# region Сценарии
+# Каждый сценарий: (нужна ли авторизация, ожидаемые коды ответа, запрос)
+def loginPage(client, session, rnd, dataset):
+    return client.get('/')
+
+
+# Каждый вход - новым клиентом, иначе авторизованный клиент сразу получает перенаправление
+def login(client, session, rnd, dataset):
+    return app.test_client().post('/', data={'email': rnd.choice(dataset['users'])[1], 'password': PASSWORD})
+
+
+def registration(client, session, rnd, dataset):
+    number = next(registrations)
+    return client.post('/registration', data={'name': 'Нагрузка',
+                                              'login': 'load{}x{}'.format(dataset['run'], number),
+                                              'phone': '9{:03d}{:06d}'.format(int(dataset['run']) % 900 + 100, number),
+                                              'reg_email': 'load{}x{}@load.local'.format(dataset['run'], number),
+                                              'reg_password': PASSWORD,
+                                              'confirm_password': PASSWORD})
+
+
+def homepage(client, session, rnd, dataset):
+    return client.get('/HomePage')
+
+
+def homepageChat(client, session, rnd, dataset):
+    return client.get('/HomePage', query_string={'selectedchat': rnd.choice(session['chats'])})
+
+
+def sendMessage(client, session, rnd, dataset):
+    return client.post('/sendmessage', query_string={'chat_id': rnd.choice(session['chats'])},
+                       data={'MessageText': messageText(rnd)}, headers={'Accept': 'application/json'})
+
+
+def creatingChat(client, session, rnd, dataset):
+    members = {str(rnd.choice(dataset['users'])[0]): '' for _ in range(rnd.randint(2, 20))}
+    return client.post('/creatingchat', data=dict(members, ChatNameCreate='Нагрузка'))
+
+
+def avatar(client, session, rnd, dataset):
+    return client.get('/avatar/{}/55'.format(rnd.choice(dataset['avatars'])))
+
+
+def userAvatar(client, session, rnd, dataset):
+    return client.get('/useravatar')
+
+
+def getUserAvatar(client, session, rnd, dataset):
+    return client.get('/getuseravatar', query_string={'userfield': rnd.choice(dataset['users'])[0]})
+
+
+SCENARIOS = {
+    'login_page': (False, (200,), loginPage),
+    'login': (False, (302,), login),
+    'registration': (False, (302,), registration),
+    'homepage': (True, (200,), homepage),
+    'homepage_chat': (True, (200,), homepageChat),
+    'sendmessage': (True, (201,), sendMessage),
+    'creatingchat': (True, (302,), creatingChat),
+    'avatar': (False, (200,), avatar),
+    'useravatar': (True, (302,), userAvatar),
+    'getuseravatar': (True, (302,), getUserAvatar),
+}
+# endregion
+
+
+def percentile(timings, q):
+    return timings[min(len(timings) - 1, int(len(timings) * q))]
+
+
+# Поток нагрузки: свой клиент и свой генератор случайных чисел
+def worker(name, requests, seed, dataset, timings, errors):
+    authorized, expected, scenario = SCENARIOS[name]
+    rnd = random.Random(seed)
+    if authorized:
+        client, session = loggedClient(rnd, dataset)
+    else:
+        client, session = app.test_client(), None
+
+    for _ in range(requests):
+        started = time.perf_counter()
+        response = scenario(client, session, rnd, dataset)
+        # Потоковый ответ отрисовывается по мере чтения, поэтому тело читается целиком
+        response.get_data()
+        timings.append(time.perf_counter() - started)
+        if response.status_code not in expected:
+            errors.append(response.status_code)
+        response.close()
+
+
+def run(name, requests, concurrency, seed, dataset):
+    timings, errors = [], []
+    threads = [threading.Thread(target=worker,
+                                args=(name, requests // concurrency + (number < requests % concurrency),
+                                      seed + number, dataset, timings, errors))
+               for number in range(concurrency)]
+
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    timings.sort()
+    return {'scenario': name,
+            'requests': len(timings),
+            'errors': len(errors),
+            'error_codes': sorted(set(errors)),
+            'mean_ms': round(sum(timings) / len(timings) * 1e3, 2),
+            'p50_ms': round(percentile(timings, 0.50) * 1e3, 2),
+            'p95_ms': round(percentile(timings, 0.95) * 1e3, 2),
+            'p99_ms': round(percentile(timings, 0.99) * 1e3, 2),
+            'throughput_rps': round(len(timings) / elapsed, 1)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Нагрузочный прогон маршрутов приложения')
+    parser.add_argument('--requests', type=int, default=500, help='запросов на сценарий')
+    parser.add_argument('--concurrency', type=int, default=1, help='параллельных клиентов')
+    parser.add_argument('--scenarios', nargs='+', choices=sorted(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='файл для результатов в JSON')
+    parser.add_argument('--baseline', help='JSON предыдущего прогона для сравнения')
+    args = parser.parse_args(argv)
+
+    with app.app_context():
+        with db.engine.connect() as connection:
+            dataset = loadDataset(connection)
+        if not dataset['users'] or not dataset['chats']:
+            raise SystemExit('БД пуста, заполните ее через benchmarks.seed')
+        scenarios = [name for name in args.scenarios if name != 'avatar' or dataset['avatars']]
+
+        results = [run(name, args.requests, args.concurrency, args.seed, dataset) for name in scenarios]
+
+    report = {'started': datetime.utcnow().isoformat(),
+              'database': str(db.engine.url),
+              'requests': args.requests,
+              'concurrency': args.concurrency,
+              'seed': args.seed,
+              'results': results}
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as file:
+            baseline = {result['scenario']: result for result in json.load(file)['results']}
+
+    print('{:<16} {:>8} {:>9} {:>9} {:>9} {:>10} {:>7} {:>9}'.format(
+        'сценарий', 'ошибки', 'p50 мс', 'p95 мс', 'p99 мс', 'запр/с', 'n', 'p95 / баз'))
+    for result in results:
+        previous = baseline.get(result['scenario'])
+        print('{:<16} {:>8} {:>9} {:>9} {:>9} {:>10} {:>7} {:>9}'.format(
+            result['scenario'], result['errors'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+            result['throughput_rps'], result['requests'],
+            round(result['p95_ms'] / previous['p95_ms'], 2) if previous else '-'))
+
+
+if __name__ == '__main__':
+    main()
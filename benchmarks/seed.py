@@ -0,0 +1,158 @@
+# Заполнение пустой БД данными для замеров: пользователи с аватарами, групповые и личные чаты
+# и сообщения. Активность распределена по закону Ципфа (--skew): немногие чаты получают
+# большую часть сообщений, а немногие пользователи состоят в большей части чатов.
+# БД и хранилище аватаров указываются через окружение, чтобы не трогать рабочие данные:
+#
+#   DATABASE_URL=sqlite:////tmp/coopnet-bench.db AVATAR_STORAGE=/tmp/coopnet-bench-avatars \
+#       python -m benchmarks.seed --users 2000 --chats 500 --direct 2000 --messages 200000
+#
+# Пароль всех пользователей - PASSWORD
+import argparse
+import io
+import itertools
+import random
+import sys
+from datetime import datetime, timedelta
+
+from PIL import Image
+from werkzeug.security import generate_password_hash
+
+from app import app, db, avatar_store, User, Chat, Message, DirectChat, chat_user, \
+    rebuildChatSummaries, backfillReadMarks, rebuildSearchIndex, message_search
+
+
+WORDS = ('привет', 'как', 'дела', 'встреча', 'завтра', 'проект', 'отчет', 'кошка', 'собака', 'обед',
+         'hello', 'deploy', 'release', 'bug', 'review', 'meeting', 'coffee', 'weekend', 'ok', 'спасибо')
+
+# Размер пачки для executemany
+BATCH_SIZE = 10000
+
+PASSWORD = 'password'
+
+
+def insertMany(connection, table, rows):
+    for start in range(0, len(rows), BATCH_SIZE):
+        connection.execute(table.insert(), rows[start:start + BATCH_SIZE])
+
+
+# Текст сообщения из случайных слов
+def messageText(rnd):
+    return ' '.join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 12)))
+
+
+# Выбор числа из range(n) по закону Ципфа с показателем s (s = 0 - равномерно).
+# Номера перемешаны, чтобы самые активные не были первыми по id
+def zipf(rnd, n, s):
+    if s <= 0:
+        return lambda: rnd.randrange(n)
+    order = list(range(n))
+    rnd.shuffle(order)
+    weights = list(itertools.accumulate(1 / (rank + 1) ** s for rank in range(n)))
+    return lambda: rnd.choices(order, cum_weights=weights)[0]
+
+
+# Однотонные изображения для аватаров
+def avatarImages(rnd, count):
+    for _ in range(count):
+        buffer = io.BytesIO()
+        Image.new('RGB', (320, 320), tuple(rnd.randrange(256) for _ in range(3))).save(buffer, 'PNG')
+        yield buffer.getvalue()
+
+
+# Без pick_chat и pick_user сообщения по чатам и участники чатов распределены равномерно.
+# Первые chats чатов - групповые, остальные direct - личные
+def seed(users, chats, members, messages, rnd, pick_chat=None, pick_user=None, direct=0, avatars=0):
+    if pick_chat is None:
+        pick_chat = lambda: rnd.randrange(chats + direct)
+    if pick_user is None:
+        pick_user = lambda: rnd.randrange(users)
+
+    password = generate_password_hash(PASSWORD)
+    started = datetime.utcnow() - timedelta(days=365)
+    avatar_hashes = [avatar_store.save(image) for image in avatarImages(rnd, avatars)]
+
+    with db.engine.begin() as connection:
+        insertMany(connection, User.__table__, [{'email': 'user{}@bench.local'.format(i),
+                                                 'name': 'Пользователь {}'.format(i),
+                                                 'telephone': '+7900{:07d}'.format(i),
+                                                 'login': 'user{}'.format(i),
+                                                 'password': password,
+                                                 'info': 'Напишите информацию о себе',
+                                                 'date_registration': started,
+                                                 'photo_hash': avatar_hashes[i % avatars] if avatars else None}
+                                                for i in range(users)])
+        user_ids = [row[0] for row in connection.execute(db.select(User.id).order_by(User.id))]
+
+        participants = []
+        for chat in range(chats):
+            chosen = set()
+            while len(chosen) < min(members, users):
+                chosen.add(pick_user())
+            participants.append(sorted(chosen))
+
+        pairs = set()
+        while len(pairs) < min(direct, users * (users - 1) // 2):
+            pair = tuple(sorted((pick_user(), pick_user())))
+            if pair[0] != pair[1]:
+                pairs.add(pair)
+        participants.extend(sorted(pairs))
+
+        insertMany(connection, Chat.__table__, [{'chat_name': 'Чат {}'.format(i),
+                                                 'chat_description': 'chat',
+                                                 'chat_creator': user_ids[0]} for i in range(chats)] +
+                                               [{'chat_name': 'Пользователь {}'.format(user_b),
+                                                 'chat_description': 'friend',
+                                                 'chat_creator': user_ids[user_a]} for user_a, user_b in sorted(pairs)])
+        chat_ids = [row[0] for row in connection.execute(db.select(Chat.chat_id).order_by(Chat.chat_id))]
+
+        insertMany(connection, DirectChat.__table__, [{'chat_id': chat_ids[chats + number],
+                                                       'user_a': user_ids[user_a],
+                                                       'user_b': user_ids[user_b]}
+                                                      for number, (user_a, user_b) in enumerate(sorted(pairs))])
+        insertMany(connection, chat_user, [{'chat_id': chat_ids[chat], 'user_id': str(user_ids[user])}
+                                           for chat in range(len(participants)) for user in participants[chat]])
+
+        rows = []
+        for i in range(messages):
+            chat = pick_chat()
+            rows.append({'chat_id': chat_ids[chat],
+                         'message_sender': user_ids[rnd.choice(participants[chat])],
+                         'message_content': messageText(rnd),
+                         'message_date_sent': started + timedelta(seconds=i * 10),
+                         'message_status': 1})
+        insertMany(connection, Message.__table__, rows)
+
+    rebuildChatSummaries()
+    backfillReadMarks()
+    if message_search:
+        rebuildSearchIndex()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Заполнение БД данными для замеров')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--chats', type=int, default=500, help='групповых чатов')
+    parser.add_argument('--direct', type=int, default=0, help='личных чатов')
+    parser.add_argument('--members', type=int, default=8, help='участников в каждом групповом чате')
+    parser.add_argument('--messages', type=int, default=200000)
+    parser.add_argument('--avatars', type=int, default=0, help='разных аватаров у пользователей')
+    parser.add_argument('--skew', type=float, default=0, help='показатель закона Ципфа, 0 - равномерно')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    rnd = random.Random(args.seed)
+    with app.app_context():
+        if db.session.query(User.id).first() is not None:
+            sys.exit('БД {} уже содержит пользователей, укажите пустую БД через DATABASE_URL'.format(db.engine.url))
+
+        seed(args.users, args.chats, args.members, args.messages, rnd,
+             pick_chat=zipf(rnd, args.chats + args.direct, args.skew),
+             pick_user=zipf(rnd, args.users, args.skew),
+             direct=args.direct, avatars=args.avatars)
+
+    print('Создано пользователей: {}, групповых чатов: {}, личных чатов: {}, сообщений: {}'.format(
+        args.users, args.chats, args.direct, args.messages))
+
+
+if __name__ == '__main__':
+    main()
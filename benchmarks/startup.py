@@ -0,0 +1,82 @@
+# Холодный запуск процесса: время импорта модуля приложения и занятая процессом память.
+# Каждый замер - отдельный процесс python, как у воркера gunicorn. БД временная, первый
+# запуск (с применением миграций) не учитывается:
+#
+#   python -m benchmarks.startup --runs 10 --top 10
+#
+# --top - самые долгие прямые импорты app по данным python -X importtime
+import argparse
+import json
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+
+# Код процесса замера. RSS - максимальный размер резидентной памяти (ru_maxrss, в Linux - КиБ)
+CHILD = ("import json, resource, sys, time\n"
+         "baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss\n"
+         "started = time.perf_counter()\n"
+         "import app\n"
+         "print(json.dumps({'seconds': time.perf_counter() - started,\n"
+         "                  'rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,\n"
+         "                  'baseline_rss_kb': baseline,\n"
+         "                  'modules': len(sys.modules),\n"
+         "                  'phonenumbers': 'phonenumbers' in sys.modules}))\n")
+
+IMPORT_TIME = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def measure(environment, importtime=False):
+    command = [sys.executable] + (['-X', 'importtime'] if importtime else []) + ['-c', CHILD]
+    result = subprocess.run(command, env=environment, capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+# Прямые импорты модуля app с наибольшим накопленным временем, микросекунды
+def slowestImports(stderr, top):
+    imports = []
+    for line in stderr.splitlines():
+        match = IMPORT_TIME.match(line)
+        # Отступ в два пробела - модули, которые импортирует сам app
+        if match and len(match.group(3)) == 3:
+            imports.append((int(match.group(2)), match.group(4)))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Время импорта и память модуля приложения')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--top', type=int, default=10, help='самых долгих импортов, 0 - не показывать')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='coopnet-startup-')
+    try:
+        environment = dict(os.environ,
+                           DATABASE_URL='sqlite:///' + os.path.join(workdir, 'coopnet.db'),
+                           AVATAR_STORAGE=os.path.join(workdir, 'avatars'),
+                           ARCHIVE_PATH=os.path.join(workdir, 'archive.db'))
+        measure(environment)
+        runs = [measure(environment)[0] for _ in range(args.runs)]
+        imports = slowestImports(measure(environment, importtime=True)[1], args.top) if args.top else []
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    seconds = sorted(run['seconds'] for run in runs)
+    print('импорт app, мс:       медиана {:.1f}, мин {:.1f}, макс {:.1f}'.format(
+        statistics.median(seconds) * 1e3, seconds[0] * 1e3, seconds[-1] * 1e3))
+    print('RSS, МиБ:             {:.1f} (интерпретатор до импорта {:.1f})'.format(
+        statistics.median(run['rss_kb'] for run in runs) / 1024,
+        statistics.median(run['baseline_rss_kb'] for run in runs) / 1024))
+    print('загружено модулей:    {}'.format(runs[0]['modules']))
+    print('phonenumbers загружен: {}'.format('да' if runs[0]['phonenumbers'] else 'нет'))
+    for cumulative, name in imports:
+        print('    {:>8.1f} мс  {}'.format(cumulative / 1e3, name))
+
+
+if __name__ == '__main__':
+    main()
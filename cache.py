@@ -0,0 +1,105 @@
+import os
+import pickle
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+# Кэш фрагментов страниц с версиями данных. Фрагмент хранится под ключом,
+# в который входят версии всего, из чего он собран: при изменении данных версия
+# увеличивается, и старые фрагменты просто перестают запрашиваться.
+# Версии не вытесняются, иначе после сброса счетчика снова нашлись бы старые фрагменты.
+# generation отличает счетчики разных экземпляров кэша (например, после перезапуска процесса)
+
+
+# Кэш в памяти процесса: последние max_entries фрагментов
+class LRUCache(object):
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.values = OrderedDict()
+        self.counters = {}
+        self.generation = os.urandom(4).hex()
+
+    def get(self, key):
+        with self.lock:
+            value = self.values.get(key)
+            if value is not None:
+                self.values.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.values[key] = value
+            self.values.move_to_end(key)
+            while len(self.values) > self.max_entries:
+                self.values.popitem(last=False)
+
+    def versions(self, names):
+        with self.lock:
+            return [self.counters.get(name, 0) for name in names]
+
+    def bump(self, names):
+        with self.lock:
+            for name in names:
+                self.counters[name] = self.counters.get(name, 0) + 1
+
+
+# Общий кэш нескольких процессов на одной машине в отдельном файле SQLite.
+# Фрагменты живут не дольше timeout секунд, устаревшие удаляются при записи
+class SQLiteCache(object):
+    def __init__(self, path, timeout):
+        self.path = path
+        self.timeout = timeout
+        self.local = threading.local()
+        self.connection().executescript("create table if not exists fragments "
+                                        "(key text primary key, value blob, expires real);"
+                                        "create table if not exists versions "
+                                        "(name text primary key, version integer not null);")
+        self.connection().execute("insert or ignore into versions (name, version) values ('generation', ?)",
+                                  (random.getrandbits(32),))
+        self.generation = '{:08x}'.format(self.versions(['generation'])[0])
+
+    # Соединение для текущего потока
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('pragma journal_mode = WAL')
+            connection.execute('pragma synchronous = NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def get(self, key):
+        row = self.connection().execute("select value from fragments where key = ? and expires > ?",
+                                        (key, time.time())).fetchone()
+        return pickle.loads(row[0]) if row is not None else None
+
+    def set(self, key, value):
+        now = time.time()
+        connection = self.connection()
+        connection.execute("insert or replace into fragments (key, value, expires) values (?, ?, ?)",
+                           (key, pickle.dumps(value), now + self.timeout))
+        connection.execute("delete from fragments where expires <= ?", (now,))
+
+    def versions(self, names):
+        found = dict(self.connection().execute("select name, version from versions where name in ({})"
+                                               .format(', '.join('?' * len(names))), names).fetchall())
+        return [found.get(name, 0) for name in names]
+
+    def bump(self, names):
+        self.connection().executemany("insert into versions (name, version) values (?, 1) "
+                                      "on conflict (name) do update set version = version + 1",
+                                      [(name,) for name in names])
+
+
+# Кэш по настройкам приложения (CACHE_BACKEND)
+def createCache(config):
+    if config['CACHE_BACKEND'] == 'sqlite':
+        os.makedirs(os.path.dirname(os.path.abspath(config['CACHE_PATH'])), exist_ok=True)
+        return SQLiteCache(config['CACHE_PATH'], config['CACHE_TIMEOUT'])
+    if config['CACHE_BACKEND'] == 'memory':
+        return LRUCache(config['CACHE_MAX_ENTRIES'])
+    raise ValueError('Неизвестный CACHE_BACKEND: {}'.format(config['CACHE_BACKEND']))
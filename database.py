@@ -0,0 +1,48 @@
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+
+# Параметры create_engine из настроек приложения (SQLALCHEMY_ENGINE_OPTIONS).
+# Для файла SQLite SQLAlchemy по умолчанию не держит соединения (NullPool): каждое
+# обращение заново открывает файл, выполняет PRAGMA и теряет кэш подготовленных запросов
+def engineOptions(config):
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    if url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:'):
+        return {}
+
+    options = {'pool_size': config['DATABASE_POOL_SIZE'],
+               'max_overflow': config['DATABASE_MAX_OVERFLOW'],
+               'pool_timeout': config['DATABASE_POOL_TIMEOUT'],
+               'pool_recycle': config['DATABASE_POOL_RECYCLE']}
+    if url.get_backend_name() == 'sqlite':
+        options['poolclass'] = QueuePool
+        # Соединения из пула используются разными потоками
+        options['connect_args'] = {'check_same_thread': False}
+    else:
+        options['pool_pre_ping'] = True
+    return options
+
+
+# Настройка соединений SQLite: PRAGMA из настроек и явное управление транзакциями.
+# Модуль sqlite3 сам открывает транзакцию только перед первой записью, из-за чего
+# транзакция, начатая чтением, не может получить блокировку записи. Поэтому транзакции
+# начинаются здесь: транзакции записи (write_transaction) - через BEGIN IMMEDIATE
+def configureEngine(engine, pragmas):
+    if engine.dialect.name != 'sqlite':
+        return
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute('pragma {} = {}'.format(name, value))
+        cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def begin(connection):
+        if connection.get_execution_options().get('write_transaction'):
+            connection.exec_driver_sql('begin immediate')
+        else:
+            connection.exec_driver_sql('begin')
@@ -0,0 +1,180 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from collections import deque
+
+
+# Буфер последних событий чатов (новые и удаленные сообщения, прочтения, участники, аватары).
+# Каждое событие получает последовательный номер, а подписчики читают буфер
+# со своей позиции, поэтому рассылка не зависит от числа участников чата.
+# Этот вариант работает в пределах одного процесса
+class EventBus(object):
+    def __init__(self, size=1000, logger=None):
+        self.logger = logger or logging.getLogger(__name__)
+        self.events = deque(maxlen=size)
+        self.last_id = 0
+        self.condition = threading.Condition()
+        self.listeners = []
+
+    # Обработчик, который вызывается при каждой публикации (например, сброс кэша)
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+        return listener
+
+    # Публикация события чата
+    def publish(self, chat_id, event_type, data):
+        self.notify(chat_id, event_type, data)
+        with self.condition:
+            event_id = self.last_id + 1
+            self.append([(event_id, chat_id, event_type, data)])
+        return event_id
+
+    # Добавление событий в буфер и пробуждение ожидающих подписчиков (под self.condition)
+    def append(self, events):
+        self.events.extend(events)
+        self.last_id = events[-1][0]
+        self.condition.notify_all()
+
+    # Ошибка одного обработчика не мешает остальным и не отменяет уже записанное событие
+    def notify(self, chat_id, event_type, data):
+        for listener in self.listeners:
+            try:
+                listener(chat_id, event_type, data)
+            except Exception:
+                self.logger.exception('Ошибка обработчика события %s чата %s', event_type, chat_id)
+
+    # Выборка событий нужных чатов с номером больше after_id
+    def since(self, after_id, chat_ids):
+        found = []
+        for event in reversed(self.events):
+            if event[0] <= after_id:
+                break
+            if event[1] in chat_ids:
+                found.append(event)
+        found.reverse()
+        return found
+
+    # Ожидание событий не дольше timeout секунд.
+    # Возвращает найденные события и новую позицию подписчика
+    def wait(self, after_id, chat_ids, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                found = self.since(after_id, chat_ids)
+                remaining = deadline - time.monotonic()
+                if found or remaining <= 0:
+                    return found, self.last_id
+                after_id = self.last_id
+                self.condition.wait(remaining)
+
+
+# Общая шина нескольких процессов на одной машине: журнал событий в файле SQLite.
+# Публикация - одна строка в журнале независимо от числа участников чата.
+# Фоновый поток каждого процесса дочитывает журнал в свой буфер, а запрос к журналу
+# выполняет только когда PRAGMA data_version показывает, что файл изменился.
+# Номера событий общие для всех процессов, поэтому Last-Event-ID годится для любого из них.
+# Обработчики (subscribe) вызываются и для событий других процессов
+class SQLiteEventBus(EventBus):
+    def __init__(self, path, size=1000, log_size=10000, poll_interval=0.05, logger=None):
+        super().__init__(size, logger)
+        self.path = path
+        self.log_size = log_size
+        self.poll_interval = poll_interval
+        # Отличает события этого процесса от событий других процессов
+        self.origin = '{}-{}'.format(os.getpid(), os.urandom(4).hex())
+        self.local = threading.local()
+        self.wakeup = threading.Event()
+
+        connection = self.connection()
+        connection.execute("create table if not exists events "
+                           "(event_id integer primary key autoincrement, origin text, chat_id integer, "
+                           "event_type text, data text)")
+        # Последние события журнала, чтобы переподключившиеся клиенты получили пропущенное
+        rows = connection.execute("select event_id, chat_id, event_type, data "
+                                  "from (select * from events order by event_id desc limit ?) "
+                                  "order by event_id", (size,)).fetchall()
+        if rows:
+            with self.condition:
+                self.append([(event_id, chat_id, event_type, json.loads(data))
+                             for event_id, chat_id, event_type, data in rows])
+
+        threading.Thread(target=self.tail, name='events-tail', daemon=True).start()
+
+    # Соединение с журналом для текущего потока
+    def connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('pragma journal_mode = WAL')
+            connection.execute('pragma synchronous = NORMAL')
+            self.local.connection = connection
+        return connection
+
+    def publish(self, chat_id, event_type, data):
+        event_id = self.connection().execute("insert into events (origin, chat_id, event_type, data) "
+                                             "values (?, ?, ?, ?)",
+                                             (self.origin, chat_id, event_type, json.dumps(data))).lastrowid
+        self.wakeup.set()
+        self.notify(chat_id, event_type, data)
+        return event_id
+
+    # Дочитывание журнала в буфер процесса. Поток не должен завершаться: без него процесс
+    # перестает получать события других процессов и сбрасывать свой кэш. После ошибки
+    # журнал перечитывается с последнего добавленного в буфер события
+    def tail(self):
+        connection = self.connection()
+        data_version = None
+        trimmed = time.monotonic()
+        while True:
+            self.wakeup.wait(self.poll_interval)
+            self.wakeup.clear()
+
+            try:
+                data_version = self.poll(connection, data_version)
+
+                # Журнал хранит только последние log_size событий
+                if time.monotonic() - trimmed > 60:
+                    trimmed = time.monotonic()
+                    connection.execute("delete from events where event_id <= ?", (self.last_id - self.log_size,))
+            except sqlite3.OperationalError:
+                # Журнал занят другим процессом, повторим на следующем шаге
+                data_version = None
+            except Exception:
+                self.logger.exception('Ошибка чтения журнала событий')
+                data_version = None
+
+    # Новые события журнала: обработчики и буфер. Возвращает прочитанную версию данных
+    def poll(self, connection, data_version):
+        version = connection.execute('pragma data_version').fetchone()[0]
+        if version == data_version:
+            return version
+
+        rows = connection.execute("select event_id, origin, chat_id, event_type, data "
+                                  "from events where event_id > ? order by event_id",
+                                  (self.last_id,)).fetchall()
+        if rows:
+            events = [(event_id, chat_id, event_type, json.loads(data))
+                      for event_id, origin, chat_id, event_type, data in rows]
+            # Обработчики - до пробуждения подписчиков, чтобы те уже видели сброшенный кэш
+            for (event_id, origin, chat_id, event_type, data), event in zip(rows, events):
+                if origin != self.origin:
+                    self.notify(chat_id, event_type, event[3])
+            with self.condition:
+                self.append(events)
+        return version
+
+
+# Шина событий по настройкам приложения (EVENTS_BACKEND)
+def createEventBus(config, logger=None):
+    if config['EVENTS_BACKEND'] == 'sqlite':
+        return SQLiteEventBus(config['EVENTS_PATH'],
+                              config['EVENTS_BUFFER_SIZE'],
+                              config['EVENTS_LOG_SIZE'],
+                              config['EVENTS_POLL_INTERVAL'],
+                              logger)
+    if config['EVENTS_BACKEND'] == 'memory':
+        return EventBus(config['EVENTS_BUFFER_SIZE'], logger)
+    raise ValueError('Неизвестный EVENTS_BACKEND: {}'.format(config['EVENTS_BACKEND']))
@@ -0,0 +1,72 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+# Очередь записи переполнена, клиенту стоит повторить запрос позже
+class IngestQueueFull(Exception):
+    pass
+
+
+# Групповая запись сообщений. Запросы кладут сообщения в ограниченную очередь,
+# а фоновый поток записывает их пачками: одна транзакция на пачку вместо транзакции
+# на каждое сообщение. Пачка закрывается, когда набралось max_batch сообщений
+# или с первого сообщения прошло max_delay секунд. Отправитель ждет Future,
+# который получает id сообщения после фиксации транзакции
+class MessageWriter(object):
+    def __init__(self, write_batch, max_queue, max_batch, max_delay):
+        self.write_batch = write_batch
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.queue = queue.Queue(max_queue)
+        self.thread = threading.Thread(target=self.run, name='message-writer', daemon=True)
+        self.thread.start()
+
+    # Постановка сообщения в очередь. Возвращает Future с результатом записи
+    def submit(self, item):
+        future = Future()
+        try:
+            self.queue.put_nowait((item, future))
+        except queue.Full:
+            raise IngestQueueFull()
+        return future
+
+    # Дописываем то, что уже в очереди, и останавливаем поток
+    def close(self):
+        self.queue.put((None, None))
+        self.thread.join()
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch and batch[-1][1] is not None:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = batch[-1][1] is None
+            if stop:
+                batch.pop()
+            if batch:
+                self.flush(batch)
+            if stop:
+                return
+
+    def flush(self, batch):
+        try:
+            results = self.write_batch([item for item, future in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # Транзакция пачки откатилась целиком. Повторяем по одному сообщению,
+            # чтобы ошибку получил только отправитель сообщения, которое ее вызвало
+            for item in batch:
+                self.flush([item])
+            return
+        for (item, future), result in zip(batch, results):
+            future.set_result(result)
@@ -0,0 +1,153 @@
+import threading
+import time
+
+from flask import Response, g, has_request_context, request
+from jinja2 import Template
+from sqlalchemy import event
+
+
+# Границы корзин гистограмм: длительности в секундах и количество запросов к БД
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+# Гистограммы по маршрутам в формате Prometheus
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def observe(self, name, buckets, labels, value):
+        with self.lock:
+            histogram = self.histograms.setdefault(name, (buckets, {}))[1]
+            counts = histogram.setdefault(labels, [[0] * len(buckets), 0, 0])
+            for number, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[0][number] += 1
+            counts[1] += value
+            counts[2] += 1
+
+    def render(self, descriptions):
+        lines = []
+        with self.lock:
+            for name, (buckets, histogram) in sorted(self.histograms.items()):
+                lines.append('# HELP {} {}'.format(name, descriptions[name]))
+                lines.append('# TYPE {} histogram'.format(name))
+                for labels, (counts, total, count) in sorted(histogram.items()):
+                    label = ','.join('{}="{}"'.format(key, value.replace('\\', '\\\\').replace('"', '\\"'))
+                                     for key, value in labels)
+                    for bound, bucket in zip(buckets, counts):
+                        lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, label, bound, bucket))
+                    lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(name, label, count))
+                    lines.append('{}_sum{{{}}} {}'.format(name, label, total))
+                    lines.append('{}_count{{{}}} {}'.format(name, label, count))
+        return '\n'.join(lines) + '\n'
+
+
+METRICS_DESCRIPTIONS = {
+    'coopnet_request_duration_seconds': 'Время обработки запроса',
+    'coopnet_request_db_seconds': 'Время запросов к БД за один запрос',
+    'coopnet_request_template_seconds': 'Время отрисовки шаблонов за один запрос',
+    'coopnet_request_queries': 'Количество запросов к БД за один запрос',
+}
+
+
+# Шаблон, который учитывает время своей отрисовки в текущем запросе.
+# Сигналы Flask о шаблонах без blinker не работают, поэтому время снимается здесь
+class TimedTemplate(Template):
+    def render(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            if has_request_context() and 'template_time' in g:
+                g.template_time += time.perf_counter() - started
+
+
+# План медленного запроса: EXPLAIN QUERY PLAN в SQLite, EXPLAIN в остальных БД.
+# Выполняется напрямую через DBAPI, чтобы не попасть в обработчики событий
+def explainQuery(connection, statement, parameters):
+    prefix = 'explain query plan ' if connection.dialect.name == 'sqlite' else 'explain '
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        return '\n'.join(' '.join(str(column) for column in row) for row in cursor.fetchall())
+    except Exception as e:
+        return 'план недоступен: {}'.format(str(e))
+    finally:
+        cursor.close()
+
+
+# Параметры запроса для журнала без значений: в них бывают хэши паролей, email и тексты
+# сообщений. Остаются имена (или позиции) и типы
+def redactParameters(parameters):
+    if isinstance(parameters, dict):
+        return {name: type(value).__name__ for name, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [redactParameters(value) if isinstance(value, (dict, list, tuple)) else type(value).__name__
+                for value in parameters]
+    return type(parameters).__name__
+
+
+# Включаемые настройкой INSTRUMENTATION замеры: количество и время запросов к БД
+# в каждом запросе, время шаблонов, заголовок Server-Timing, журнал медленных запросов
+# с их планом и гистограммы по маршрутам на /metrics
+def instrument(app, engine):
+    metrics = Metrics()
+    slow_query = app.config['SLOW_QUERY_THRESHOLD']
+    log_parameters = app.config['SLOW_QUERY_LOG_PARAMETERS']
+    app.jinja_env.template_class = TimedTemplate
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def beforeCursorExecute(connection, cursor, statement, parameters, context, executemany):
+        context.query_started = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def afterCursorExecute(connection, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context.query_started
+        if has_request_context() and 'db_time' in g:
+            g.db_queries += 1
+            g.db_time += elapsed
+
+        if elapsed >= slow_query:
+            plan = ''
+            if not executemany and statement.lstrip().lower().startswith(('select', 'with')):
+                plan = explainQuery(connection, statement, parameters)
+            app.logger.warning('Медленный запрос к БД (%.1f мс): %s\nПараметры: %r\nПлан:\n%s',
+                               elapsed * 1e3, statement,
+                               parameters if log_parameters else redactParameters(parameters), plan)
+
+    @app.before_request
+    def startTiming():
+        g.request_started = time.perf_counter()
+        g.db_queries = 0
+        g.db_time = 0
+        g.template_time = 0
+
+    @app.after_request
+    def finishTiming(response):
+        if 'request_started' not in g:
+            return response
+        total = time.perf_counter() - g.request_started
+        response.headers.add('Server-Timing', 'db;dur={:.2f};desc="{} queries"'.format(g.db_time * 1e3, g.db_queries))
+        response.headers.add('Server-Timing', 'tpl;dur={:.2f}'.format(g.template_time * 1e3))
+        response.headers.add('Server-Timing', 'total;dur={:.2f}'.format(total * 1e3))
+
+        if request.endpoint != 'metrics':
+            labels = (('method', request.method),
+                      ('route', request.url_rule.rule if request.url_rule is not None else 'unmatched'),
+                      ('status', str(response.status_code)))
+            metrics.observe('coopnet_request_duration_seconds', DURATION_BUCKETS, labels, total)
+            metrics.observe('coopnet_request_db_seconds', DURATION_BUCKETS, labels, g.db_time)
+            metrics.observe('coopnet_request_template_seconds', DURATION_BUCKETS, labels, g.template_time)
+            metrics.observe('coopnet_request_queries', QUERY_BUCKETS, labels, g.db_queries)
+        return response
+
+    # Метрики отдаются только локальным адресам
+    def metricsView():
+        if request.remote_addr not in app.config['METRICS_ALLOWED_ADDRESSES']:
+            return Response(status=403)
+        return Response(metrics.render(METRICS_DESCRIPTIONS), mimetype='text/plain; version=0.0.4')
+
+    app.add_url_rule('/metrics', 'metrics', metricsView)
+    return metrics
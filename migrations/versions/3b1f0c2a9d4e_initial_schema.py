@@ -0,0 +1,144 @@
+"""Начальная схема: пользователи, чаты, сообщения, сводки чатов, границы прочтения, поиск
+
+Revision ID: 3b1f0c2a9d4e
+Revises:
+Create Date: 2026-10-18 12:00:00.000000
+
+Принимает и БД, созданные до перехода на миграции: недостающие таблицы и колонки
+добавляются, существующие остаются как есть. Новые таблицы заполняются по сообщениям.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b1f0c2a9d4e'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    connection = op.get_bind()
+    inspector = sa.inspect(connection)
+    tables = set(inspector.get_table_names())
+
+    def columns(table):
+        return {column['name'] for column in inspector.get_columns(table)}
+
+    # region Таблицы первой версии приложения
+    if 'Пользователь' not in tables:
+        op.create_table('Пользователь',
+                        sa.Column('id', sa.Integer(), nullable=False),
+                        sa.Column('email', sa.String(length=320), nullable=True),
+                        sa.Column('name', sa.String(length=60), nullable=True),
+                        sa.Column('telephone', sa.String(length=15), nullable=True),
+                        sa.Column('login', sa.String(length=32), nullable=True),
+                        sa.Column('password', sa.String(length=500), nullable=True),
+                        sa.Column('info', sa.String(length=70), nullable=True),
+                        sa.Column('date_registration', sa.DateTime(), nullable=True),
+                        sa.Column('photo', sa.BLOB(), nullable=True),
+                        sa.Column('photo_hash', sa.String(length=64), nullable=True),
+                        sa.PrimaryKeyConstraint('id'),
+                        sa.UniqueConstraint('email'),
+                        sa.UniqueConstraint('login'),
+                        sa.UniqueConstraint('telephone'))
+    elif 'photo_hash' not in columns('Пользователь'):
+        op.add_column('Пользователь', sa.Column('photo_hash', sa.String(length=64), nullable=True))
+
+    if 'Чат' not in tables:
+        op.create_table('Чат',
+                        sa.Column('chat_id', sa.Integer(), nullable=False),
+                        sa.Column('chat_name', sa.String(length=32), nullable=True),
+                        sa.Column('chat_description', sa.String(length=70), nullable=True),
+                        sa.Column('chat_photo', sa.BLOB(), nullable=True),
+                        sa.Column('chat_photo_hash', sa.String(length=64), nullable=True),
+                        sa.Column('chat_creator', sa.Integer(), nullable=True),
+                        sa.ForeignKeyConstraint(['chat_creator'], ['Пользователь.id']),
+                        sa.PrimaryKeyConstraint('chat_id'))
+    elif 'chat_photo_hash' not in columns('Чат'):
+        op.add_column('Чат', sa.Column('chat_photo_hash', sa.String(length=64), nullable=True))
+
+    if 'Список Участников Чата' not in tables:
+        op.create_table('Список Участников Чата',
+                        sa.Column('chat_id', sa.Integer(), nullable=True),
+                        sa.Column('user_id', sa.String(length=320), nullable=True),
+                        sa.ForeignKeyConstraint(['chat_id'], ['Чат.chat_id']),
+                        sa.ForeignKeyConstraint(['user_id'], ['Пользователь.id']))
+
+    if 'Сообщение' not in tables:
+        op.create_table('Сообщение',
+                        sa.Column('message_id', sa.Integer(), autoincrement=True, nullable=False),
+                        sa.Column('chat_id', sa.Integer(), nullable=True),
+                        sa.Column('message_sender', sa.Integer(), nullable=True),
+                        sa.Column('message_content', sa.String(length=120), nullable=True),
+                        sa.Column('message_date_sent', sa.DateTime(), nullable=True),
+                        sa.Column('message_status', sa.Integer(), nullable=True),
+                        sa.ForeignKeyConstraint(['chat_id'], ['Чат.chat_id']),
+                        sa.ForeignKeyConstraint(['message_sender'], ['Пользователь.id']),
+                        sa.PrimaryKeyConstraint('message_id'))
+    # endregion
+
+    # region Личные чаты, сводки чатов и границы прочтения
+    if 'Личный Чат' not in tables:
+        op.create_table('Личный Чат',
+                        sa.Column('chat_id', sa.Integer(), nullable=False),
+                        sa.Column('user_a', sa.Integer(), nullable=False),
+                        sa.Column('user_b', sa.Integer(), nullable=False),
+                        sa.ForeignKeyConstraint(['chat_id'], ['Чат.chat_id']),
+                        sa.ForeignKeyConstraint(['user_a'], ['Пользователь.id']),
+                        sa.ForeignKeyConstraint(['user_b'], ['Пользователь.id']),
+                        sa.PrimaryKeyConstraint('chat_id'),
+                        sa.UniqueConstraint('user_a', 'user_b', name='uq_direct_chat_users'))
+
+    if 'Сводка Чата' not in tables:
+        op.create_table('Сводка Чата',
+                        sa.Column('chat_id', sa.Integer(), nullable=False),
+                        sa.Column('last_message_id', sa.Integer(), nullable=True),
+                        sa.Column('last_message_content', sa.String(length=120), nullable=True),
+                        sa.Column('last_message_date_sent', sa.DateTime(), nullable=True),
+                        sa.Column('last_message_sender', sa.Integer(), nullable=True),
+                        sa.ForeignKeyConstraint(['chat_id'], ['Чат.chat_id']),
+                        sa.ForeignKeyConstraint(['last_message_sender'], ['Пользователь.id']),
+                        sa.PrimaryKeyConstraint('chat_id'))
+        op.execute("insert into \"Сводка Чата\" (chat_id, last_message_id, last_message_content, last_message_date_sent, last_message_sender) "
+                   "select chat_id, message_id, message_content, message_date_sent, message_sender "
+                   "from \"Сообщение\" "
+                   "where message_id in (select max(message_id) from \"Сообщение\" group by chat_id)")
+
+    # Прочтения переносятся из message_status сообщений
+    if 'Прочитанные Сообщения' not in tables:
+        op.create_table('Прочитанные Сообщения',
+                        sa.Column('chat_id', sa.Integer(), nullable=False),
+                        sa.Column('user_id', sa.Integer(), nullable=False),
+                        sa.Column('last_read_message_id', sa.Integer(), nullable=False),
+                        sa.ForeignKeyConstraint(['chat_id'], ['Чат.chat_id']),
+                        sa.ForeignKeyConstraint(['user_id'], ['Пользователь.id']),
+                        sa.PrimaryKeyConstraint('chat_id', 'user_id'))
+        op.execute("insert into \"Прочитанные Сообщения\" (chat_id, user_id, last_read_message_id) "
+                   "select member.chat_id, cast(member.user_id as integer), max(mes.message_id) "
+                   "from \"Список Участников Чата\" member inner join \"Сообщение\" mes "
+                   "on mes.chat_id = member.chat_id "
+                   "and (mes.message_sender = cast(member.user_id as integer) or mes.message_status = 1) "
+                   "group by member.chat_id, member.user_id")
+    # endregion
+
+    # Полнотекстовый индекс сообщений (FTS5, только SQLite)
+    if connection.dialect.name == 'sqlite' and 'Поиск Сообщений' not in tables:
+        op.execute("create virtual table \"Поиск Сообщений\" "
+                   "using fts5(message_content, chat_id unindexed, "
+                   "content='Сообщение', content_rowid='message_id', "
+                   "tokenize='unicode61 remove_diacritics 2')")
+        op.execute("insert into \"Поиск Сообщений\" (\"Поиск Сообщений\") values ('rebuild')")
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'sqlite':
+        op.execute("drop table if exists \"Поиск Сообщений\"")
+    op.drop_table('Прочитанные Сообщения')
+    op.drop_table('Сводка Чата')
+    op.drop_table('Личный Чат')
+    op.drop_table('Сообщение')
+    op.drop_table('Список Участников Чата')
+    op.drop_table('Чат')
+    op.drop_table('Пользователь')
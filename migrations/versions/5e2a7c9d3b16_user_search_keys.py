@@ -0,0 +1,59 @@
+"""Ключи поиска пользователей
+
+Revision ID: 5e2a7c9d3b16
+Revises: 8c4d2e7f1a05
+Create Date: 2026-10-18 15:00:00.000000
+
+lower() в SQLite меняет регистр только латинских букв, и поиск по началу кириллического
+имени ничего не находил. Логин, имя и email без учета регистра (str.casefold) хранятся
+в колонках login_key, name_key, email_key, индексы lower(...) заменяются индексами по ним.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e2a7c9d3b16'
+down_revision = '8c4d2e7f1a05'
+branch_labels = None
+depends_on = None
+
+
+def searchKey(value):
+    return value.casefold() if value else value
+
+
+def upgrade():
+    connection = op.get_bind()
+    columns = {column['name'] for column in sa.inspect(connection).get_columns('Пользователь')}
+    for name, length in (('login_key', 32), ('name_key', 60), ('email_key', 320)):
+        if name not in columns:
+            op.add_column('Пользователь', sa.Column(name, sa.String(length=length), nullable=True))
+
+    users = connection.execute(sa.text("select id, login, name, email from \"Пользователь\"")).fetchall()
+    if users:
+        connection.execute(sa.text("update \"Пользователь\" "
+                                   "set login_key = :login_key, name_key = :name_key, email_key = :email_key "
+                                   "where id = :id"),
+                           [{'id': user_id, 'login_key': searchKey(login), 'name_key': searchKey(name),
+                             'email_key': searchKey(email)} for user_id, login, name, email in users])
+
+    op.drop_index('ix_user_lower_login', table_name='Пользователь', if_exists=True)
+    op.drop_index('ix_user_lower_name', table_name='Пользователь', if_exists=True)
+    op.drop_index('ix_user_lower_email', table_name='Пользователь', if_exists=True)
+    op.create_index('ix_user_login_key', 'Пользователь', ['login_key'], if_not_exists=True)
+    op.create_index('ix_user_name_key', 'Пользователь', ['name_key'], if_not_exists=True)
+    op.create_index('ix_user_email_key', 'Пользователь', ['email_key'], if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_user_email_key', table_name='Пользователь')
+    op.drop_index('ix_user_name_key', table_name='Пользователь')
+    op.drop_index('ix_user_login_key', table_name='Пользователь')
+    op.create_index('ix_user_lower_login', 'Пользователь', [sa.text('lower(login)')])
+    op.create_index('ix_user_lower_name', 'Пользователь', [sa.text('lower(name)')])
+    op.create_index('ix_user_lower_email', 'Пользователь', [sa.text('lower(email)')])
+    with op.batch_alter_table('Пользователь') as batch_op:
+        batch_op.drop_column('email_key')
+        batch_op.drop_column('name_key')
+        batch_op.drop_column('login_key')
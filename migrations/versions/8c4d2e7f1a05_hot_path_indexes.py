@@ -0,0 +1,43 @@
+"""Индексы горячего пути
+
+Revision ID: 8c4d2e7f1a05
+Revises: 3b1f0c2a9d4e
+Create Date: 2026-10-18 12:30:00.000000
+
+Планы запросов с этими индексами проверяет benchmarks/explain.py.
+- участники чата: по пользователю (боковая панель, членство) и по чату (участники, собеседник);
+- сообщения: история по курсору message_id и счетчик непрочитанных - покрывающий
+  индекс с отправителем вместо индекса (chat_id, message_id);
+- пользователи: поиск в справочнике по началу lower(login), lower(name), lower(email).
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c4d2e7f1a05'
+down_revision = '3b1f0c2a9d4e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_chat_user_user_id_chat_id', 'Список Участников Чата', ['user_id', 'chat_id'], if_not_exists=True)
+    op.create_index('ix_chat_user_chat_id_user_id', 'Список Участников Чата', ['chat_id', 'user_id'], if_not_exists=True)
+
+    op.drop_index('ix_message_chat_id_message_id', table_name='Сообщение', if_exists=True)
+    op.create_index('ix_message_chat_id_message_id_sender', 'Сообщение', ['chat_id', 'message_id', 'message_sender'],
+                    if_not_exists=True)
+
+    op.create_index('ix_user_lower_login', 'Пользователь', [sa.text('lower(login)')], if_not_exists=True)
+    op.create_index('ix_user_lower_name', 'Пользователь', [sa.text('lower(name)')], if_not_exists=True)
+    op.create_index('ix_user_lower_email', 'Пользователь', [sa.text('lower(email)')], if_not_exists=True)
+
+
+def downgrade():
+    op.drop_index('ix_user_lower_email', table_name='Пользователь')
+    op.drop_index('ix_user_lower_name', table_name='Пользователь')
+    op.drop_index('ix_user_lower_login', table_name='Пользователь')
+    op.drop_index('ix_message_chat_id_message_id_sender', table_name='Сообщение')
+    op.drop_index('ix_chat_user_chat_id_user_id', table_name='Список Участников Чата')
+    op.drop_index('ix_chat_user_user_id_chat_id', table_name='Список Участников Чата')
@@ -0,0 +1,94 @@
+import secrets
+import threading
+import time
+from concurrent import futures
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+
+# Все потоки хэширования заняты и очередь заполнена: клиент повторяет запрос позже
+class HasherBusy(Exception):
+    pass
+
+
+# Хэширование паролей в ограниченном пуле потоков. Хэш намеренно дорогой, поэтому
+# одновременно считается не больше workers хэшей, а в очереди ждут не больше queue_size:
+# шквал входов не занимает все ядра и потоки, которые обслуживают чаты.
+# method - алгоритм и стоимость в формате werkzeug ('pbkdf2:sha256:260000');
+# хэши, посчитанные с другими параметрами, пересчитываются при успешном входе
+class PasswordHasher(object):
+    def __init__(self, method, workers, queue_size, timeout):
+        self.method = method
+        self.timeout = timeout
+        self.dummy = None
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='password-hasher')
+
+    def run(self, function, *args):
+        if not self.slots.acquire(blocking=False):
+            raise HasherBusy()
+        try:
+            future = self.executor.submit(function, *args)
+        except BaseException:
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda done: self.slots.release())
+        # Хэш не посчитан за timeout секунд - пул перегружен, как и при заполненной очереди
+        try:
+            return future.result(self.timeout)
+        except futures.TimeoutError:
+            raise HasherBusy() from None
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password, self.method)
+
+    # password_hash None - пользователя нет: пароль сверяется с подставным хэшем той же
+    # стоимости, чтобы ответ занимал столько же времени, и проверка не проходит
+    def verify(self, password_hash, password):
+        if password_hash is None:
+            if self.dummy is None:
+                self.dummy = self.hash(secrets.token_hex(16))
+            self.run(check_password_hash, self.dummy, password)
+            return False
+        return self.run(check_password_hash, password_hash, password)
+
+    # Хэш посчитан с другим алгоритмом или стоимостью
+    def outdated(self, password_hash):
+        return password_hash.split('$', 1)[0] != self.method
+
+
+# Ограничение неудачных попыток по ключу (пользователь, адрес): не больше limit
+# за window секунд. Счетчики хранятся в памяти процесса, устаревшие удаляются,
+# когда ключей становится больше max_keys
+class AttemptThrottle(object):
+    def __init__(self, limit, window, max_keys=100000):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.attempts = {}
+
+    # Сколько секунд ключ еще заблокирован, 0 - попытка разрешена
+    def blocked(self, key):
+        with self.lock:
+            started, count = self.attempts.get(key, (0, 0))
+            remaining = started + self.window - time.monotonic()
+            if count < self.limit or remaining <= 0:
+                return 0
+            return remaining
+
+    def failed(self, key):
+        now = time.monotonic()
+        with self.lock:
+            started, count = self.attempts.get(key, (now, 0))
+            if started + self.window <= now:
+                started, count = now, 0
+            self.attempts[key] = (started, count + 1)
+            if len(self.attempts) > self.max_keys:
+                self.attempts = {key: value for key, value in self.attempts.items()
+                                 if value[0] + self.window > now}
+
+    def reset(self, key):
+        with self.lock:
+            self.attempts.pop(key, None)
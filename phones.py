@@ -0,0 +1,30 @@
+import threading
+
+
+# Проверка телефонных номеров. Пакет phonenumbers заметно увеличивает время запуска
+# и память каждого процесса, а нужен только при регистрации, поэтому он импортируется
+# при первой проверке. Номер проверяется только по метаданным регионов regions
+# (первый - регион по умолчанию для номеров без кода страны)
+class PhoneValidator(object):
+    def __init__(self, regions):
+        self.regions = tuple(regions)
+        self.lock = threading.Lock()
+        self.phonenumbers = None
+
+    # Импорт пакета и загрузка метаданных регионов, один раз на процесс
+    def load(self):
+        with self.lock:
+            if self.phonenumbers is None:
+                import phonenumbers
+                for region in self.regions:
+                    phonenumbers.PhoneMetadata.metadata_for_region(region)
+                self.phonenumbers = phonenumbers
+        return self.phonenumbers
+
+    def valid(self, phone):
+        phonenumbers = self.phonenumbers or self.load()
+        try:
+            number = phonenumbers.parse(phone, self.regions[0])
+        except phonenumbers.NumberParseException:
+            return False
+        return any(phonenumbers.is_valid_number_for_region(number, region) for region in self.regions)
@@ -0,0 +1,288 @@
+from sqlalchemy import text, bindparam
+
+
+# Запросы приложения. Значения передаются только через параметры (:name),
+# поэтому текст каждого запроса постоянен: SQLAlchemy компилирует его один раз,
+# а SQLite повторно использует подготовленное выражение из кэша соединения.
+# Запросы написаны на общем для SQLite и PostgreSQL SQL: идентификаторы в двойных кавычках,
+# user_id участника чата хранится строкой, поэтому сравнения с ним - через cast.
+# Полнотекстовый поиск (FTS5) есть только в SQLite
+
+
+# region Пользователи
+# Данные пользователя текущего запроса
+USER_IDENTITY = text("select id, email, name, login, photo_hash "
+                     "from \"Пользователь\" "
+                     "where id = :user_id")
+
+# Данные пользователя и хэш пароля для авторизации
+USER_CREDENTIALS = text("select id, email, name, login, photo_hash, password "
+                        "from \"Пользователь\" "
+                        "where email = :email")
+
+UPDATE_USER_PASSWORD = text("update \"Пользователь\" "
+                            "set password = :password "
+                            "where id = :user_id")
+
+USER_EMAIL = text("select email "
+                  "from \"Пользователь\" "
+                  "where id = :user_id")
+
+USER_PHOTO_HASH = text("select photo_hash "
+                       "from \"Пользователь\" "
+                       "where id = :user_id")
+
+USER_PROFILE = text("select id, email, name, telephone, login, info, date_registration, photo_hash "
+                    "from \"Пользователь\" "
+                    "where id = :user_id")
+
+INSERT_USER = text("insert into \"Пользователь\" (email, name, telephone, login, password, info, date_registration, "
+                   "email_key, name_key, login_key) "
+                   "values (:email, :name, :telephone, :login, :password, :info, :date_registration, "
+                   ":email_key, :name_key, :login_key)")
+
+# Справочник: поиск по началу логина, имени или email по индексам ключей поиска
+SEARCH_USERS = text("select id, email, name, login, photo_hash "
+                    "from \"Пользователь\" "
+                    "where id in (select id from \"Пользователь\" where login_key >= :query and login_key < :query_end "
+                    "union select id from \"Пользователь\" where name_key >= :query and name_key < :query_end "
+                    "union select id from \"Пользователь\" where email_key >= :query and email_key < :query_end) "
+                    "and id > :after and id != :user_id "
+                    "order by id "
+                    "limit :limit")
+
+# Существующие пользователи из списка id
+EXISTING_USERS = text("select id "
+                      "from \"Пользователь\" "
+                      "where id in :user_ids").bindparams(bindparam('user_ids', expanding=True))
+
+# Справочник без поиска: страница по первичному ключу
+LIST_USERS = text("select id, email, name, login, photo_hash "
+                  "from \"Пользователь\" "
+                  "where id > :after and id != :user_id "
+                  "order by id "
+                  "limit :limit")
+# endregion
+
+
+# region Чаты
+# Все чаты пользователя для боковой панели одним запросом по сводкам чатов.
+# Для личных чатов возвращается собеседник, чаты упорядочены по последней активности
+USER_CHATS = text("select c.chat_id, "
+                  "case when c.chat_description = 'chat' then c.chat_name else friend.email end as chat_name, "
+                  "c.chat_description, friend.id as companion_id, "
+                  "case when c.chat_description = 'chat' then c.chat_photo_hash else friend.photo_hash end as photo_hash, "
+                  "s.last_message_id, s.last_message_sender, s.last_message_content, s.last_message_date_sent, "
+                  "(select count(*) "
+                  "from \"Сообщение\" mes "
+                  "where mes.chat_id = me.chat_id and mes.message_id > coalesce(r.last_read_message_id, 0) "
+                  "and mes.message_sender != :user_id) as unread_count "
+                  "from \"Список Участников Чата\" me "
+                  "inner join \"Чат\" c on c.chat_id = me.chat_id "
+                  "left join \"Сводка Чата\" s on s.chat_id = me.chat_id "
+                  "left join \"Прочитанные Сообщения\" r on r.chat_id = me.chat_id and r.user_id = :user_id "
+                  "left join \"Список Участников Чата\" other "
+                  "on c.chat_description != 'chat' and other.chat_id = me.chat_id and other.user_id != me.user_id "
+                  "left join \"Пользователь\" friend on friend.id = cast(other.user_id as integer) "
+                  "where me.user_id = cast(:user_id as varchar) "
+                  "order by s.last_message_id desc")
+
+# Пользователь состоит в чате
+CHAT_MEMBER = text("select 1 "
+                   "from \"Список Участников Чата\" "
+                   "where chat_id = :chat_id and user_id = cast(:user_id as varchar)")
+
+USER_CHAT_IDS = text("select chat_id "
+                     "from \"Список Участников Чата\" "
+                     "where user_id = cast(:user_id as varchar)")
+
+CHAT = text("select chat_id, chat_name, chat_description, chat_creator, chat_photo_hash "
+            "from \"Чат\" "
+            "where chat_id = :chat_id")
+
+CHAT_PHOTO_HASH = text("select chat_photo_hash "
+                       "from \"Чат\" "
+                       "where chat_id = :chat_id")
+
+# Первый участник чата, кроме пользователя (собеседник в личном чате)
+CHAT_COMPANION = text("select user_id "
+                      "from \"Список Участников Чата\" "
+                      "where chat_id = :chat_id and user_id != cast(:user_id as varchar)")
+
+# Участники чата, кроме пользователя
+CHAT_PARTICIPANTS = text("select id, email, photo_hash "
+                         "from \"Пользователь\" "
+                         "where id in (select cast(user_id as integer) "
+                         "from \"Список Участников Чата\" "
+                         "where chat_id = :chat_id and user_id != cast(:user_id as varchar))")
+
+INSERT_CHAT = text("insert into \"Чат\" (chat_name, chat_description, chat_creator) "
+                   "values (:chat_name, :chat_description, :chat_creator) "
+                   "returning chat_id")
+
+# Id всех участников чата
+CHAT_MEMBER_IDS = text("select cast(user_id as integer) "
+                       "from \"Список Участников Чата\" "
+                       "where chat_id = :chat_id")
+
+INSERT_CHAT_MEMBER = text("insert into \"Список Участников Чата\" (chat_id, user_id) "
+                          "values (:chat_id, cast(:user_id as varchar))")
+
+DELETE_CHAT_MEMBER = text("delete from \"Список Участников Чата\" "
+                          "where chat_id = :chat_id and user_id = cast(:user_id as varchar)")
+
+DIRECT_CHAT = text("select chat_id "
+                   "from \"Личный Чат\" "
+                   "where user_a = :user_a and user_b = :user_b")
+
+INSERT_DIRECT_CHAT = text("insert into \"Личный Чат\" (chat_id, user_a, user_b) "
+                          "values (:chat_id, :user_a, :user_b)")
+# endregion
+
+
+# region Сообщения
+# Страница истории чата, которая заканчивается перед сообщением before (курсор), без OFFSET
+CHAT_MESSAGES = text("select mes.message_id, mes.chat_id, mes.message_sender, sender.name, mes.message_content, "
+                     "mes.message_date_sent, mes.message_status, sender.photo_hash "
+                     "from (select * "
+                     "from \"Сообщение\" "
+                     "where chat_id = :chat_id and message_id < :before "
+                     "order by message_id desc "
+                     "limit :limit) mes left join \"Пользователь\" sender on mes.message_sender = sender.id "
+                     "order by mes.message_id asc")
+
+# Границы страницы истории чата перед сообщением before: первый и последний id и число сообщений
+CHAT_PAGE_BOUNDS = text("select min(message_id), max(message_id), count(*) "
+                        "from (select message_id "
+                        "from \"Сообщение\" "
+                        "where chat_id = :chat_id and message_id < :before "
+                        "order by message_id desc "
+                        "limit :limit)")
+
+# Есть ли в чате сообщения старше before
+CHAT_OLDER_MESSAGE = text("select 1 "
+                          "from \"Сообщение\" "
+                          "where chat_id = :chat_id and message_id < :before "
+                          "limit 1")
+
+# Сообщения чата с first по last по возрастанию: идут в порядке индекса, без сортировки,
+# поэтому следующие limit строк читаются сразу, без просмотра всего диапазона
+CHAT_MESSAGES_RANGE = text("select mes.message_id, mes.chat_id, mes.message_sender, sender.name, mes.message_content, "
+                           "mes.message_date_sent, mes.message_status, sender.photo_hash "
+                           "from \"Сообщение\" mes left join \"Пользователь\" sender on mes.message_sender = sender.id "
+                           "where mes.chat_id = :chat_id and mes.message_id between :first and :last "
+                           "order by mes.message_id asc "
+                           "limit :limit")
+
+# Сообщения чата после сообщения since по возрастанию (дозагрузка новых сообщений)
+CHAT_MESSAGES_SINCE = text("select mes.message_id, mes.chat_id, mes.message_sender, sender.name, mes.message_content, "
+                           "mes.message_date_sent, mes.message_status, sender.photo_hash "
+                           "from \"Сообщение\" mes left join \"Пользователь\" sender on mes.message_sender = sender.id "
+                           "where mes.chat_id = :chat_id and mes.message_id > :since "
+                           "order by mes.message_id asc "
+                           "limit :limit")
+
+# Отправители сообщений из архива
+MESSAGE_SENDERS = text("select id, name, photo_hash "
+                       "from \"Пользователь\" "
+                       "where id in :user_ids").bindparams(bindparam('user_ids', expanding=True))
+
+# Сообщения старше cutoff для переноса в архив: по чатам, после пары (chat_id, message_id)
+ARCHIVE_CANDIDATES = text("select message_id, chat_id, message_sender, message_content, message_date_sent, message_status "
+                          "from \"Сообщение\" "
+                          "where (chat_id, message_id) > (:chat_id, :message_id) and message_date_sent < :cutoff "
+                          "order by chat_id, message_id "
+                          "limit :limit")
+
+DELETE_MESSAGES = text("delete from \"Сообщение\" "
+                       "where message_id in :message_ids").bindparams(bindparam('message_ids', expanding=True))
+
+# Сообщение пользователя (для проверки прав на удаление)
+OWN_MESSAGE = text("select chat_id, message_content "
+                   "from \"Сообщение\" "
+                   "where message_id = :message_id and message_sender = :user_id")
+
+INSERT_MESSAGE = text("insert into \"Сообщение\" (chat_id, message_sender, message_content, message_date_sent, message_status) "
+                      "values (:chat_id, :message_sender, :message_content, :message_date_sent, 0) "
+                      "returning message_id")
+
+DELETE_MESSAGE = text("delete from \"Сообщение\" "
+                      "where message_id = :message_id")
+
+# Сводка чата переходит к новому сообщению
+UPSERT_CHAT_SUMMARY = text("insert into \"Сводка Чата\" (chat_id, last_message_id, last_message_content, last_message_date_sent, last_message_sender) "
+                           "values (:chat_id, :message_id, :message_content, :message_date_sent, :message_sender) "
+                           "on conflict (chat_id) do update set "
+                           "last_message_id = excluded.last_message_id, "
+                           "last_message_content = excluded.last_message_content, "
+                           "last_message_date_sent = excluded.last_message_date_sent, "
+                           "last_message_sender = excluded.last_message_sender")
+
+# Если удалено последнее сообщение, сводка переходит к предыдущему. Когда в основной таблице
+# сообщений чата не осталось, сводка не меняется: предыдущее сообщение ищется в архиве
+REWIND_CHAT_SUMMARY = text("UPDATE \"Сводка Чата\" "
+                           "set (last_message_id, last_message_content, last_message_date_sent, last_message_sender) = "
+                           "(select message_id, message_content, message_date_sent, message_sender "
+                           "from \"Сообщение\" "
+                           "where chat_id = :chat_id "
+                           "order by message_id desc "
+                           "limit 1) "
+                           "where chat_id = :chat_id and last_message_id = :message_id "
+                           "and exists (select 1 from \"Сообщение\" where chat_id = :chat_id)")
+
+# Сводка переходит к сообщению из архива (или ко всем NULL, если сообщений не осталось)
+REWIND_CHAT_SUMMARY_TO = text("UPDATE \"Сводка Чата\" "
+                              "set last_message_id = :message_id, "
+                              "last_message_content = :message_content, "
+                              "last_message_date_sent = :message_date_sent, "
+                              "last_message_sender = :message_sender "
+                              "where chat_id = :chat_id and last_message_id = :deleted_id")
+
+# Последнее сообщение чата по сводке
+CHAT_LAST_MESSAGE_ID = text("select last_message_id "
+                            "from \"Сводка Чата\" "
+                            "where chat_id = :chat_id")
+
+# Сдвигаем границу прочтения только вперед
+MARK_CHAT_READ = text("insert into \"Прочитанные Сообщения\" (chat_id, user_id, last_read_message_id) "
+                      "values (:chat_id, :user_id, :message_id) "
+                      "on conflict (chat_id, user_id) do update set last_read_message_id = excluded.last_read_message_id "
+                      "where excluded.last_read_message_id > \"Прочитанные Сообщения\".last_read_message_id")
+
+DELETE_READ_MARK = text("delete from \"Прочитанные Сообщения\" "
+                        "where chat_id = :chat_id and user_id = :user_id")
+
+# Последнее сообщение чата, прочитанное кем-либо из собеседников. Отметки пользователей,
+# которые уже не состоят в чате, не учитываются
+CHAT_READ_UP_TO = text("select max(mark.last_read_message_id) "
+                       "from \"Прочитанные Сообщения\" mark inner join \"Список Участников Чата\" member "
+                       "on member.chat_id = mark.chat_id and member.user_id = cast(mark.user_id as varchar) "
+                       "where mark.chat_id = :chat_id and mark.user_id != :user_id")
+# endregion
+
+
+# region Поиск сообщений
+# Совпадения из индекса FTS5 в чатах пользователя, упорядоченные по релевантности (bm25)
+SEARCH_MESSAGES = text("select mes.message_id, mes.chat_id, "
+                       "case when c.chat_description = 'chat' then c.chat_name else friend.email end as chat_name, "
+                       "c.chat_description, "
+                       "case when c.chat_description = 'chat' then c.chat_photo_hash else friend.photo_hash end as photo_hash, "
+                       "snippet(\"Поиск Сообщений\", 0, '', '', '…', 12) as snippet, mes.message_date_sent "
+                       "from \"Поиск Сообщений\" "
+                       "inner join \"Сообщение\" mes on mes.message_id = \"Поиск Сообщений\".rowid "
+                       "inner join \"Чат\" c on c.chat_id = mes.chat_id "
+                       "left join \"Список Участников Чата\" other "
+                       "on c.chat_description != 'chat' and other.chat_id = c.chat_id and other.user_id != cast(:user_id as varchar) "
+                       "left join \"Пользователь\" friend on friend.id = cast(other.user_id as integer) "
+                       "where \"Поиск Сообщений\" match :query "
+                       "and \"Поиск Сообщений\".chat_id in (select chat_id from \"Список Участников Чата\" where user_id = cast(:user_id as varchar)) "
+                       "order by \"Поиск Сообщений\".rank "
+                       "limit :limit offset :offset")
+
+SEARCH_INDEX_INSERT = text("insert into \"Поиск Сообщений\" (rowid, message_content, chat_id) "
+                           "values (:message_id, :message_content, :chat_id)")
+
+# Индекс хранит только ссылки, поэтому удаляемый текст передается ему явно
+SEARCH_INDEX_DELETE = text("insert into \"Поиск Сообщений\" (\"Поиск Сообщений\", rowid, message_content, chat_id) "
+                           "values ('delete', :message_id, :message_content, :chat_id)")
+# endregion
@@ -0,0 +1,98 @@
+import itertools
+import os
+import tempfile
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+# Приложение импортируется один раз, все его файлы - во временном каталоге.
+# Хэш пароля дешевый, чтобы регистрация и вход в тестах не занимали время
+workdir = tempfile.mkdtemp(prefix='coopnet-tests-')
+os.environ.update(DATABASE_URL='sqlite:///' + os.path.join(workdir, 'coopnet.db'),
+                  SCHEMA_LOCK_PATH=os.path.join(workdir, 'schema.lock'),
+                  ARCHIVE_PATH=os.path.join(workdir, 'archive.db'),
+                  AVATAR_STORAGE=os.path.join(workdir, 'avatars'),
+                  ASSETS_BUILD_PATH=os.path.join(workdir, 'dist'),
+                  JINJA_BYTECODE_CACHE='',
+                  CACHE_BACKEND='memory',
+                  EVENTS_BACKEND='memory',
+                  MESSAGE_INGEST='0',
+                  INSTRUMENTATION='0',
+                  PASSWORD_HASH_METHOD='pbkdf2:sha256:1000')
+
+import app as coopnet  # noqa: E402
+
+PASSWORD = 'password'
+
+# Номера для уникальных email, логинов и телефонов
+numbers = itertools.count(1)
+
+
+class RegisteredUser(object):
+    def __init__(self, id, email):
+        self.id = id
+        self.email = email
+
+
+@pytest.fixture
+def app():
+    return coopnet
+
+
+# Запрос к БД приложения: строки результата (для изменяющих запросов - пустой список)
+@pytest.fixture
+def query():
+    def execute(sql, **parameters):
+        with coopnet.app.app_context():
+            result = coopnet.db.engine.execute(coopnet.text(sql), **parameters)
+            return result.fetchall() if result.returns_rows else []
+    return execute
+
+
+# Новый пользователь, зарегистрированный через форму
+@pytest.fixture
+def register(query):
+    def create():
+        number = next(numbers)
+        email = 'user{}@test.ru'.format(number)
+        response = coopnet.app.test_client().post('/registration', data={'name': 'Тестовый',
+                                                                         'login': 'tester{}'.format(number),
+                                                                         'phone': '900{:07d}'.format(number),
+                                                                         'reg_email': email,
+                                                                         'reg_password': PASSWORD,
+                                                                         'confirm_password': PASSWORD})
+        assert response.status_code == 302
+        return RegisteredUser(query('select id from "Пользователь" where email = :email', email=email)[0][0], email)
+    return create
+
+
+# Клиент, авторизованный под пользователем
+@pytest.fixture
+def login():
+    def client(user):
+        test_client = coopnet.app.test_client()
+        response = test_client.post('/', data={'email': user.email, 'password': PASSWORD})
+        assert response.status_code == 302
+        return test_client
+    return client
+
+
+# Групповой чат: создатель и участники. Возвращает id чата
+@pytest.fixture
+def group(login):
+    def create(creator, *members):
+        response = login(creator).post('/creatingchat', data=dict({str(member.id): '' for member in members},
+                                                                  ChatNameCreate='Группа'))
+        assert response.status_code == 302
+        return int(parse_qs(urlparse(response.location).query)['selectedchat'][0])
+    return create
+
+
+# Отправка сообщения через API. Возвращает id сообщения
+@pytest.fixture
+def send():
+    def message(client, chat_id, content='сообщение'):
+        response = client.post('/api/chats/{}/messages'.format(chat_id), json={'message_content': content})
+        assert response.status_code == 201
+        return response.get_json()['message_id']
+    return message
@@ -0,0 +1,55 @@
+def messagesUrl(chat_id):
+    return '/api/chats/{}/messages'.format(chat_id)
+
+
+def test_same_page_is_not_modified(register, login, group, send):
+    creator = register()
+    chat_id = group(creator)
+    client = login(creator)
+    send(client, chat_id)
+
+    etag = client.get(messagesUrl(chat_id)).headers['ETag']
+
+    assert client.get(messagesUrl(chat_id), headers={'If-None-Match': etag}).status_code == 304
+
+
+def test_etag_differs_between_pages(register, login, group, send):
+    creator = register()
+    chat_id = group(creator)
+    client = login(creator)
+    message_ids = [send(client, chat_id, 'сообщение {}'.format(number)) for number in range(3)]
+
+    latest = client.get(messagesUrl(chat_id))
+    older = client.get(messagesUrl(chat_id), query_string={'before': message_ids[1]},
+                       headers={'If-None-Match': latest.headers['ETag']})
+    since = client.get(messagesUrl(chat_id), query_string={'since': message_ids[0]},
+                       headers={'If-None-Match': latest.headers['ETag']})
+
+    assert older.status_code == 200
+    assert [message['message_id'] for message in older.get_json()['messages']] == message_ids[:1]
+    assert since.status_code == 200
+    assert [message['message_id'] for message in since.get_json()['messages']] == message_ids[1:]
+    assert len({latest.headers['ETag'], older.headers['ETag'], since.headers['ETag']}) == 3
+
+
+def test_etag_differs_between_users(register, login, group, send):
+    creator, member = register(), register()
+    chat_id = group(creator, member)
+    creator_client, member_client = login(creator), login(member)
+    send(creator_client, chat_id)
+
+    etag = creator_client.get(messagesUrl(chat_id)).headers['ETag']
+
+    assert member_client.get(messagesUrl(chat_id), headers={'If-None-Match': etag}).status_code == 200
+
+
+def test_new_message_changes_etag(register, login, group, send):
+    creator = register()
+    chat_id = group(creator)
+    client = login(creator)
+    send(client, chat_id)
+    etag = client.get(messagesUrl(chat_id)).headers['ETag']
+
+    send(client, chat_id)
+
+    assert client.get(messagesUrl(chat_id), headers={'If-None-Match': etag}).status_code == 200
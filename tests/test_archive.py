@@ -0,0 +1,50 @@
+from datetime import datetime
+
+JSON = {'Accept': 'application/json'}
+
+
+def summary(query, chat_id):
+    return query('select last_message_id, last_message_content from "Сводка Чата" where chat_id = :chat_id',
+                 chat_id=chat_id)[0]
+
+
+# Сообщения чата до message_id (включительно) переносятся в архив
+def archive(app, query, chat_id, message_id):
+    query('update "Сообщение" set message_date_sent = :date where chat_id = :chat_id and message_id <= :message_id',
+          date='2000-01-01 00:00:00', chat_id=chat_id, message_id=message_id)
+    with app.app.app_context():
+        app.archivingMessages(datetime(2001, 1, 1), 100, 200)
+
+
+def test_summary_rewinds_into_archive(app, query, register, login, group, send):
+    creator = register()
+    chat_id = group(creator)
+    client = login(creator)
+    message_ids = [send(client, chat_id, 'сообщение {}'.format(number)) for number in range(3)]
+    archive(app, query, chat_id, message_ids[0])
+
+    client.post('/deletemessage', query_string={'chat_id': chat_id}, data={'submit': message_ids[2]}, headers=JSON)
+    assert tuple(summary(query, chat_id)) == (message_ids[1], 'сообщение 1')
+
+    # В основной таблице сообщений чата не осталось - сводка берется из архива
+    client.post('/deletemessage', query_string={'chat_id': chat_id}, data={'submit': message_ids[1]}, headers=JSON)
+    assert tuple(summary(query, chat_id)) == (message_ids[0], 'сообщение 0')
+
+    # Удалено последнее сообщение архива
+    client.post('/deletemessage', query_string={'chat_id': chat_id}, data={'submit': message_ids[0]}, headers=JSON)
+    assert tuple(summary(query, chat_id)) == (None, None)
+
+
+def test_rebuild_keeps_archived_chat_summaries(app, query, register, login, group, send):
+    creator = register()
+    archived_chat, active_chat = group(creator), group(creator)
+    client = login(creator)
+    archived_id = send(client, archived_chat, 'в архиве')
+    active_id = send(client, active_chat, 'в таблице')
+    archive(app, query, archived_chat, archived_id)
+
+    with app.app.app_context():
+        app.rebuildChatSummaries()
+
+    assert tuple(summary(query, archived_chat)) == (archived_id, 'в архиве')
+    assert tuple(summary(query, active_chat)) == (active_id, 'в таблице')
@@ -0,0 +1,140 @@
+import pytest
+
+JSON = {'Accept': 'application/json'}
+
+
+def readMarks(query, chat_id):
+    return dict(query('select user_id, last_read_message_id from "Прочитанные Сообщения" where chat_id = :chat_id',
+                      chat_id=chat_id))
+
+
+def readUpTo(client, chat_id):
+    return client.get('/api/chats/{}/messages'.format(chat_id)).get_json()['read_up_to']
+
+
+# region Участники чата
+@pytest.mark.parametrize('streaming', [False, True])
+def test_homepage_redirects_non_member(app, query, register, login, group, send, streaming, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'HOMEPAGE_STREAMING', streaming)
+    creator, member, outsider = register(), register(), register()
+    chat_id = group(creator, member)
+    send(login(creator), chat_id, 'секрет')
+
+    response = login(outsider).get('/HomePage', query_string={'selectedchat': chat_id})
+
+    assert response.status_code == 302
+    assert 'секрет' not in response.get_data(as_text=True)
+    assert outsider.id not in readMarks(query, chat_id)
+
+
+def test_homepage_shows_chat_to_member(register, login, group, send):
+    creator, member = register(), register()
+    chat_id = group(creator, member)
+    send(login(creator), chat_id, 'привет')
+
+    response = login(member).get('/HomePage', query_string={'selectedchat': chat_id})
+
+    assert response.status_code == 200
+    assert 'привет' in response.get_data(as_text=True)
+
+
+def test_sendmessage_requires_chat_and_membership(register, login, group):
+    creator, outsider = register(), register()
+    chat_id = group(creator)
+    client = login(outsider)
+
+    assert client.post('/sendmessage', data={'MessageText': 'x'}, headers=JSON).status_code == 400
+    assert client.post('/sendmessage', query_string={'chat_id': chat_id},
+                       data={'MessageText': 'x'}, headers=JSON).status_code == 403
+    assert login(creator).post('/sendmessage', query_string={'chat_id': chat_id},
+                               data={'MessageText': 'x'}, headers=JSON).status_code == 201
+
+
+def test_api_hides_chat_from_non_member(register, login, group):
+    creator, outsider = register(), register()
+    chat_id = group(creator)
+
+    assert login(outsider).get('/api/chats/{}/messages'.format(chat_id)).status_code == 404
+# endregion
+
+
+# region Отметки о прочтении
+def test_readmessages_requires_membership(query, register, login, group, send):
+    creator, outsider = register(), register()
+    chat_id = group(creator)
+    message_id = send(login(creator), chat_id)
+
+    response = login(outsider).post('/readmessages', query_string={'chat_id': chat_id}, data={'message_id': message_id})
+
+    assert response.status_code == 403
+    assert outsider.id not in readMarks(query, chat_id)
+
+
+def test_read_mark_is_clamped_to_last_message(query, register, login, group, send):
+    creator, member = register(), register()
+    chat_id = group(creator, member)
+    message_id = send(login(creator), chat_id)
+    client = login(member)
+
+    response = client.post('/readmessages', query_string={'chat_id': chat_id}, data={'message_id': message_id + 1000})
+    assert response.get_json()['last_read_message_id'] == message_id
+    response = client.post('/api/chats/{}/read'.format(chat_id), json={'message_id': message_id + 1000})
+    assert response.get_json()['last_read_message_id'] == message_id
+    assert readMarks(query, chat_id)[member.id] == message_id
+
+
+def test_read_up_to_counts_only_members(query, register, login, group, send):
+    creator, member, outsider = register(), register(), register()
+    chat_id = group(creator, member)
+    creator_client = login(creator)
+    message_id = send(creator_client, chat_id)
+    query('insert into "Прочитанные Сообщения" (chat_id, user_id, last_read_message_id) '
+          'values (:chat_id, :user_id, :message_id)', chat_id=chat_id, user_id=outsider.id, message_id=message_id)
+    assert readUpTo(creator_client, chat_id) == 0
+
+    login(member).post('/readmessages', query_string={'chat_id': chat_id}, data={'message_id': message_id})
+    assert readUpTo(creator_client, chat_id) == message_id
+
+    creator_client.post('/removechatmembers', query_string={'chat_id': chat_id}, data={str(member.id): ''}, headers=JSON)
+    assert readUpTo(creator_client, chat_id) == 0
+# endregion
+
+
+# region Удаление участников
+@pytest.mark.parametrize('streaming', [False, True])
+def test_group_with_only_creator_renders(app, register, login, group, send, streaming, monkeypatch):
+    monkeypatch.setitem(app.app.config, 'HOMEPAGE_STREAMING', streaming)
+    creator, member = register(), register()
+    chat_id = group(creator, member)
+    client = login(creator)
+    send(client, chat_id)
+
+    response = client.post('/removechatmembers', query_string={'chat_id': chat_id}, data={str(member.id): ''}, headers=JSON)
+    assert response.get_json() == {'chat_id': chat_id, 'removed': [member.id]}
+
+    assert client.get('/HomePage', query_string={'selectedchat': chat_id}).status_code == 200
+    assert client.get('/HomePage', query_string={'selectedchat': group(creator)}).status_code == 200
+
+
+def test_removed_member_loses_access(register, login, group):
+    creator, member = register(), register()
+    chat_id = group(creator, member)
+    member_client = login(member)
+    assert member_client.get('/HomePage', query_string={'selectedchat': chat_id}).status_code == 200
+
+    login(creator).post('/removechatmembers', query_string={'chat_id': chat_id}, data={str(member.id): ''}, headers=JSON)
+
+    assert member_client.get('/HomePage', query_string={'selectedchat': chat_id}).status_code == 302
+    assert member_client.get('/api/chats/{}/messages'.format(chat_id)).status_code == 404
+
+
+def test_only_creator_removes_members(register, login, group):
+    creator, member, other = register(), register(), register()
+    chat_id = group(creator, member, other)
+
+    response = login(member).post('/removechatmembers', query_string={'chat_id': chat_id},
+                                  data={str(other.id): ''}, headers=JSON)
+
+    assert response.status_code == 404
+    assert login(other).get('/api/chats/{}/messages'.format(chat_id)).status_code == 200
+# endregion
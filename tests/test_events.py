@@ -0,0 +1,31 @@
+import os
+import time
+
+from events import SQLiteEventBus
+
+
+def waitFor(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+# Ошибка обработчика не останавливает поток, который дочитывает журнал
+def test_tail_survives_listener_errors(tmp_path):
+    path = os.path.join(str(tmp_path), 'events.db')
+    publisher, subscriber = SQLiteEventBus(path), SQLiteEventBus(path)
+    received = []
+
+    @subscriber.subscribe
+    def failing(chat_id, event_type, data):
+        raise RuntimeError('обработчик')
+
+    @subscriber.subscribe
+    def recording(chat_id, event_type, data):
+        received.append(chat_id)
+
+    publisher.publish(1, 'message', {})
+    assert waitFor(lambda: received == [1])
+    publisher.publish(2, 'message', {})
+    assert waitFor(lambda: received == [1, 2])
@@ -0,0 +1,24 @@
+import pytest
+
+from ingest import MessageWriter
+
+
+# Пачка с ошибочным сообщением: ошибку получает только его отправитель
+def test_failing_item_does_not_fail_batch():
+    batches = []
+
+    def writeBatch(items):
+        batches.append(list(items))
+        if None in items:
+            raise ValueError('пустое сообщение')
+        return [item * 10 for item in items]
+
+    writer = MessageWriter(writeBatch, 100, 10, 0.05)
+    futures = [writer.submit(item) for item in (1, None, 3)]
+    writer.close()
+
+    assert futures[0].result(1) == 10
+    with pytest.raises(ValueError):
+        futures[1].result(1)
+    assert futures[2].result(1) == 30
+    assert batches[0] == [1, None, 3]
@@ -0,0 +1,56 @@
+import threading
+
+import pytest
+
+from passwords import AttemptThrottle, HasherBusy, PasswordHasher
+
+
+def test_throttle_blocks_after_limit():
+    throttle = AttemptThrottle(2, 60)
+    throttle.failed('key')
+    assert not throttle.blocked('key')
+    throttle.failed('key')
+    assert throttle.blocked('key') > 0
+    assert not throttle.blocked('other')
+
+    throttle.reset('key')
+    assert not throttle.blocked('key')
+
+
+def test_hasher_timeout_is_busy():
+    hasher = PasswordHasher('pbkdf2:sha256:1000', 1, 1, 0.05)
+    release = threading.Event()
+    try:
+        with pytest.raises(HasherBusy):
+            hasher.run(release.wait, 5)
+    finally:
+        release.set()
+
+
+def test_unknown_user_password_never_matches():
+    hasher = PasswordHasher('pbkdf2:sha256:1000', 1, 1, 5)
+    assert not hasher.verify(None, 'password')
+    assert hasher.verify(hasher.hash('password'), 'password')
+
+
+def login(app, user, password, address):
+    return app.app.test_client().post('/', data={'email': user.email, 'password': password},
+                                      environ_base={'REMOTE_ADDR': address})
+
+
+def test_failed_logins_from_one_address_do_not_lock_out_owner(app, register):
+    user = register()
+    for _ in range(app.app.config['LOGIN_ACCOUNT_ADDRESS_ATTEMPTS']):
+        assert login(app, user, 'wrong', '10.1.0.1').status_code == 200
+
+    assert login(app, user, 'password', '10.1.0.1').status_code == 429
+    assert login(app, user, 'password', '10.1.0.2').status_code == 302
+
+
+def test_account_is_throttled_across_addresses(app, register, monkeypatch):
+    monkeypatch.setattr(app.account_throttle, 'limit', 3)
+    user = register()
+    for number in range(3):
+        assert login(app, user, 'wrong', '10.2.0.{}'.format(number)).status_code == 200
+
+    assert login(app, user, 'wrong', '10.2.0.100').status_code == 429